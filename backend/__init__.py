@@ -1 +1,8 @@
 # Health Assistant Backend
+import os
+
+from dotenv import load_dotenv
+
+# Load .env from the project root once, before any backend module reads its settings.
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"),
+            override=False)
@@ -0,0 +1,232 @@
+"""
+Process-wide admission control for upstream model calls.
+
+At most UPSTREAM_MAX_CONCURRENCY generations run at once; further requests
+wait in a bounded priority queue instead of all hitting the provider (and
+its 429s) together. Possible emergencies go to the front of the queue and
+are never refused for a full queue. When the queue is full, new requests are refused at once
+(the routes answer 503 with Retry-After) rather than piling up.
+"""
+import asyncio
+import heapq
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from backend import metrics
+
+# Upstream generations in flight per process (0 disables admission control).
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "16"))
+# Requests allowed to wait for a slot; beyond this, non-priority requests are shed.
+ADMISSION_QUEUE_MAX = int(os.getenv("ADMISSION_QUEUE_MAX", "64"))
+# Longest a queued request waits before it is shed.
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "10"))
+
+metrics.describe('admission_wait_seconds', 'Time spent queued for an upstream slot, by priority.')
+metrics.describe('admission_shed_total', 'Requests refused an upstream slot, by reason (queue_full, timeout).')
+
+
+class AdmissionRejected(Exception):
+    """No upstream slot: the queue is full or the wait timed out. retry_after is a hint in whole seconds."""
+
+    def __init__(self, reason: str, retry_after: int, queue_depth: int):
+        super().__init__(f"upstream admission refused ({reason}), retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+
+
+class Ticket:
+    """
+    A request's place in line: it holds a slot already or is queued for one.
+    wait() until it holds one, then close() when the upstream call ends
+    (close() also leaves the queue, and is safe to call more than once).
+    """
+
+    def __init__(self, controller: "AdmissionController | None", priority: bool):
+        self.controller = controller
+        self.priority = priority
+        self.granted = controller is None
+        self.closed = False
+        self.granted_at = time.monotonic()
+        self._wake = threading.Event()
+        self._async_wakers: list = []
+
+    def _grant(self) -> None:
+        """Called by the controller, under its lock."""
+        self.granted = True
+        self.granted_at = time.monotonic()
+        self._wake.set()
+        for loop, event in self._async_wakers:
+            loop.call_soon_threadsafe(event.set)
+
+    def wait(self, cancel=None) -> bool:
+        """
+        Block until the ticket holds a slot. Returns False if it was closed or
+        cancel (an upstream.Cancellation) fired first; raises AdmissionRejected on timeout.
+        """
+        if self.controller is None or self.granted:
+            return not self.closed
+        if cancel is not None:
+            cancel.on_cancel(self._wake.set)
+        started = time.monotonic()
+        self._wake.wait(self.controller.max_wait)
+        return self._waited(started, cancel is not None and cancel.cancelled)
+
+    async def wait_async(self) -> bool:
+        """Async twin of wait(); cancel the awaiting task to give up."""
+        if self.controller is None or self.granted:
+            return not self.closed
+        event = asyncio.Event()
+        with self.controller._lock:
+            if not self.granted:
+                self._async_wakers.append((asyncio.get_running_loop(), event))
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(event.wait(), None if self.granted else self.controller.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self._waited(started, True)
+            raise
+        return self._waited(started, False)
+
+    def _waited(self, started: float, cancelled: bool) -> bool:
+        metrics.observe('admission_wait_seconds', time.monotonic() - started, priority=str(self.priority).lower())
+        if cancelled or self.closed:
+            self.close()
+            return False
+        if self.granted:
+            return True
+        self.close()
+        with self.controller._lock:
+            raise self.controller._reject('timeout')
+
+    def close(self) -> None:
+        controller = self.controller
+        if controller is None:
+            return
+        with controller._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if not self.granted:
+                controller._queued -= 1  # left the queue; skipped when its turn comes
+                return
+        controller._release(time.monotonic() - self.granted_at)
+
+
+class AdmissionController:
+    """
+    Counting semaphore with a priority wait queue. A freed slot is handed
+    straight to the best waiting ticket (priority first, then arrival order),
+    so a newcomer can never overtake the queue.
+    """
+
+    def __init__(self, limit: int = UPSTREAM_MAX_CONCURRENCY, queue_max: int = ADMISSION_QUEUE_MAX,
+                 max_wait: float = ADMISSION_MAX_WAIT_SECONDS):
+        self.limit = limit
+        self.queue_max = queue_max
+        self.max_wait = max_wait
+        self._active = 0
+        # (0 for priority else 1, seq, ticket); closed tickets are skipped lazily.
+        self._queue: list[tuple[int, int, Ticket]] = []
+        self._queued = 0
+        self._seq = 0
+        self._hold_ewma = 2.0
+        self._shed = 0
+        self._lock = threading.Lock()
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._hold_ewma * (self._queued + 1) / max(1, self.limit)))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        """Caller holds _lock."""
+        self._shed += 1
+        metrics.inc('admission_shed_total', reason=reason)
+        return AdmissionRejected(reason, self._retry_after(), self._queued)
+
+    def queue_full(self) -> bool:
+        """True if a non-priority request arriving now would be shed."""
+        with self._lock:
+            return self.limit > 0 and self._active >= self.limit and self._queued >= self.queue_max
+
+    def enter(self, priority: bool = False) -> Ticket:
+        """
+        Take a free slot or a place in the queue, without blocking. Raises
+        AdmissionRejected at once when the queue is full (never for priority).
+        """
+        if self.limit <= 0:
+            return Ticket(None, priority)
+        ticket = Ticket(self, priority)
+        with self._lock:
+            if self._active < self.limit and not self._queued:
+                self._active += 1
+                ticket._grant()
+                return ticket
+            if not priority and self._queued >= self.queue_max:
+                raise self._reject('queue_full')
+            self._seq += 1
+            heapq.heappush(self._queue, (0 if priority else 1, self._seq, ticket))
+            self._queued += 1
+        return ticket
+
+    def try_enter(self) -> Ticket | None:
+        """
+        A granted ticket if a slot is free right now (nobody queued), else None.
+        Never queues: for optional extra calls, such as hedges, that are only
+        worth making with spare capacity.
+        """
+        if self.limit <= 0:
+            return Ticket(None, False)
+        ticket = Ticket(self, False)
+        with self._lock:
+            if self._active >= self.limit or self._queued:
+                return None
+            self._active += 1
+            ticket._grant()
+        return ticket
+
+    def _release(self, held: float) -> None:
+        """A ticket that held a slot for held seconds closed: hand the slot to the next waiter."""
+        with self._lock:
+            self._hold_ewma += 0.2 * (held - self._hold_ewma)
+            while self._queue:
+                _, _, ticket = heapq.heappop(self._queue)
+                if ticket.closed:
+                    continue
+                self._queued -= 1
+                ticket._grant()
+                return
+            self._active -= 1
+
+    @contextmanager
+    def slot(self, priority: bool = False, ticket: Ticket | None = None):
+        """
+        Hold a slot for the with-block, entering the queue unless ticket is given.
+        Raises AdmissionRejected if the ticket times out or was already closed.
+        """
+        ticket = ticket or self.enter(priority)
+        try:
+            if not ticket.wait():
+                with self._lock:
+                    raise self._reject('closed')
+            yield
+        finally:
+            ticket.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'active': self._active,
+                'queue_depth': self._queued,
+                'shed': self._shed,
+                'est_wait_seconds': self._retry_after() if self._queued else 0,
+            }
+
+
+admission = AdmissionController()
+metrics.register_gauges('admission', admission.stats)
@@ -1,30 +1,41 @@
-"""OpenAI/OpenRouter API integration for symptom analysis."""
+"""
+OpenAI/OpenRouter API integration for symptom analysis.
+
+The openai SDK is imported on first use (_get_client), not at module import,
+so serverless cold starts don't pay for it before the first analysis.
+Upstream traffic can be recorded to a cassette file and replayed offline
+with its original timing (UPSTREAM_CASSETTE_MODE, see backend.cassette).
+"""
+import json
 import os
+import sys
+import threading
 import time
-from pathlib import Path
-from typing import Optional
-from dotenv import load_dotenv
-from openai import OpenAI
-
-try:
-    # Optional: specific exceptions exist in newer SDK versions
-    from openai import (
-        APIConnectionError,
-        APITimeoutError,
-        AuthenticationError,
-        RateLimitError,
-    )
-except Exception:  # pragma: no cover
-    APIConnectionError = APITimeoutError = AuthenticationError = RateLimitError = Exception  # type: ignore
+from typing import TYPE_CHECKING, Optional
 
-_PROJECT_ROOT = Path(__file__).resolve().parents[1]
-# Load .env from project root regardless of current working directory
-load_dotenv(dotenv_path=_PROJECT_ROOT / ".env", override=False)
+from backend import metrics
+from backend.admission import AdmissionRejected, Ticket, admission
+from backend.circuit import (
+    RETRY_MAX_ATTEMPTS, CircuitOpenError, backoff_delay, retry_after_seconds, retry_scheduler,
+)
+from backend.cache import ANALYSIS_CACHE_TTL_SECONDS, TTLCache, analysis_cache, make_cache_key, similar_cache
+from backend.http_pool import get_http_client, start_warm_up
+from backend.medical_context import build_medical_context
+from backend.sections import CompletionDetector, trim_after_completion
+from backend.triage import pre_triage
+from backend.upstream import UPSTREAM_BACKENDS, Backend, Cancellation, hedged_stream, parse_backends
 
-# Client state
-_client: OpenAI | None = None
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# Client state: one client per upstream backend (see backend.upstream)
+_clients: "dict[str, OpenAI]" = {}
+_clients_lock = threading.Lock()
+_backend_list: list[Backend] | None = None
 
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "").strip()
+# Where the openai SDK sends requests when no base URL is configured.
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
 
 
 def _default_model() -> str:
@@ -43,10 +54,14 @@ def _default_model() -> str:
 # Set OPENAI_MODEL in .env to override
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", _default_model()).strip() or _default_model()
 
+# Upper bound on generated tokens; streams usually stop earlier (see _until_complete).
+MAX_OUTPUT_TOKENS = 400
+
 
 def _openrouter_extra_headers() -> dict:
     """
     OpenRouter recommends attribution headers. These are optional.
+    Read once (OPENROUTER_HEADERS) and sent as every client's default headers.
 
     https://openrouter.ai/docs
     """
@@ -60,36 +75,244 @@ def _openrouter_extra_headers() -> dict:
     return headers
 
 
-def _get_client() -> OpenAI:
-    """Get or create OpenAI client. Uses OPENAI_API_KEY from env."""
-    global _client
-    if _client is None:
+OPENROUTER_HEADERS = _openrouter_extra_headers()
+
+
+def _replaying() -> bool:
+    """True when upstream calls are answered from a cassette (see backend.cassette), so no API key is needed."""
+    if not os.getenv("UPSTREAM_CASSETTE", "").strip():
+        return False  # no cassette: don't import the module (and httpx) on every config check
+    from backend import cassette
+    return cassette.UPSTREAM_CASSETTE_MODE == "replay"
+
+
+def _client_kwargs(backend: Backend | None = None) -> dict:
+    """Constructor arguments shared by the sync and async clients (for backend, or the default)."""
+    if _replaying():
+        api_key = "replay"
+    elif backend is not None and backend.key_env:
+        api_key = os.getenv(backend.key_env, "").strip()
+        if not api_key:
+            raise ValueError(f"{backend.key_env} environment variable is not set (backend {backend.name})")
+    else:
         api_key = (
             os.getenv("OPENROUTER_API_KEY", "").strip()
             or os.getenv("OPENAI_API_KEY", "").strip()
         )
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY (or OPENROUTER_API_KEY) environment variable is not set")
-        base_url = OPENAI_BASE_URL or os.getenv("OPENROUTER_BASE_URL", "").strip()
-        timeout_s = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "20").strip() or "20")
-        if base_url:
-            _client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout_s)
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY (or OPENROUTER_API_KEY) environment variable is not set")
+    base_url = OPENAI_BASE_URL or os.getenv("OPENROUTER_BASE_URL", "").strip()
+    if backend is not None and backend.base_url:
+        base_url = backend.base_url
+    timeout_s = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "20").strip() or "20")
+    # Retries are scheduled off the request thread (backend.circuit), not slept in the SDK.
+    max_retries = int(os.getenv("OPENAI_MAX_RETRIES", "0").strip() or "0")
+    kwargs = {"api_key": api_key, "timeout": timeout_s, "max_retries": max_retries,
+              "default_headers": OPENROUTER_HEADERS}
+    if base_url:
+        kwargs["base_url"] = base_url
+    return kwargs
+
+
+def _backends() -> list[Backend]:
+    """Configured upstream backends in preference order (UPSTREAM_BACKENDS, else OPENAI_MODEL)."""
+    global _backend_list
+    if _backend_list is None:
+        _backend_list = parse_backends(UPSTREAM_BACKENDS, OPENAI_MODEL)
+    return _backend_list
+
+
+def _backend_client(backend: Backend) -> "OpenAI":
+    """Get or create the client for one backend."""
+    client = _clients.get(backend.name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(backend.name)
+            if client is None:
+                with metrics.span('upstream_client_create_seconds'):
+                    from openai import OpenAI
+                    client = _clients[backend.name] = OpenAI(**_client_kwargs(backend), http_client=get_http_client())
+    return client
+
+
+def _get_client() -> "OpenAI":
+    """Get or create the primary backend's OpenAI client. Uses OPENAI_API_KEY from env."""
+    return _backend_client(_backends()[0])
+
+
+def upstream_base_urls() -> list[str]:
+    """Base URL of every configured backend (the SDK default when unset), skipping backends without a key."""
+    urls = []
+    for backend in _backends():
+        try:
+            urls.append(_client_kwargs(backend).get("base_url") or DEFAULT_BASE_URL)
+        except ValueError:
+            continue
+    return urls
+
+
+def warm_up_upstream() -> None:
+    """
+    In the background: open pooled connections to the upstream hosts (see
+    backend.http_pool), then run the SDK's request and response parsing once
+    (_prime_sdk), so the first analysis costs what every later one does.
+    """
+    start_warm_up(upstream_base_urls(), then=_prime_sdk)
+
+
+# Canned upstream replies for _prime_sdk.
+_PRIME_RESPONSE = {
+    "id": "resp_warmup", "object": "response", "created_at": 0, "model": "warm-up", "status": "completed",
+    "output": [{"id": "msg_warmup", "type": "message", "role": "assistant", "status": "completed",
+                "content": [{"type": "output_text", "text": "ok", "annotations": []}]}],
+    "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+}
+_PRIME_EVENTS = [
+    {"type": "response.created", "sequence_number": 0,
+     "response": dict(_PRIME_RESPONSE, status="in_progress", output=[])},
+    {"type": "response.output_item.added", "sequence_number": 1, "output_index": 0,
+     "item": dict(_PRIME_RESPONSE["output"][0], status="in_progress", content=[])},
+    {"type": "response.content_part.added", "sequence_number": 2, "output_index": 0, "content_index": 0,
+     "item_id": "msg_warmup", "part": {"type": "output_text", "text": "", "annotations": []}},
+    {"type": "response.output_text.delta", "sequence_number": 3, "output_index": 0, "content_index": 0,
+     "item_id": "msg_warmup", "delta": "ok"},
+    {"type": "response.completed", "sequence_number": 4, "response": _PRIME_RESPONSE},
+]
+_PRIME_CHAT = {"id": "chat_warmup", "object": "chat.completion", "created": 0, "model": "warm-up",
+               "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}]}
+_PRIME_CHUNK = {"id": "chat_warmup", "object": "chat.completion.chunk", "created": 0, "model": "warm-up",
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": "ok"}, "finish_reason": None}]}
+
+
+def _prime_reply(request):
+    import httpx
+    body = json.loads(request.content or b"{}")
+    if request.url.path.endswith("/responses"):
+        payload, events = _PRIME_RESPONSE, _PRIME_EVENTS
+    else:
+        payload, events = _PRIME_CHAT, [_PRIME_CHUNK, "[DONE]"]
+    if not body.get("stream"):
+        return httpx.Response(200, json=payload)
+    sse = "".join(f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n" for event in events)
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=sse)
+
+
+def _prime_sdk() -> None:
+    """
+    Make the calls analyses make, against canned replies on a local mock
+    transport (no network, no tokens). The SDK builds its pydantic response
+    models lazily on first use, which otherwise adds 100-300 ms to the first
+    real analysis. Best effort: any failure just leaves that cost in place.
+    """
+    try:
+        import httpx
+        from openai import OpenAI
+        client = OpenAI(api_key="warm-up", base_url="http://warm-up.invalid/v1", max_retries=0,
+                        http_client=httpx.Client(transport=httpx.MockTransport(_prime_reply)))
+        request = {"model": "warm-up", "temperature": 0.2}
+        if hasattr(client, "responses"):
+            request.update(instructions=SYSTEM_PROMPT, input="warm-up", max_output_tokens=MAX_OUTPUT_TOKENS)
+            _extract_output_text(client.responses.create(**request))
+            if hasattr(client.responses, "stream"):
+                with client.responses.stream(**request) as stream:
+                    for _ in _response_event_deltas(stream):
+                        pass
+            for _ in _response_event_deltas(client.responses.create(**request, stream=True)):
+                pass
         else:
-            _client = OpenAI(api_key=api_key, timeout=timeout_s)
-    return _client
+            request.update(messages=[{"role": "user", "content": "warm-up"}], max_tokens=MAX_OUTPUT_TOKENS)
+            client.chat.completions.create(**request)
+            for _ in _chat_chunk_deltas(client.chat.completions.create(**request, stream=True)):
+                pass
+    except Exception:
+        pass
+
+
+def _sdk_errors(*names: str) -> tuple:
+    """
+    openai exception classes by name, for isinstance checks. Empty until the SDK
+    has been imported: before that no SDK error can have been raised.
+    """
+    sdk = sys.modules.get("openai")
+    if sdk is None:
+        return ()
+    return tuple(getattr(sdk, name) for name in names if isinstance(getattr(sdk, name, None), type))
 
 
 def _is_quota_error(exc: Exception) -> bool:
-    """True if the error is a 429 / quota exceeded."""
-    if isinstance(exc, RateLimitError):
+    """
+    True if the error is a 429 / quota exceeded, or we are refusing upstream calls
+    ourselves (every backend's breaker open, or no admission slot).
+    """
+    if isinstance(exc, (CircuitOpenError, AdmissionRejected, *_sdk_errors("RateLimitError"))):
         return True
     msg = str(exc).lower()
     return "429" in msg or "quota" in msg or "rate limit" in msg or "too many requests" in msg
 
 
+def _is_timeout_error(exc: Exception) -> bool:
+    if isinstance(exc, _sdk_errors("APITimeoutError")):
+        return True
+    return "timed out" in str(exc).lower()
+
+
+def _count_upstream_error(exc: Exception) -> None:
+    metrics.inc('upstream_errors_total')
+    if _is_quota_error(exc):
+        metrics.inc('upstream_quota_errors_total')
+
+
+def _record_upstream_error(backend: Backend, exc: Exception) -> None:
+    """Count an upstream failure; quota errors and timeouts also feed backend's circuit breaker."""
+    _count_upstream_error(exc)
+    if _is_quota_error(exc) or _is_timeout_error(exc):
+        if backend.breaker.record_failure(retry_after_seconds(exc)):
+            metrics.inc('upstream_breaker_opens_total', backend=backend.name)
+
+
+def _is_retryable(exc: Exception | None) -> bool:
+    # A request shed by admission control is not retried: that would only add load to a full queue.
+    return exc is not None and not isinstance(exc, AdmissionRejected) and (_is_quota_error(exc) or _is_timeout_error(exc))
+
+
+def _schedule_retry(cache_key: str, user_message: str, exc: Exception, attempt: int = 0) -> None:
+    """
+    Re-run a failed analysis later on the retry scheduler (jittered backoff,
+    at least the upstream's Retry-After); the answer lands in the result cache.
+    """
+    if attempt >= RETRY_MAX_ATTEMPTS:
+        return
+    retry_after = exc.retry_after if isinstance(exc, (CircuitOpenError, AdmissionRejected)) else retry_after_seconds(exc)
+    if retry_scheduler.schedule(backoff_delay(attempt, retry_after),
+                                lambda: _retry_analysis(cache_key, user_message, attempt), key=cache_key):
+        metrics.inc('upstream_retries_total')
+
+
+def _retry_analysis(cache_key: str, user_message: str, attempt: int) -> None:
+    if analysis_cache.get(cache_key) is not None:
+        return
+    # Runs on the single scheduler thread: never wait in the admission queue, try again later instead.
+    ticket = admission.try_enter()
+    if ticket is None:
+        busy = admission.stats()
+        _schedule_retry(cache_key, user_message,
+                        AdmissionRejected('busy', max(1, busy['est_wait_seconds']), busy['queue_depth']), attempt + 1)
+        return
+    try:
+        text = _complete_with_failover(user_message)
+    except Exception as e:
+        if _is_retryable(e):
+            _schedule_retry(cache_key, user_message, e, attempt + 1)
+        return
+    finally:
+        ticket.close()
+    if text:
+        _store_analysis(cache_key, text)
+
+
 def _is_api_key_error(exc: Exception) -> bool:
     """True if the error is invalid/expired API key."""
-    if isinstance(exc, AuthenticationError):
+    if isinstance(exc, _sdk_errors("AuthenticationError")):
         return True
     msg = str(exc).lower()
     return (
@@ -102,38 +325,12 @@ def _is_api_key_error(exc: Exception) -> bool:
 
 def get_config_error() -> Optional[str]:
     """Return error message if API is not configured, else None. Fast pre-check before streaming."""
-    if not (os.getenv("OPENROUTER_API_KEY", "").strip() or os.getenv("OPENAI_API_KEY", "").strip()):
+    if not (os.getenv("OPENROUTER_API_KEY", "").strip() or os.getenv("OPENAI_API_KEY", "").strip()
+            or _replaying()):
         return "OPENAI_API_KEY (or OPENROUTER_API_KEY) is not set. Please set it in your .env file."
     return None
 
 
-def build_medical_context(profile: Optional[dict]) -> str:
-    """Build medical context string from user profile."""
-    if not profile:
-        return "No medical history provided."
-
-    context_parts = []
-    if profile.get('name'):
-        context_parts.append(f"Patient name: {profile['name']}")
-    if profile.get('age'):
-        context_parts.append(f"Age: {profile['age']} years")
-    if profile.get('gender'):
-        context_parts.append(f"Gender: {profile['gender']}")
-    if profile.get('height_cm') and profile.get('weight_kg'):
-        bmi = round(profile['weight_kg'] / ((profile['height_cm'] / 100) ** 2), 1)
-        context_parts.append(f"Height: {profile['height_cm']} cm, Weight: {profile['weight_kg']} kg (BMI: {bmi})")
-    if profile.get('existing_conditions'):
-        context_parts.append(f"Existing conditions: {profile['existing_conditions']}")
-    if profile.get('allergies'):
-        context_parts.append(f"Allergies: {profile['allergies']}")
-    if profile.get('smoking_habit'):
-        context_parts.append(f"Smoking: {profile['smoking_habit']}")
-    if profile.get('alcohol_habit'):
-        context_parts.append(f"Alcohol: {profile['alcohol_habit']}")
-
-    return "\n".join(context_parts) if context_parts else "No medical history provided."
-
-
 SYSTEM_PROMPT = """You are a health assistant for preliminary symptom analysis.
 
 RULES:
@@ -172,58 +369,380 @@ def _extract_output_text(resp) -> str:
     return "".join(out).strip()
 
 
-def analyze_symptoms(symptoms: str, profile: dict | None) -> str:
+def _build_user_message(symptoms: str, medical_context: str) -> str:
+    return f"Context:\n{medical_context}\n\nSymptoms: {symptoms}\n\nAnalyze briefly. If emergency signs, state warning first."
+
+
+def _backends_key() -> str:
     """
-    Analyze symptoms using OpenAI API and return structured response.
-    Optimized for fast response (1-4 seconds): short prompt, limited output.
+    The model part of a cache key: every configured backend, in order, since a hedge
+    or failover may answer from any of them. Changing UPSTREAM_BACKENDS starts a fresh cache.
+    """
+    return ",".join(backend.name for backend in _backends())
+
+
+def _analysis_cache_key(symptoms: str, medical_context: str) -> str:
+    return make_cache_key(symptoms, medical_context, _backends_key())
+
+
+# Misses waiting for their answer: cache key -> (symptoms, context key, pre-triage category).
+# _store_analysis moves an entry into the similarity index once its answer is cached, never before.
+_awaiting_answer = TTLCache(max(1, similar_cache.max_entries if similar_cache else 1), ANALYSIS_CACHE_TTL_SECONDS)
+
+
+def _triage_category(symptoms: str) -> str | None:
+    result = pre_triage(symptoms)
+    return result['category'] if result else None
+
+
+def _cached_analysis(cache_key: str, symptoms: str, medical_context: str, remember: bool = True) -> str | None:
+    """
+    Cached answer for this request: exact key first, then (SIMILAR_CACHE_SIZE > 0)
+    the answer of a near-duplicate symptom text under the same profile context and
+    with the same pre-triage result (see cache.SimilarityIndex, which also refuses
+    texts that differ in a red-flag word). On a miss with remember=True, the request
+    is indexed once its own answer is stored, so later near-duplicates can reuse it.
+    """
+    cached = analysis_cache.get(cache_key)
+    if cached is not None or similar_cache is None:
+        return cached
+    context_key = make_cache_key("", medical_context, _backends_key())
+    category = _triage_category(symptoms)
+    for key, key_category in similar_cache.lookup(symptoms, context_key):
+        if key != cache_key and key_category == category:
+            cached = analysis_cache.get(key)
+            if cached is not None:
+                return cached
+    if remember:
+        _awaiting_answer.set(cache_key, (symptoms, context_key, category))
+    return None
+
+
+def _store_analysis(cache_key: str, text: str) -> None:
+    """Cache a finished answer, and index its symptom text for near-duplicate lookups."""
+    analysis_cache.set(cache_key, text)
+    if similar_cache is None:
+        return
+    awaiting = _awaiting_answer.get(cache_key)
+    if awaiting is not None:
+        _awaiting_answer.invalidate(cache_key)
+        symptoms, context_key, category = awaiting
+        similar_cache.add(symptoms, context_key, (cache_key, category))
+
+
+def _cache_streamed(cache_key: str, parts: list[str]) -> None:
+    """Cache a stream that ran to completion (partial/cancelled streams never get here)."""
+    text = "".join(parts).strip()
+    if text:
+        _store_analysis(cache_key, text)
+
+
+def _replay_cached(text: str):
+    """Yield a cached response line by line so streaming clients see normal deltas."""
+    for line in text.splitlines(keepends=True):
+        yield line
+
+
+# ============ Single-flight coalescing ============
+
+class _Flight:
+    """One upstream generation shared by every concurrent request with the same key."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.deltas: list[str] = []
+        self.done = False
+        self.cancelled = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+        # Who answered, as analyze_symptoms reports it to callers: {'model': ...} or {'error': True}.
+        self.outcome: dict = {}
+        # Wakes the producer as soon as the last reader leaves, even mid-wait for a token.
+        self.cancellation = Cancellation()
+
+
+# In-flight generations by analysis key. Lock order: _flights_lock, then flight.cond.
+_flights: dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+_flight_stats = {'started': 0, 'coalesced': 0, 'cancelled': 0}
+
+
+def _run_flight(flight: _Flight, source) -> None:
+    """Producer thread: pull deltas from the upstream generator and fan them out."""
+    gen = source(flight.cancellation, flight.outcome)
+    try:
+        for delta in gen:
+            with flight.cond:
+                if flight.cancelled:
+                    break
+                flight.deltas.append(delta)
+                flight.cond.notify_all()
+    except Exception as e:
+        # _stream_upstream reports its own errors; this only guards unexpected failures.
+        with flight.cond:
+            flight.outcome['error'] = True
+            flight.deltas.append(f"Sorry, we encountered an error: {str(e)}. Please try again or consult a healthcare professional.")
+    finally:
+        # Closing the generator exits the SDK stream context and drops the HTTP connection.
+        gen.close()
+        with _flights_lock:
+            if _flights.get(flight.key) is flight:
+                del _flights[flight.key]
+        with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+
+
+def _attach_flight(key: str, source=None, on_join=None) -> _Flight | None:
+    """
+    Subscribe to the in-flight generation for key. If none is running, start one
+    from source(cancellation, outcome) (or return None when source is not given).
+    on_join() is called when joining one already running, before anything is waited on.
     """
+    with _flights_lock:
+        flight = _flights.get(key)
+        joined = flight is not None
+        if flight is None:
+            if source is None:
+                return None
+            flight = _Flight(key)
+            _flights[key] = flight
+            _flight_stats['started'] += 1
+            threading.Thread(target=_run_flight, args=(flight, source), daemon=True).start()
+        else:
+            _flight_stats['coalesced'] += 1
+        with flight.cond:
+            flight.subscribers += 1
+    if joined and on_join is not None:
+        on_join()
+    return flight
+
+
+def _wake_flight(flight: _Flight) -> None:
+    with flight.cond:
+        flight.cond.notify_all()
+
+
+def _subscribe(flight: _Flight, cancel: Cancellation | None = None):
+    """Yield every delta of flight from the beginning; detach on exit (or as soon as cancel fires)."""
+    index = 0
+    if cancel is not None:
+        cancel.on_cancel(lambda: _wake_flight(flight))
     try:
-        client = _get_client()
-    except ValueError as e:
-        return f"Configuration error: {str(e)}. Please set OPENROUTER_API_KEY (or OPENAI_API_KEY) in your .env file."
+        while True:
+            with flight.cond:
+                while index >= len(flight.deltas) and not flight.done and not (cancel and cancel.cancelled):
+                    flight.cond.wait()
+                pending = flight.deltas[index:]
+                finished = flight.done
+            if cancel is not None and cancel.cancelled:
+                return
+            if not pending and finished:
+                return
+            index += len(pending)
+            yield from pending
+    finally:
+        with _flights_lock:
+            with flight.cond:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned:
+                    # Last reader left: stop the upstream and let new requests start fresh.
+                    flight.cancelled = True
+                    _flight_stats['cancelled'] += 1
+                    if _flights.get(flight.key) is flight:
+                        del _flights[flight.key]
+        if abandoned:
+            flight.cancellation.cancel()
 
-    medical_context = build_medical_context(profile)
-    user_message = f"Context:\n{medical_context}\n\nSymptoms: {symptoms}\n\nAnalyze briefly. If emergency signs, state warning first."
 
-    last_error = None
-    for attempt in range(2):
-        try:
-            # Prefer the newer Responses API when available
-            if hasattr(client, "responses"):
-                resp = client.responses.create(
-                    model=OPENAI_MODEL,
-                    instructions=SYSTEM_PROMPT,
-                    input=user_message,
-                    extra_headers=_openrouter_extra_headers(),
-                    temperature=0.2,
-                    max_output_tokens=400,
-                )
-                return _extract_output_text(resp)
-
-            # Fallback: chat.completions
-            chat = client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_message},
-                ],
-                extra_headers=_openrouter_extra_headers(),
+def _single_flight(key: str, source, cancel: Cancellation | None = None, outcome: dict | None = None,
+                   on_join=None):
+    """
+    Stream deltas for key, sharing one upstream generation between identical
+    concurrent requests. outcome receives the generation's outcome at the end;
+    on_join() is called if this request joined a generation already running.
+    """
+    flight = _attach_flight(key, source, on_join)
+    yield from _subscribe(flight, cancel)
+    if outcome is not None:
+        outcome.update(flight.outcome)
+
+
+def single_flight_stats() -> dict:
+    """Counters for coalesced upstream generations."""
+    with _flights_lock:
+        return dict(_flight_stats, in_flight=len(_flights))
+
+
+def is_analysis_cached(symptoms: str, medical_context: str) -> bool:
+    """True when analyze_symptoms would answer from the result cache."""
+    cache_key = _analysis_cache_key(symptoms, medical_context)
+    return _cached_analysis(cache_key, symptoms, medical_context, remember=False) is not None
+
+
+def analyze_in_background(symptoms: str, profile: dict | None, medical_context: str | None = None,
+                          priority: bool = False) -> None:
+    """Run analyze_symptoms on a daemon thread; the answer lands in the result cache."""
+    threading.Thread(
+        target=analyze_symptoms, args=(symptoms, profile, medical_context), kwargs={'priority': priority},
+        name='analysis-background', daemon=True,
+    ).start()
+
+
+def _complete_once(client: "OpenAI", model: str, user_message: str) -> str:
+    """One non-streaming generation: Responses API when available, else chat.completions."""
+    # Prefer the newer Responses API when available
+    if hasattr(client, "responses"):
+        with metrics.span('upstream_latency_seconds', api="responses.create"):
+            resp = client.responses.create(
+                model=model,
+                instructions=SYSTEM_PROMPT,
+                input=user_message,
                 temperature=0.2,
-                max_tokens=400,
+                max_output_tokens=MAX_OUTPUT_TOKENS,
             )
-            return (chat.choices[0].message.content or "").strip()
+        return _extract_output_text(resp)
+
+    # Fallback: chat.completions
+    with metrics.span('upstream_latency_seconds', api="chat.completions.create"):
+        chat = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_message},
+            ],
+            temperature=0.2,
+            max_tokens=MAX_OUTPUT_TOKENS,
+        )
+    return chat.choices[0].message.content or ""
+
+
+class AnalysisError(Exception):
+    """A failed analysis; str() is the user-facing message. retryable is set for quota/rate-limit errors."""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _complete_with_failover(user_message: str, outcome: dict | None = None) -> str:
+    """
+    One non-streaming analysis, failing over through the backends whose breaker
+    admits a request. Raises the last error, or CircuitOpenError if none would.
+    outcome['model'] is set to the model that answered.
+    """
+    backends = _backends()
+    last_error = None
+    for position, backend in enumerate(backends):
+        if not backend.breaker.allow():
+            metrics.inc('upstream_breaker_rejections_total', backend=backend.name)
+            continue
+        if last_error is not None:
+            metrics.inc('upstream_failovers_total', backend=backend.name)
+        try:
+            text = trim_after_completion(_complete_once(_backend_client(backend), backend.model, user_message)).strip()
         except Exception as e:
             last_error = e
-            if _is_quota_error(e) and attempt == 0:
-                # Keep UI responsive; don't stall the user for long.
-                time.sleep(2)
-                continue
-            break
+            _record_upstream_error(backend, e)
+            continue
+        backend.breaker.record_success()
+        if outcome is not None:
+            outcome['model'] = backend.model
+        return text
+    if last_error is None:
+        raise CircuitOpenError(min(backend.breaker.retry_in() for backend in backends))
+    raise last_error
+
+
+def analyze_symptoms(symptoms: str, profile: dict | None, medical_context: str | None = None,
+                     raise_errors: bool = False, priority: bool = False, ticket: Ticket | None = None,
+                     outcome: dict | None = None) -> str:
+    """
+    Analyze symptoms using OpenAI API and return structured response.
+    Optimized for fast response (1-4 seconds): short prompt, limited output.
+    Successful responses are cached (see backend.cache) and served without an upstream call.
+    Failures are returned as a user-facing message, or raised as AnalysisError with raise_errors=True.
+    Quota errors and timeouts are retried later off this thread (see backend.circuit), never waited on here.
+    The upstream call waits for a process-wide slot (see backend.admission); priority (a possible
+    emergency) jumps the queue. ticket is a place already taken with admission.enter(), closed here.
+    outcome, when given, is filled in with who answered: {'model': the backend's model, or 'cache'},
+    or {'error': True} when the returned text is an error message. Neither key when unknown.
+    """
+    outcome = {} if outcome is None else outcome
+    try:
+        return _analyze(symptoms, profile, medical_context, raise_errors, priority, ticket, outcome)
+    finally:
+        if ticket is not None:
+            ticket.close()
+
+
+def _analyze(symptoms: str, profile: dict | None, medical_context: str | None, raise_errors: bool,
+             priority: bool, ticket: Ticket | None, outcome: dict) -> str:
+    if medical_context is None:
+        medical_context = build_medical_context(profile)
+    cache_key = _analysis_cache_key(symptoms, medical_context)
+    cached = _cached_analysis(cache_key, symptoms, medical_context)
+    if cached is not None:
+        outcome['model'] = 'cache'
+        return cached
+
+    # An identical streaming analysis is already running: wait for it instead of paying twice.
+    flight = _attach_flight(cache_key)
+    if flight is not None:
+        if ticket is not None:
+            ticket.close()  # the running generation holds its own slot; don't keep one while waiting on it
+        text = "".join(_subscribe(flight)).strip()
+        outcome.update(flight.outcome)
+        return text
+
+    try:
+        _get_client()
+    except ValueError as e:
+        outcome['error'] = True
+        message = f"Configuration error: {str(e)}. Please set OPENROUTER_API_KEY (or OPENAI_API_KEY) in your .env file."
+        if raise_errors:
+            raise AnalysisError(message) from e
+        return message
+
+    user_message = _build_user_message(symptoms, medical_context)
+    try:
+        with admission.slot(priority, ticket):
+            text = _complete_with_failover(user_message, outcome)
+    except Exception as e:
+        last_error = e
+    else:
+        if text:
+            _store_analysis(cache_key, text)
+        return text
+    outcome['error'] = True
+    if _is_retryable(last_error) and not raise_errors:
+        _schedule_retry(cache_key, user_message, last_error)
+    message = _analysis_error_message(last_error)
+    if raise_errors:
+        retryable = _is_retryable(last_error) or isinstance(last_error, AdmissionRejected)
+        raise AnalysisError(message, retryable=retryable) from last_error
+    return message
+
+
+def busy_message(retry_after: int) -> str:
+    """User-facing text for a request refused by admission control."""
+    return (
+        "**We’re handling a lot of requests right now.** "
+        f"Please try again in about {retry_after} seconds. "
+        "If your symptoms are severe or getting worse, don’t wait: contact a healthcare professional or emergency services."
+    )
+
+
+def _analysis_error_message(last_error: Exception | None) -> str:
+    """User-facing text for a failed non-streaming analysis."""
     if last_error and _is_api_key_error(last_error):
         return (
             "Your API key is invalid or expired. "
             "If using OpenRouter: create a new key at https://openrouter.ai/keys and set OPENROUTER_API_KEY in your .env file, then restart the app."
         )
+    if isinstance(last_error, AdmissionRejected):
+        return busy_message(last_error.retry_after)
     if last_error and _is_quota_error(last_error):
         return (
             "**We’re temporarily at capacity.** The AI service has hit its usage limit. "
@@ -233,93 +752,295 @@ def analyze_symptoms(symptoms: str, profile: dict | None) -> str:
     return f"Sorry, we encountered an error while analyzing your symptoms: {str(last_error)}. Please try again later or consult a healthcare professional."
 
 
-def analyze_symptoms_stream(symptoms: str, profile: dict | None):
+def analyze_symptoms_stream(symptoms: str, profile: dict | None, medical_context: str | None = None,
+                            cancel: Cancellation | None = None, priority: bool = False,
+                            ticket: Ticket | None = None, outcome: dict | None = None):
     """
     Stream symptom analysis for faster perceived response (first tokens in ~1-2s).
-    Yields text chunks.
+    Yields text chunks. A cached response is replayed line by line instead of calling upstream.
+    Cancelling cancel (from any thread) ends the stream at once, as closing it would.
+    priority (a possible emergency) puts the upstream call at the front of the admission queue;
+    ticket is a place already taken with admission.enter(), closed when no longer needed.
+    outcome is filled in as by analyze_symptoms, by the time the stream ends.
     """
+    outcome = {} if outcome is None else outcome
+    started = False
     try:
-        client = _get_client()
-    except ValueError as e:
-        yield f"Configuration error: {str(e)}. Please set OPENROUTER_API_KEY (or OPENAI_API_KEY) in your .env file."
+        if medical_context is None:
+            medical_context = build_medical_context(profile)
+        cache_key = _analysis_cache_key(symptoms, medical_context)
+        cached = _cached_analysis(cache_key, symptoms, medical_context)
+        if cached is not None:
+            outcome['model'] = 'cache'
+            yield from _replay_cached(cached)
+            return
+
+        try:
+            _get_client()
+        except ValueError as e:
+            outcome['error'] = True
+            yield f"Configuration error: {str(e)}. Please set OPENROUTER_API_KEY (or OPENAI_API_KEY) in your .env file."
+            return
+
+        user_message = _build_user_message(symptoms, medical_context)
+
+        def source(flight_cancel: Cancellation, flight_outcome: dict):
+            nonlocal started
+            started = True
+            return _stream_upstream(user_message, cache_key, flight_cancel, priority, ticket, flight_outcome)
+
+        yield from _single_flight(cache_key, source, cancel, outcome,
+                                  on_join=ticket.close if ticket is not None else None)
+    finally:
+        # The generation this call started owns the ticket; cache hits and coalesced streams never use it
+        # (a coalesced stream gives it back as soon as it joins, not when it ends).
+        if ticket is not None and not started:
+            ticket.close()
+
+
+def _response_event_deltas(events):
+    """Text deltas from Responses API stream events."""
+    for event in events:
+        if getattr(event, "type", "") == "response.output_text.delta":
+            delta = getattr(event, "delta", None)
+            if delta:
+                yield delta
+
+
+def _chat_chunk_deltas(chunks):
+    """Text deltas from chat.completions stream chunks."""
+    for chunk in chunks:
+        delta = getattr(chunk.choices[0].delta, "content", None)
+        if delta:
+            yield delta
+
+
+_early_stop_stats = {'streams': 0, 'early_stops': 0, 'est_tokens_saved': 0, 'est_ms_saved': 0.0}
+_early_stop_lock = threading.Lock()
+
+
+def _record_stream_end(stopped_early: bool, chars_emitted: int, elapsed_s: float) -> None:
+    """
+    Account for one finished upstream stream. For an early stop the saving is
+    estimated as the unused max_output_tokens budget (~4 chars per token),
+    timed at the per-token rate observed so far; it is an upper bound.
+    """
+    with _early_stop_lock:
+        _early_stop_stats['streams'] += 1
+        if not stopped_early:
+            return
+        tokens_emitted = max(1, chars_emitted // 4)
+        tokens_saved = max(0, MAX_OUTPUT_TOKENS - tokens_emitted)
+        _early_stop_stats['early_stops'] += 1
+        _early_stop_stats['est_tokens_saved'] += tokens_saved
+        _early_stop_stats['est_ms_saved'] += tokens_saved * (elapsed_s * 1000 / tokens_emitted)
+
+
+_cancel_stats = {'cancelled_streams': 0, 'est_tokens_avoided': 0}
+
+
+def _record_stream_cancelled(parts: list[str]) -> None:
+    """
+    Account for an upstream generation dropped because its reader went away.
+    Tokens avoided are estimated like early stops: the unused max_output_tokens
+    budget (~4 chars per token), an upper bound.
+    """
+    tokens_emitted = sum(map(len, parts)) // 4
+    with _early_stop_lock:
+        _cancel_stats['cancelled_streams'] += 1
+        _cancel_stats['est_tokens_avoided'] += max(0, MAX_OUTPUT_TOKENS - tokens_emitted)
+
+
+def cancellation_stats() -> dict:
+    """Counters for generations cancelled on client disconnect."""
+    with _early_stop_lock:
+        return dict(_cancel_stats)
+
+
+def early_stop_stats() -> dict:
+    """Early-termination counters, with per-stopped-request averages."""
+    with _early_stop_lock:
+        stats = dict(_early_stop_stats)
+    stops = stats['early_stops']
+    stats['avg_tokens_saved'] = round(stats['est_tokens_saved'] / stops, 1) if stops else 0.0
+    stats['avg_ms_saved'] = round(stats['est_ms_saved'] / stops, 1) if stops else 0.0
+    stats['est_ms_saved'] = round(stats['est_ms_saved'], 1)
+    return stats
+
+
+metrics.register_gauges('analysis_cache', analysis_cache.stats)
+if similar_cache is not None:
+    metrics.register_gauges('similar_cache', similar_cache.stats)
+metrics.register_gauges('single_flight', single_flight_stats)
+metrics.register_gauges('early_stop', early_stop_stats)
+metrics.register_gauges('client_disconnect', cancellation_stats)
+metrics.register_gauges('upstream_breaker', lambda: {
+    'open_backends': sum(backend.breaker.state != 'closed' for backend in _backends()),
+    'rejected': sum(backend.breaker.stats()['rejected'] for backend in _backends()),
+    'retries_pending': retry_scheduler.pending(),
+})
+metrics.describe('upstream_ttft_seconds', 'Time from upstream call to first text delta, by API path.')
+metrics.describe('upstream_latency_seconds', 'Upstream call duration (stream end or full response), by API path.')
+metrics.describe('upstream_retries_total', 'Analyses rescheduled off-thread after a quota/rate-limit error or timeout.')
+metrics.describe('upstream_breaker_rejections_total', 'Upstream attempts skipped because the backend circuit breaker was open.')
+metrics.describe('upstream_quota_errors_total', 'Upstream quota/rate-limit errors.')
+
+
+def _until_complete(deltas, api: str, started: float):
+    """
+    Forward deltas until all five sections are in and the last line has ended,
+    then stop pulling (the caller closes the upstream stream).
+    api names the upstream call for metrics; started is its time.monotonic() start.
+    """
+    detector = CompletionDetector()
+    emitted = 0
+    for delta in deltas:
+        if not emitted:
+            metrics.observe('upstream_ttft_seconds', time.monotonic() - started, api=api)
+        keep = detector.feed(delta)
+        if keep is not None:
+            delta = delta[:keep]
+        if delta:
+            emitted += len(delta)
+            yield delta
+        if detector.complete:
+            break
+    elapsed = time.monotonic() - started
+    metrics.observe('upstream_latency_seconds', elapsed, api=api)
+    metrics.inc('upstream_stream_chars_total', emitted, api=api)
+    _record_stream_end(detector.complete, emitted, elapsed)
+
+
+def _close_stream(stream) -> None:
+    """Close an SDK stream so the HTTP response (and generation) is dropped."""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+def _stream_upstream(user_message: str, cache_key: str, cancel: Cancellation | None = None,
+                     priority: bool = False, ticket: Ticket | None = None, outcome: dict | None = None):
+    """
+    Run one upstream streaming generation and yield its deltas. Waits for an
+    admission slot first (on ticket, if one was taken), then is hedged across the configured backends (see
+    upstream.hedged_stream); cached on completion. Cancelling cancel (every
+    reader gone) closes the upstream streams at once, or leaves the admission
+    queue; a cancelled generation is counted (see cancellation_stats) and not cached.
+    outcome is filled in as by analyze_symptoms.
+    """
+    outcome = {} if outcome is None else outcome
+    try:
+        ticket = ticket or admission.enter(priority)
+        if not ticket.wait(cancel):
+            return
+    except AdmissionRejected as e:
+        outcome['error'] = True
+        yield _stream_error_message(e)
         return
+    try:
+        yield from _stream_admitted(user_message, cache_key, cancel, outcome)
+    finally:
+        ticket.close()
 
-    medical_context = build_medical_context(profile)
-    user_message = f"Context:\n{medical_context}\n\nSymptoms: {symptoms}\n\nAnalyze briefly. If emergency signs, state warning first."
 
-    max_retries = 1
-    last_error = None
-    for attempt in range(max_retries):
-        try:
-            # Prefer Responses API streaming when available
-            if hasattr(client, "responses"):
-                # SDK supports semantic streaming events
-                if hasattr(client.responses, "stream"):
-                    with client.responses.stream(
-                        model=OPENAI_MODEL,
-                        instructions=SYSTEM_PROMPT,
-                        input=user_message,
-                        extra_headers=_openrouter_extra_headers(),
-                        temperature=0.2,
-                        max_output_tokens=400,
-                    ) as stream:
-                        for event in stream:
-                            if getattr(event, "type", "") == "response.output_text.delta":
-                                delta = getattr(event, "delta", None)
-                                if delta:
-                                    yield delta
-                        return
-
-                # Fallback: stream=True iterable
-                events = client.responses.create(
-                    model=OPENAI_MODEL,
-                    instructions=SYSTEM_PROMPT,
-                    input=user_message,
-                    temperature=0.2,
-                    max_output_tokens=400,
-                    extra_headers=_openrouter_extra_headers(),
-                    stream=True,
-                )
-                for event in events:
-                    if getattr(event, "type", "") == "response.output_text.delta":
-                        delta = getattr(event, "delta", None)
-                        if delta:
-                            yield delta
-                return
+def _answered_by(outcome: dict):
+    """on_win callback for upstream.hedged_stream: note the winning backend's model in outcome."""
+    return lambda backend: outcome.update(model=backend.model)
+
+
+def _stream_admitted(user_message: str, cache_key: str, cancel: Cancellation | None, outcome: dict):
+    parts: list[str] = []
+    try:
+        for delta in hedged_stream(_backends(), lambda backend, on_open: _backend_deltas(backend, user_message, on_open),
+                                   on_error=_record_upstream_error, cancel=cancel, on_win=_answered_by(outcome)):
+            parts.append(delta)
+            yield delta
+    except GeneratorExit:
+        _record_stream_cancelled(parts)
+        raise
+    except Exception as e:
+        if _is_retryable(e) and not parts:
+            _schedule_retry(cache_key, user_message, e)
+        outcome['error'] = True
+        yield _stream_error_message(e)
+        return
+    if cancel is not None and cancel.cancelled:
+        _record_stream_cancelled(parts)
+        return
+    _cache_streamed(cache_key, parts)
+
 
-            # Final fallback: chat.completions streaming
-            stream = client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_message},
-                ],
-                extra_headers=_openrouter_extra_headers(),
+def _backend_deltas(backend: Backend, user_message: str, on_open):
+    """
+    Stream one generation from backend (with API fallbacks), raising on failure.
+    on_open receives a callable that aborts the HTTP stream, for hedging cancellation.
+    """
+    client = _backend_client(backend)
+    # Prefer Responses API streaming when available
+    if hasattr(client, "responses"):
+        # SDK supports semantic streaming events
+        if hasattr(client.responses, "stream"):
+            started = time.monotonic()
+            with client.responses.stream(
+                model=backend.model,
+                instructions=SYSTEM_PROMPT,
+                input=user_message,
                 temperature=0.2,
-                max_tokens=400,
-                stream=True,
-            )
-            for chunk in stream:
-                delta = getattr(chunk.choices[0].delta, "content", None)
-                if delta:
-                    yield delta
+                max_output_tokens=MAX_OUTPUT_TOKENS,
+            ) as stream:
+                on_open(lambda: _close_stream(stream))
+                yield from _until_complete(_response_event_deltas(stream), "responses.stream", started)
             return
-        except Exception as e:
-            last_error = e
-            if _is_quota_error(e) and attempt < max_retries - 1:
-                time.sleep(2)
-                continue
-            break
+
+        # Fallback: stream=True iterable
+        started = time.monotonic()
+        events = client.responses.create(
+            model=backend.model,
+            instructions=SYSTEM_PROMPT,
+            input=user_message,
+            temperature=0.2,
+            max_output_tokens=MAX_OUTPUT_TOKENS,
+            stream=True,
+        )
+        on_open(lambda: _close_stream(events))
+        try:
+            yield from _until_complete(_response_event_deltas(events), "responses.create.stream", started)
+        finally:
+            _close_stream(events)
+        return
+
+    # Final fallback: chat.completions streaming
+    started = time.monotonic()
+    stream = client.chat.completions.create(
+        model=backend.model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_message},
+        ],
+        temperature=0.2,
+        max_tokens=MAX_OUTPUT_TOKENS,
+        stream=True,
+    )
+    on_open(lambda: _close_stream(stream))
+    try:
+        yield from _until_complete(_chat_chunk_deltas(stream), "chat.completions.stream", started)
+    finally:
+        _close_stream(stream)
+
+
+def _stream_error_message(last_error: Exception | None) -> str:
+    """User-facing text for a failed streaming analysis."""
     if last_error and _is_api_key_error(last_error):
-        yield (
+        return (
             "Your API key is invalid or expired. "
             "If using OpenRouter: create a new key at https://openrouter.ai/keys and set OPENROUTER_API_KEY in your .env file, then restart the app."
         )
-    elif last_error and _is_quota_error(last_error):
-        yield (
+    if isinstance(last_error, AdmissionRejected):
+        return busy_message(last_error.retry_after)
+    if last_error and _is_quota_error(last_error):
+        return (
             "**We’re temporarily at capacity.** The AI service has hit its usage limit. "
             "In the meantime: rest, stay hydrated, and see a doctor if symptoms persist or worsen. "
             "Please try again in a few minutes, or check your API usage limits in your OpenAI dashboard."
         )
-    else:
-        yield f"Sorry, we encountered an error: {str(last_error)}. Please try again or consult a healthcare professional."
+    return f"Sorry, we encountered an error: {str(last_error)}. Please try again or consult a healthcare professional."
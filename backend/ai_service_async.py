@@ -0,0 +1,221 @@
+"""Async (AsyncOpenAI) symptom analysis engine used by the ASGI entry point."""
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+from backend.ai_service import (
+    MAX_OUTPUT_TOKENS, SYSTEM_PROMPT,
+    _analysis_cache_key, _answered_by, _backends, _build_user_message, _cache_streamed, _cached_analysis,
+    _client_kwargs,
+    _is_retryable, _record_stream_cancelled, _record_stream_end, _record_upstream_error,
+    _replay_cached, _schedule_retry, _stream_error_message, build_medical_context,
+)
+from backend import metrics
+from backend.admission import AdmissionRejected, Ticket, admission
+from backend.http_pool import close_async_http_client, get_async_http_client
+from backend.sections import CompletionDetector
+from backend.upstream import Backend, hedged_stream_async
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# One client per backend (AsyncOpenAI is safe to share across tasks)
+_async_clients: dict[str, "AsyncOpenAI"] = {}
+
+
+def _get_async_client(backend: Backend | None = None) -> "AsyncOpenAI":
+    """Get or create the AsyncOpenAI client for backend (default: the primary one)."""
+    backend = backend or _backends()[0]
+    client = _async_clients.get(backend.name)
+    if client is None:
+        with metrics.span('upstream_client_create_seconds'):
+            from openai import AsyncOpenAI
+            client = _async_clients[backend.name] = AsyncOpenAI(**_client_kwargs(backend),
+                                                                http_client=get_async_http_client())
+    return client
+
+
+async def close_async_client() -> None:
+    """Drop the clients and close their shared connection pool (ASGI lifespan shutdown)."""
+    _async_clients.clear()
+    await close_async_http_client()
+
+
+async def _response_event_deltas(events):
+    """Text deltas from Responses API stream events."""
+    async for event in events:
+        if getattr(event, "type", "") == "response.output_text.delta":
+            delta = getattr(event, "delta", None)
+            if delta:
+                yield delta
+
+
+async def _chat_chunk_deltas(chunks):
+    """Text deltas from chat.completions stream chunks."""
+    async for chunk in chunks:
+        delta = getattr(chunk.choices[0].delta, "content", None)
+        if delta:
+            yield delta
+
+
+async def _until_complete(deltas, api: str, started: float):
+    """Async twin of ai_service._until_complete: stop once all five sections are in."""
+    detector = CompletionDetector()
+    emitted = 0
+    try:
+        async for delta in deltas:
+            if not emitted:
+                metrics.observe('upstream_ttft_seconds', time.monotonic() - started, api=api)
+            keep = detector.feed(delta)
+            if keep is not None:
+                delta = delta[:keep]
+            if delta:
+                emitted += len(delta)
+                yield delta
+            if detector.complete:
+                break
+    finally:
+        await deltas.aclose()
+    elapsed = time.monotonic() - started
+    metrics.observe('upstream_latency_seconds', elapsed, api=api)
+    metrics.inc('upstream_stream_chars_total', emitted, api=api)
+    _record_stream_end(detector.complete, emitted, elapsed)
+
+
+async def _close_stream(stream) -> None:
+    """Close an SDK async stream so the HTTP response (and generation) is dropped."""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        await close()
+
+
+async def analyze_symptoms_async(symptoms: str, profile: dict | None, medical_context: str | None = None) -> str:
+    """Async counterpart of ai_service.analyze_symptoms: full text, served from cache when possible."""
+    parts = []
+    async for delta in analyze_symptoms_stream_async(symptoms, profile, medical_context):
+        parts.append(delta)
+    return "".join(parts).strip()
+
+
+async def analyze_symptoms_stream_async(symptoms: str, profile: dict | None, medical_context: str | None = None,
+                                        priority: bool = False, ticket: Ticket | None = None,
+                                        outcome: dict | None = None):
+    """
+    Async counterpart of ai_service.analyze_symptoms_stream. Yields text chunks
+    without holding a thread while waiting on the upstream (or for an admission slot).
+    outcome is filled in as by ai_service.analyze_symptoms.
+    """
+    outcome = {} if outcome is None else outcome
+    stream = None
+    try:
+        if medical_context is None:
+            medical_context = build_medical_context(profile)
+        cache_key = _analysis_cache_key(symptoms, medical_context)
+        # The SQLite cache tier and the similarity index block; keep them off the event loop.
+        cached = await asyncio.to_thread(_cached_analysis, cache_key, symptoms, medical_context)
+        if cached is not None:
+            outcome['model'] = 'cache'
+            for line in _replay_cached(cached):
+                yield line
+            return
+
+        try:
+            _get_async_client()
+        except ValueError as e:
+            outcome['error'] = True
+            yield f"Configuration error: {str(e)}. Please set OPENROUTER_API_KEY (or OPENAI_API_KEY) in your .env file."
+            return
+
+        user_message = _build_user_message(symptoms, medical_context)
+        try:
+            ticket = ticket or admission.enter(priority)
+            if not await ticket.wait_async():
+                return
+        except AdmissionRejected as e:
+            outcome['error'] = True
+            yield _stream_error_message(e)
+            return
+        stream = _stream_admitted(cache_key, user_message, outcome)
+        async for delta in stream:
+            yield delta
+    finally:
+        if stream is not None:
+            # async for does not close the inner generator; do it now so the upstream attempts stop with us.
+            await stream.aclose()
+        if ticket is not None:
+            ticket.close()
+
+
+async def _stream_admitted(cache_key: str, user_message: str, outcome: dict):
+    parts: list[str] = []
+    try:
+        async for delta in hedged_stream_async(_backends(), lambda backend: _backend_deltas(backend, user_message),
+                                               on_error=_record_upstream_error, on_win=_answered_by(outcome)):
+            parts.append(delta)
+            yield delta
+    except (GeneratorExit, asyncio.CancelledError):
+        # Closed or cancelled by the ASGI handler (client gone): the attempts are already cancelled.
+        _record_stream_cancelled(parts)
+        raise
+    except Exception as e:
+        if _is_retryable(e) and not parts:
+            _schedule_retry(cache_key, user_message, e)
+        outcome['error'] = True
+        yield _stream_error_message(e)
+        return
+    _cache_streamed(cache_key, parts)
+
+
+async def _backend_deltas(backend: Backend, user_message: str):
+    """Async twin of ai_service._backend_deltas: one generation from backend, raising on failure."""
+    client = _get_async_client(backend)
+    # Prefer Responses API streaming when available
+    if hasattr(client, "responses"):
+        # SDK supports semantic streaming events
+        if hasattr(client.responses, "stream"):
+            started = time.monotonic()
+            async with client.responses.stream(
+                model=backend.model,
+                instructions=SYSTEM_PROMPT,
+                input=user_message,
+                temperature=0.2,
+                max_output_tokens=MAX_OUTPUT_TOKENS,
+            ) as stream:
+                async for delta in _until_complete(_response_event_deltas(stream), "responses.stream", started):
+                    yield delta
+            return
+
+        # Fallback: stream=True async iterable
+        started = time.monotonic()
+        events = await client.responses.create(
+            model=backend.model,
+            instructions=SYSTEM_PROMPT,
+            input=user_message,
+            temperature=0.2,
+            max_output_tokens=MAX_OUTPUT_TOKENS,
+            stream=True,
+        )
+        try:
+            async for delta in _until_complete(_response_event_deltas(events), "responses.create.stream", started):
+                yield delta
+        finally:
+            await _close_stream(events)
+        return
+
+    # Final fallback: chat.completions streaming
+    started = time.monotonic()
+    stream = await client.chat.completions.create(
+        model=backend.model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_message},
+        ],
+        temperature=0.2,
+        max_tokens=MAX_OUTPUT_TOKENS,
+        stream=True,
+    )
+    try:
+        async for delta in _until_complete(_chat_chunk_deltas(stream), "chat.completions.stream", started):
+            yield delta
+    finally:
+        await _close_stream(stream)
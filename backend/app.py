@@ -1,24 +1,33 @@
 """Flask application entry point."""
 import os
 from flask import Flask
-from dotenv import load_dotenv
-from backend.database import init_db
+from backend.database import ensure_schema
+from backend.http_pool import UPSTREAM_WARMUP
+
+# Lazy mode defers schema setup to the first request (default on Vercel, where
+# every cold start pays for work done at import time).
+LAZY_INIT = os.getenv("LAZY_INIT", "1" if os.getenv("VERCEL") else "").strip().lower() in {"1", "true", "yes", "on"}
 
 
 def create_app():
-    """Application factory."""
+    """Application factory. .env is loaded by the backend package on import."""
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    # Load .env from project root regardless of current working directory
-    load_dotenv(dotenv_path=os.path.join(base_dir, ".env"), override=False)
     app = Flask(__name__,
                 template_folder=os.path.join(base_dir, 'templates'),
                 static_folder=os.path.join(base_dir, 'static'))
     app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 
-    # Initialize database
-    with app.app_context():
-        init_db()
+    # The cassette module checks its settings on import; do it now, so a bad
+    # UPSTREAM_CASSETTE_MODE stops the app here instead of failing every analysis
+    if os.getenv("UPSTREAM_CASSETTE", "").strip():
+        import backend.cassette  # noqa: F401
+
+    # Initialize database (once per process; skipped entirely when the schema is current)
+    if LAZY_INIT:
+        app.before_request(ensure_schema)
+    else:
+        ensure_schema()
 
     # Register blueprints
     from backend.routes import auth_bp, main_bp, api_bp
@@ -26,6 +35,11 @@ def create_app():
     app.register_blueprint(main_bp)
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    # Open upstream connections now, off-thread, so the first analysis doesn't pay for DNS/TLS setup
+    if UPSTREAM_WARMUP:
+        from backend.ai_service import warm_up_upstream
+        warm_up_upstream()
+
     return app
 
 
@@ -0,0 +1,279 @@
+"""
+ASGI entry point.
+
+POST /api/analyze/stream (and GET /api/analyze/stream/<job_id> to resume it)
+is served natively on the event loop by the async engine
+(backend.ai_service_async), so a slow generation costs a coroutine instead
+of a worker thread. Every other path is handed to the Flask app.
+
+Run with:  uvicorn backend.asgi:app --workers 2
+"""
+import asyncio
+import json
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+from backend import metrics
+from backend.admission import AdmissionRejected, Ticket, admission
+from backend.app import app as flask_app
+from backend.ai_service import busy_message, get_config_error, is_analysis_cached, upstream_base_urls
+from backend.ai_service_async import analyze_symptoms_stream_async, close_async_client
+from backend.database import get_profile_with_context
+from backend.history import record_stream
+from backend.http_pool import UPSTREAM_WARMUP, keep_warm_async
+from backend.jobs import AnalysisJob, JobLimitReached, create_job, get_job, parse_last_event_id, sse_events_async
+from backend.rate_limit import check_rate_limit
+from backend.streaming import AnalysisStream, paced_async, requested_format
+from backend.triage import pre_triage
+
+_wsgi_app = WsgiToAsgi(flask_app)
+
+STREAM_PATH = '/api/analyze/stream'
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+# Running producer tasks (the event loop only keeps weak references).
+_producers: set = set()
+
+
+def _load_session(scope) -> dict:
+    """Decode the Flask session cookie from the request headers (same signing as Flask)."""
+    raw_cookie = ''
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            raw_cookie = value.decode('latin-1')
+            break
+    morsel = SimpleCookie(raw_cookie).get(flask_app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return {}
+    try:
+        max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        return serializer.loads(morsel.value, max_age=max_age)
+    except Exception:
+        return {}
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return body
+
+
+async def _wait_for_disconnect(receive) -> None:
+    """Return once the client has gone away (the request body has already been read)."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_json(send, status: int, payload: dict, headers: list | None = None) -> None:
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                   + (headers or []),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def analyze_stream(scope, receive, send) -> None:
+    """Async twin of routes.analyze_stream: same checks, same SSE event format."""
+    session = _load_session(scope)
+    if 'user_id' not in session:
+        await send({'type': 'http.response.start', 'status': 302, 'headers': [(b'location', b'/auth/login')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    try:
+        data = json.loads(await _read_body(receive) or b'{}')
+    except ValueError:
+        data = {}
+    symptoms = (data.get('symptoms', '') if isinstance(data, dict) else '').strip()
+    if not symptoms:
+        await _send_json(send, 400, {'error': 'Please describe your symptoms.'})
+        return
+
+    triage = pre_triage(symptoms)
+
+    user_id = session['user_id']
+    # RATE_LIMIT_BACKEND=sqlite takes a write transaction; keep it off the event loop.
+    allowed, retry_after = await asyncio.to_thread(check_rate_limit, str(user_id))
+    if not allowed and triage is None:
+        await _send_json(send, 429, {
+            'error': f'Too many requests. Please wait {retry_after} seconds and try again.'
+        }, [(b'retry-after', str(retry_after).encode())])
+        return
+
+    config_err = get_config_error()
+    if config_err and triage is None:
+        await _send_json(send, 503, {'error': config_err})
+        return
+
+    # SQLite is blocking; keep it off the event loop.
+    profile_dict, medical_context = await asyncio.to_thread(get_profile_with_context, user_id)
+
+    can_analyze = allowed and not config_err
+    ticket = None
+    if can_analyze and not (admission.queue_full()
+                            and await asyncio.to_thread(is_analysis_cached, symptoms, medical_context)):
+        try:
+            ticket = admission.enter(triage is not None)
+        except AdmissionRejected as e:
+            await _send_json(send, 503, {
+                'error': busy_message(e.retry_after),
+                'retry_after': e.retry_after,
+                'queue_depth': e.queue_depth,
+            }, [(b'retry-after', str(e.retry_after).encode())])
+            return
+
+    try:
+        job = create_job(user_id, priority=triage is not None)
+    except JobLimitReached as e:
+        if ticket is not None:
+            ticket.close()
+        await _send_json(send, 503, {
+            'error': busy_message(e.retry_after),
+            'retry_after': e.retry_after,
+        }, [(b'retry-after', str(e.retry_after).encode())])
+        return
+    encoder = AnalysisStream(requested_format(data))
+    producer = asyncio.ensure_future(_produce(job, encoder, triage, can_analyze, symptoms, profile_dict,
+                                              medical_context, ticket))
+    _producers.add(producer)
+    producer.add_done_callback(_producers.discard)
+    loop = asyncio.get_running_loop()
+    job.cancellation.on_cancel(lambda: loop.call_soon_threadsafe(producer.cancel))
+    await _send_job(job, 0, receive, send)
+
+
+async def _produce(job: AnalysisJob, encoder: AnalysisStream, triage: dict | None, can_analyze: bool,
+                   symptoms: str, profile_dict: dict | None, medical_context: str, ticket: Ticket | None) -> None:
+    """Run the analysis into job; a task of its own so it outlives a dropped connection."""
+    stream = chunks = None
+    parts = []
+    outcome = {}
+    try:
+        if triage is not None:
+            metrics.inc('pre_triage_hits_total', category=triage['category'])
+            job.publish(encoder.triage(triage, analysis_pending=can_analyze))
+            if not can_analyze:
+                return
+        stream = analyze_symptoms_stream_async(symptoms, profile_dict, medical_context,
+                                               priority=triage is not None, ticket=ticket, outcome=outcome)
+        chunks = paced_async(stream, encoder)
+        async for chunk in chunks:
+            if chunk is None:
+                frames = encoder.encode_due()
+            else:
+                parts.append(chunk)
+                frames = encoder.encode(chunk)
+            if frames:
+                job.publish(frames)
+    finally:
+        if stream is not None:
+            if chunks is not None:
+                await chunks.aclose()
+            # Closing the generator cancels the upstream attempts and exits the SDK stream context.
+            await stream.aclose()
+        elif ticket is not None:
+            ticket.close()
+        if not job.cancellation.cancelled:
+            job.publish(encoder.finish())
+        job.finish()
+        if not job.cancellation.cancelled:
+            record_stream(job.user_id, symptoms, medical_context, triage, ''.join(parts),
+                          time.monotonic() - job.created, outcome)
+
+
+async def resume_stream(scope, receive, send) -> None:
+    """Async twin of routes.resume_analyze_stream."""
+    session = _load_session(scope)
+    job = get_job(scope['path'][len(STREAM_PATH) + 1:], session.get('user_id')) if 'user_id' in session else None
+    if job is None:
+        await _send_json(send, 404, {'error': 'This analysis has expired. Please send your symptoms again.'})
+        return
+    last_event_id = dict(scope.get('headers') or []).get(b'last-event-id')
+    if last_event_id is None:
+        last_event_id = (parse_qs(scope.get('query_string', b'').decode()).get('last_event_id') or [None])[0]
+    else:
+        last_event_id = last_event_id.decode('latin-1')
+    after = parse_last_event_id(last_event_id)
+    if after is None or not job.can_resume(after):
+        await _send_json(send, 410, {'error': 'This analysis can no longer be resumed. Please send your symptoms again.'})
+        return
+    metrics.inc('analysis_job_resumes_total')
+    await _send_job(job, after, receive, send)
+
+
+async def _send_job(job: AnalysisJob, after_seq: int, receive, send) -> None:
+    """Stream job's SSE events after after_seq to this connection."""
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': SSE_HEADERS + [(b'x-analysis-job', job.id.encode())]})
+    events = sse_events_async(job, after_seq)
+
+    async def pump() -> None:
+        async for frame in events:
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    # Servers may drop sends after a disconnect without raising, so watch for
+    # http.disconnect too and stop reading the moment it arrives (the job keeps running).
+    streaming = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({streaming, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if not streaming.done():
+            metrics.inc('sse_client_disconnects_total')
+            streaming.cancel()
+        try:
+            await streaming
+        except asyncio.CancelledError:
+            pass
+    finally:
+        watcher.cancel()
+        await events.aclose()
+
+
+async def _lifespan(receive, send) -> None:
+    warmer = None
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if UPSTREAM_WARMUP:
+                # The native stream endpoint uses the async pool; warm it like create_app warms the sync one.
+                warmer = asyncio.ensure_future(keep_warm_async(upstream_base_urls()))
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if warmer is not None:
+                warmer.cancel()
+            await close_async_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application callable."""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['path'] == STREAM_PATH and scope['method'] == 'POST':
+        await analyze_stream(scope, receive, send)
+        return
+    if scope['type'] == 'http' and scope['path'].startswith(STREAM_PATH + '/') and scope['method'] == 'GET':
+        await resume_stream(scope, receive, send)
+        return
+    await _wsgi_app(scope, receive, send)
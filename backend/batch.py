@@ -0,0 +1,140 @@
+"""Batch symptom analysis for /api/analyze/batch (bounded fan-out, results in completion order)."""
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from backend.ai_service import AnalysisError, analyze_symptoms, is_analysis_cached
+from backend.emergency import is_emergency_text
+from backend.medical_context import build_medical_context
+from backend.rate_limit import create_limiter
+from backend.sections import parse_sections
+
+# Upstream calls in flight per batch request.
+BATCH_CONCURRENCY = max(1, int(os.getenv("BATCH_CONCURRENCY", "4")))
+# Largest accepted batch.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+# How long one item may wait for a rate-limit slot before it is reported as rate limited.
+BATCH_MAX_WAIT_SECONDS = float(os.getenv("BATCH_MAX_WAIT_SECONDS", "120"))
+# Uncached batch items per user per minute; a budget of its own, so a batch never uses up
+# the user's interactive RATE_LIMIT_PER_MINUTE.
+BATCH_RATE_LIMIT_PER_MINUTE = int(os.getenv("BATCH_RATE_LIMIT_PER_MINUTE", "60"))
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def _batch_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = create_limiter(BATCH_RATE_LIMIT_PER_MINUTE)
+    return _limiter
+
+
+def validate_items(items) -> str | None:
+    """Error message for a malformed batch, or None. Individual items are checked while running."""
+    if not isinstance(items, list) or not items:
+        return 'Send {"items": [{"symptoms": "...", "profile": {...}}, ...]}.'
+    if len(items) > BATCH_MAX_ITEMS:
+        return f'Too many items: at most {BATCH_MAX_ITEMS} per batch.'
+    return None
+
+
+def _wait_for_slot(identifier: str, stop: threading.Event) -> tuple[bool, int | None]:
+    """Take a batch rate-limit slot for identifier, sleeping while the limiter refuses (bounded)."""
+    deadline = time.monotonic() + BATCH_MAX_WAIT_SECONDS
+    while True:
+        allowed, retry_after = _batch_limiter().check(f'batch:{identifier}')
+        if allowed:
+            return True, None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or stop.wait(min(retry_after or 1, remaining)):
+            return False, retry_after
+
+
+def _run_item(index: int, item, default_profile: dict | None, default_context: str,
+              rate_limit_key: str, stop: threading.Event) -> dict:
+    """One item's result line; every failure, malformed input included, is reported for that item only."""
+    try:
+        return _analyze_item(index, item, default_profile, default_context, rate_limit_key, stop)
+    except Exception as e:
+        return _failed(index, e)
+
+
+def _failed(index: int, exc: Exception) -> dict:
+    return {'index': index, 'ok': False, 'error': f'Analysis failed: {exc}', 'retryable': False}
+
+
+def _analyze_item(index: int, item, default_profile: dict | None, default_context: str,
+                  rate_limit_key: str, stop: threading.Event) -> dict:
+    if not isinstance(item, dict):
+        return {'index': index, 'ok': False, 'error': 'Item must be an object.'}
+    symptoms = item.get('symptoms')
+    symptoms = symptoms.strip() if isinstance(symptoms, str) else ''
+    if not symptoms:
+        return {'index': index, 'ok': False, 'error': 'Please describe your symptoms.'}
+    profile = item.get('profile')
+    if profile is None:
+        profile, medical_context = default_profile, default_context
+    elif isinstance(profile, dict):
+        try:
+            medical_context = build_medical_context(profile)
+        except (TypeError, ValueError, ArithmeticError):
+            # e.g. height_cm/weight_kg sent as strings
+            return {'index': index, 'ok': False, 'error': 'profile has invalid values.'}
+    else:
+        return {'index': index, 'ok': False, 'error': 'profile must be an object.'}
+
+    # Cached answers cost no upstream call, so they don't spend a rate-limit slot.
+    if not is_analysis_cached(symptoms, medical_context):
+        allowed, retry_after = _wait_for_slot(rate_limit_key, stop)
+        if not allowed:
+            return {'index': index, 'ok': False, 'error': 'Rate limited.', 'retryable': True,
+                    'retry_after': retry_after}
+    try:
+        response_text = analyze_symptoms(symptoms, profile, medical_context, raise_errors=True)
+    except AnalysisError as e:
+        return {'index': index, 'ok': False, 'error': str(e), 'retryable': e.retryable}
+    return {
+        'index': index,
+        'ok': True,
+        'response': response_text,
+        'sections': parse_sections(response_text),
+        'is_emergency': is_emergency_text(response_text),
+    }
+
+
+def run_batch(items: list, default_profile: dict | None, default_context: str, rate_limit_key: str,
+              concurrency: int = BATCH_CONCURRENCY):
+    """
+    Analyze items on a bounded thread pool, yielding one result dict per item
+    as it finishes, then {"done": true, ...}. Items without a "profile" use
+    default_profile/default_context. Every upstream call takes a slot from
+    the caller's batch rate limit (BATCH_RATE_LIMIT_PER_MINUTE). Closing the generator (client gone) cancels the
+    items that have not started.
+    """
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(items))),
+                                  thread_name_prefix='analyze-batch')
+    failed = 0
+    try:
+        indexes = {
+            executor.submit(_run_item, index, item, default_profile, default_context, rate_limit_key, stop): index
+            for index, item in enumerate(items)
+        }
+        pending = set(indexes)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:  # _run_item reports its own failures; this only guards the unexpected
+                    result = _failed(indexes[future], e)
+                failed += not result['ok']
+                yield result
+        yield {'done': True, 'count': len(items), 'failed': failed}
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
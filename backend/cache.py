@@ -0,0 +1,437 @@
+"""
+In-process caches: analysis results (LRU + optional SQLite tier), a
+near-duplicate index over symptom texts, and a generic TTL LRU.
+"""
+import hashlib
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Defaults: 512 entries for 10 minutes. Override in .env.
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "512"))
+ANALYSIS_CACHE_TTL_SECONDS = float(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", "600"))
+# Set ANALYSIS_CACHE_SQLITE=1 to keep results across restarts / share between workers.
+ANALYSIS_CACHE_SQLITE = os.getenv("ANALYSIS_CACHE_SQLITE", "").strip().lower() in {"1", "true", "yes", "on"}
+# Near-duplicate lookups (opt in): entries in the similarity index (0 disables it) and the
+# Jaccard similarity of the symptom word sets required to reuse an answer.
+SIMILAR_CACHE_SIZE = int(os.getenv("SIMILAR_CACHE_SIZE", "0"))
+SIMILAR_CACHE_THRESHOLD = float(os.getenv("SIMILAR_CACHE_THRESHOLD", "0.8"))
+
+
+def normalize_symptoms(symptoms: str) -> str:
+    """Lowercase and collapse whitespace so trivial retyping still hits the cache."""
+    return " ".join((symptoms or "").lower().split())
+
+
+def make_cache_key(symptoms: str, medical_context: str, model: str) -> str:
+    """Cache key from normalized symptoms, a hash of the profile context and the model id."""
+    context_hash = hashlib.sha256((medical_context or "").encode("utf-8")).hexdigest()
+    raw = "\x1f".join((model or "", context_hash, normalize_symptoms(symptoms)))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _default_sqlite_path() -> str:
+    instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance')
+    os.makedirs(instance_path, exist_ok=True)
+    return os.path.join(instance_path, 'analysis_cache.db')
+
+
+class ResultCache:
+    """
+    Bounded LRU with per-entry TTL, optionally backed by a SQLite table.
+
+    The in-process tier is checked first; a second-tier hit is promoted back
+    into memory. Both tiers honour the same TTL.
+    """
+
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_SIZE, ttl_seconds: float = ANALYSIS_CACHE_TTL_SECONDS,
+                 sqlite_path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.sqlite_path = sqlite_path
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._sqlite_ready = False
+        self.hits = 0
+        self.sqlite_hits = 0
+        self.misses = 0
+
+    # ---- SQLite tier ----
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.sqlite_path, timeout=5)
+        if not self._sqlite_ready:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS analysis_cache ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.commit()
+            self._sqlite_ready = True
+        return conn
+
+    def _sqlite_get(self, key: str) -> Optional[tuple[float, str]]:
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    'SELECT created_at, response FROM analysis_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row and time.time() - row[0] > self.ttl_seconds:
+                    conn.execute('DELETE FROM analysis_cache WHERE key = ?', (key,))
+                    conn.commit()
+                    return None
+                return (row[0], row[1]) if row else None
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # The second tier is best-effort; never fail an analysis because of it.
+            return None
+
+    def _sqlite_set(self, key: str, created_at: float, response: str) -> None:
+        try:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO analysis_cache (key, response, created_at) VALUES (?, ?, ?)',
+                    (key, response, created_at)
+                )
+                conn.execute('DELETE FROM analysis_cache WHERE created_at < ?', (time.time() - self.ttl_seconds,))
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            pass
+
+    # ---- public API ----
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached response or None. Counts hits/misses."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        if self.sqlite_path:
+            stored = self._sqlite_get(key)
+            if stored is not None:
+                with self._lock:
+                    self._store(key, stored)
+                    self.sqlite_hits += 1
+                return stored[1]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, response: str) -> None:
+        """Cache a successful response in every configured tier."""
+        created_at = time.time()
+        with self._lock:
+            self._store(key, (created_at, response))
+        if self.sqlite_path:
+            self._sqlite_set(key, created_at, response)
+
+    def _store(self, key: str, entry: tuple[float, str]) -> None:
+        """Insert into the LRU (caller holds the lock)."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop the in-process tier and reset counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.sqlite_hits = self.misses = 0
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.sqlite_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'sqlite_hits': self.sqlite_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.sqlite_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+# Words that carry no clinical meaning.
+_STOPWORDS = frozenset(
+    "a an and or the i i'm im me my mine we our you your he she it its they them this that these those "
+    "am is are was were be been being have has had having do does did of to in on at for with from by "
+    "as so but very really just some also feel feeling got get getting any".split()
+)
+# Negations fold into the next word ("no fever" -> "not:fever"), so they can't match "fever".
+_NEGATIONS = frozenset(
+    "no not never without none denies deny denied don't doesn't didn't haven't hasn't isn't aren't wasn't".split()
+)
+
+
+def symptom_shingles(symptoms: str) -> frozenset:
+    """Order-insensitive word set used for near-duplicate matching ("fever + headache" == "headache and fever")."""
+    words = set()
+    negated = False
+    for word in _WORD_RE.findall((symptoms or "").lower()):
+        if word in _NEGATIONS:
+            negated = True
+            continue
+        if word in _STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]  # crude plural folding: "headaches" -> "headache"
+        if negated:
+            word, negated = "not:" + word, False
+        words.add(sys.intern(word))
+    return frozenset(words)
+
+
+# Words that can turn a routine complaint into an urgent one ("... with blood", "..., now confused").
+# Texts that differ in any of them (negated or not) are never near-duplicates, however similar otherwise.
+RED_FLAG_WORDS = symptom_shingles(
+    "blood bloody bleeding bleed vomiting chest heart attack stroke droop drooping slurred slurring numb "
+    "numbness weak weakness paralysis paralysed paralyzed faint fainted fainting unconscious unresponsive "
+    "collapse collapsed seizure convulsion fit confused confusion disoriented drowsy breathe breathing breath "
+    "breathless choking choke gasping wheezing blue purple swelling swollen throat tongue lips severe sudden "
+    "suddenly worst worse crushing radiating jaw stiff neck vision blind suicidal suicide overdose pregnant "
+    "pregnancy black"
+)
+
+
+def _differs_on_red_flag(words: frozenset, other: frozenset) -> bool:
+    return any(word.removeprefix("not:") in RED_FLAG_WORDS for word in words ^ other)
+
+
+class SimilarityIndex:
+    """
+    Near-duplicate lookup over (symptom text, context key) -> value, using
+    MinHash signatures with LSH banding.
+
+    Each text's word set is summarised by num_perm min-hashes, split into
+    bands; texts sharing any band (within the same context key) become
+    candidates, and a candidate is only returned if the exact Jaccard
+    similarity of the word sets reaches the threshold and the two texts
+    differ in no RED_FLAG_WORDS. Lookups touch a handful of buckets
+    regardless of size. Entries are evicted LRU at max_entries, removing
+    their bucket references; adding a value that is already indexed only
+    refreshes it.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, max_entries: int = SIMILAR_CACHE_SIZE, threshold: float = SIMILAR_CACHE_THRESHOLD,
+                 num_perm: int = 32, bands: int = 8, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.max_entries = max(1, max_entries)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._perms = [(rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME)) for _ in range(num_perm)]
+        # word -> its num_perm permuted hashes (bounded; vocabulary is small in practice)
+        self._word_hashes: dict[str, tuple] = {}
+        # entry id -> (context key, word set, band keys, value), least recently used first
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        # band key -> entry id, or a list of ids when several entries share the band
+        self._buckets: dict[int, object] = {}
+        # value -> its entry id
+        self._ids: dict = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.red_flag_rejections = 0
+
+    def _hashes(self, word: str) -> tuple:
+        hashes = self._word_hashes.get(word)
+        if hashes is None:
+            if len(self._word_hashes) >= 100_000:
+                self._word_hashes.clear()
+            base = hash(word) & 0xFFFFFFFFFFFFFFF
+            hashes = self._word_hashes[word] = tuple((a * base + b) % self._PRIME for a, b in self._perms)
+        return hashes
+
+    def _band_keys(self, words: frozenset, context_key: str) -> tuple:
+        signature = tuple(map(min, zip(*map(self._hashes, words))))
+        rows = self.rows
+        return tuple(
+            hash((context_key, band, signature[band * rows:(band + 1) * rows]))
+            for band in range(self.bands)
+        )
+
+    def lookup(self, text: str, context_key: str) -> list:
+        """Values of stored texts similar to text under the same context key, most similar first."""
+        words = symptom_shingles(text)
+        if not words:
+            return []
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(words, context_key):
+                bucket = self._buckets.get(band_key)
+                if bucket is None:
+                    continue
+                if isinstance(bucket, list):
+                    candidates.update(bucket)
+                else:
+                    candidates.add(bucket)
+            scored = []
+            for entry_id in candidates:
+                entry_context, entry_words, _, value = self._entries[entry_id]
+                if entry_context != context_key:
+                    continue
+                score = len(words & entry_words) / len(words | entry_words)
+                if score < self.threshold:
+                    continue
+                if _differs_on_red_flag(words, entry_words):
+                    self.red_flag_rejections += 1
+                    continue
+                scored.append((score, entry_id, value))
+                self._entries.move_to_end(entry_id)
+            if scored:
+                self.hits += 1
+            else:
+                self.misses += 1
+        scored.sort(key=lambda item: (-item[0], -item[1]))
+        return [value for _, _, value in scored]
+
+    def add(self, text: str, context_key: str, value) -> None:
+        """Index value under text (ignored for texts with no meaningful words)."""
+        words = symptom_shingles(text)
+        if not words:
+            return
+        context_key = sys.intern(context_key)
+        with self._lock:
+            entry_id = self._ids.get(value)
+            if entry_id is not None:
+                self._entries.move_to_end(entry_id)
+                return
+            band_keys = self._band_keys(words, context_key)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._ids[value] = entry_id
+            self._entries[entry_id] = (context_key, words, band_keys, value)
+            for band_key in band_keys:
+                bucket = self._buckets.get(band_key)
+                if bucket is None:
+                    self._buckets[band_key] = entry_id
+                elif isinstance(bucket, list):
+                    bucket.append(entry_id)
+                else:
+                    self._buckets[band_key] = [bucket, entry_id]
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        """Drop the least recently used entry and its bucket references (caller holds the lock)."""
+        entry_id, (_, _, band_keys, value) = self._entries.popitem(last=False)
+        del self._ids[value]
+        for band_key in band_keys:
+            bucket = self._buckets.get(band_key)
+            if isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[band_key] = bucket[0]
+            elif bucket == entry_id:
+                del self._buckets[band_key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+            self._ids.clear()
+            self.hits = self.misses = self.red_flag_rejections = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'buckets': len(self._buckets),
+                'hits': self.hits,
+                'misses': self.misses,
+                'red_flag_rejections': self.red_flag_rejections,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class TTLCache:
+    """Small thread-safe LRU with per-entry TTL for arbitrary values (in-process only)."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[object, tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """Return the cached value or default."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+analysis_cache = ResultCache(sqlite_path=_default_sqlite_path() if ANALYSIS_CACHE_SQLITE else None)
+# Maps near-duplicate symptom texts to analysis_cache keys; None when disabled.
+similar_cache = SimilarityIndex() if SIMILAR_CACHE_SIZE > 0 else None
@@ -0,0 +1,409 @@
+"""
+Record and replay upstream model traffic.
+
+With UPSTREAM_CASSETTE_MODE=record, every model call goes out as usual and
+is also appended to the UPSTREAM_CASSETTE file: one JSON line per call with
+the model, hashes of the instructions and input, and the text deltas with
+the time each arrived. With UPSTREAM_CASSETTE_MODE=replay, no request leaves
+the process: calls are answered from the file, streamed at the recorded pace
+divided by UPSTREAM_CASSETTE_SPEED (0: no delay), for load tests and
+regression benchmarks that are reproducible and need no network or API key.
+
+Both work at the httpx transport layer under the shared pools (see
+backend.http_pool), so the SDK, hedging, completion detection and
+cancellation run exactly as they do against the real provider. Replies are
+rebuilt for whichever API the SDK calls (Responses or chat completions).
+Imported only when a cassette is in use (it imports httpx).
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+
+import httpx
+
+# Cassette file (JSON lines, append-only).
+UPSTREAM_CASSETTE = os.getenv("UPSTREAM_CASSETTE", "").strip()
+# record: call upstream and append each call to the cassette; replay: answer from it. Off when unset.
+UPSTREAM_CASSETTE_MODE = os.getenv("UPSTREAM_CASSETTE_MODE", "").strip().lower() if UPSTREAM_CASSETTE else ""
+# Replay pace: 1 = recorded timing, 10 = ten times faster, 0 = no delay.
+UPSTREAM_CASSETTE_SPEED = float(os.getenv("UPSTREAM_CASSETTE_SPEED", "1"))
+# A request with no recording: "any" replays a recording chosen by its input hash, "error" answers 404.
+UPSTREAM_CASSETTE_MISS = os.getenv("UPSTREAM_CASSETTE_MISS", "any").strip().lower()
+
+if UPSTREAM_CASSETTE_MODE not in {"", "record", "replay"}:
+    raise ValueError(f"Unknown UPSTREAM_CASSETTE_MODE {UPSTREAM_CASSETTE_MODE!r} (expected record or replay)")
+if UPSTREAM_CASSETTE_MISS not in {"any", "error"}:
+    raise ValueError(f"Unknown UPSTREAM_CASSETTE_MISS {UPSTREAM_CASSETTE_MISS!r} (expected any or error)")
+
+_MODEL_PATHS = ("/responses", "/chat/completions")
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _describe(request) -> dict | None:
+    """model / instructions / input hashes and stream flag of a model call, or None for other requests."""
+    if request.method != "POST" or not request.url.path.endswith(_MODEL_PATHS):
+        return None
+    try:
+        body = json.loads(request.content or b"{}")
+    except ValueError:
+        return None
+    if "messages" in body:
+        messages = body.get("messages") or []
+        instructions = "\n".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+        prompt = "\n".join(str(m.get("content", "")) for m in messages if m.get("role") != "system")
+    else:
+        instructions, prompt = str(body.get("instructions") or ""), body.get("input") or ""
+        prompt = prompt if isinstance(prompt, str) else json.dumps(prompt, sort_keys=True)
+    return {
+        "api": "chat" if request.url.path.endswith("/chat/completions") else "responses",
+        "model": body.get("model", ""),
+        "instructions": _digest(instructions),
+        "input": _digest(prompt),
+        "stream": bool(body.get("stream")),
+    }
+
+
+def _stream_deltas(event: dict) -> str | None:
+    """Text delta of one SSE event from either API."""
+    if event.get("type") == "response.output_text.delta":
+        return event.get("delta") or None
+    choices = event.get("choices") or []
+    if choices and isinstance(choices[0], dict):
+        return (choices[0].get("delta") or {}).get("content") or None
+    return None
+
+
+def _full_text(payload: dict) -> str:
+    """Text of a non-streaming reply from either API."""
+    if "choices" in payload:
+        return ((payload["choices"] or [{}])[0].get("message") or {}).get("content") or ""
+    return "".join(
+        part.get("text", "")
+        for item in payload.get("output") or [] if item.get("type") == "message"
+        for part in item.get("content") or [] if part.get("type") == "output_text"
+    )
+
+
+# ============ Recording ============
+
+class _Recorder:
+    """Appends one JSON line per call; a single write() per line, so several processes can share the file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: int | None = None
+        self._lock = threading.Lock()
+
+    def write(self, entry: dict) -> None:
+        line = (json.dumps(entry, separators=(",", ":"), ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._fd, line)
+
+
+class _RecordingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """Passes an upstream body through unchanged, noting its text deltas and when each arrived."""
+
+    def __init__(self, stream, call: dict, started: float, recorder: _Recorder):
+        self._stream = stream
+        self._call = call
+        self._started = started
+        self._recorder = recorder
+        self._buffer = b""
+        self._times: list[float] = []
+        self._deltas: list[str] = []
+        self._closed = False
+
+    def _feed(self, chunk: bytes) -> None:
+        if not self._call["stream"]:
+            self._buffer += chunk
+            return
+        self._buffer += chunk.replace(b"\r\n", b"\n")
+        *events, self._buffer = self._buffer.split(b"\n\n")
+        for raw in events:
+            data = b"\n".join(line[5:].lstrip() for line in raw.split(b"\n") if line.startswith(b"data:"))
+            if not data or data == b"[DONE]":
+                continue
+            try:
+                delta = _stream_deltas(json.loads(data))
+            except ValueError:
+                continue
+            if delta:
+                self._times.append(time.monotonic())
+                self._deltas.append(delta)
+
+    def _finish(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        now = time.monotonic()
+        if not self._call["stream"]:
+            try:
+                text = _full_text(json.loads(self._buffer or b"{}"))
+            except ValueError:
+                return
+            self._times, self._deltas = [now], [text]
+        # Milliseconds: first delta after the request was sent, then between deltas.
+        gaps, previous = [], self._started
+        for at in self._times:
+            gaps.append(round((at - previous) * 1000, 1))
+            previous = at
+        self._recorder.write(dict(self._call, t=gaps, d=self._deltas, end=round((now - previous) * 1000, 1),
+                                  at=int(time.time())))
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._feed(chunk)
+            yield chunk
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._feed(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._finish()
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._finish()
+
+
+class RecordingTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """httpx transport (sync and async) that sends through inner and records successful model calls."""
+
+    def __init__(self, inner, path: str = UPSTREAM_CASSETTE):
+        self._inner = inner
+        self._recorder = _Recorder(path)
+        # http_pool reads connection stats from here.
+        self._pool = getattr(inner, "_pool", None)
+
+    def _prepare(self, request) -> dict | None:
+        call = _describe(request)
+        if call is not None:
+            request.headers["Accept-Encoding"] = "identity"  # record plain text, not compressed bytes
+        return call
+
+    def _wrap(self, request, response, call: dict | None, started: float):
+        if call is None or response.status_code != 200:
+            return response
+        return httpx.Response(response.status_code, headers=response.headers, request=request,
+                              extensions=response.extensions,
+                              stream=_RecordingStream(response.stream, call, started, self._recorder))
+
+    def handle_request(self, request):
+        call = self._prepare(request)
+        started = time.monotonic()
+        return self._wrap(request, self._inner.handle_request(request), call, started)
+
+    async def handle_async_request(self, request):
+        call = self._prepare(request)
+        started = time.monotonic()
+        return self._wrap(request, await self._inner.handle_async_request(request), call, started)
+
+    def close(self) -> None:
+        self._inner.close()
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+# ============ Replay ============
+
+def load(path: str) -> list[dict]:
+    """Every complete recording in a cassette file (a torn last line is skipped)."""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and entry.get("d") is not None:
+                entries.append(entry)
+    return entries
+
+
+def _response_object(response_id: str, model: str, text: str, status: str) -> dict:
+    output = []
+    if status == "completed":
+        output = [{"id": "msg_" + response_id, "type": "message", "role": "assistant", "status": "completed",
+                   "content": [{"type": "output_text", "text": text, "annotations": []}]}]
+    return {"id": response_id, "object": "response", "created_at": int(time.time()), "model": model,
+            "status": status, "output": output, "parallel_tool_calls": False, "tool_choice": "auto", "tools": []}
+
+
+def _chat_object(model: str, text: str) -> dict:
+    return {"id": "chatcmpl-replay", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}]}
+
+
+def _sse(event) -> bytes:
+    return f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode("utf-8")
+
+
+def _frames(api: str, model: str, deltas: list[str]) -> tuple[list[bytes], list[bytes], list[bytes]]:
+    """(opening frames, one frame per delta, closing frames) of an SSE reply in api's format."""
+    text = "".join(deltas)
+    if api == "chat":
+        def chunk(delta: dict, finish_reason=None) -> dict:
+            return {"id": "chatcmpl-replay", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        body = [_sse(chunk(dict({"content": d}, **({"role": "assistant"} if i == 0 else {}))))
+                for i, d in enumerate(deltas)]
+        return [], body, [_sse(chunk({}, "stop")), _sse("[DONE]")]
+
+    item = {"id": "msg_replay", "type": "message", "role": "assistant", "status": "in_progress", "content": []}
+    part = {"output_index": 0, "content_index": 0, "item_id": "msg_replay"}
+    seq = iter(range(len(deltas) + 10))
+    opening = [
+        _sse({"type": "response.created", "sequence_number": next(seq),
+              "response": _response_object("replay", model, text, "in_progress")}),
+        _sse({"type": "response.output_item.added", "sequence_number": next(seq), "output_index": 0, "item": item}),
+        _sse(dict(part, type="response.content_part.added", sequence_number=next(seq),
+                  part={"type": "output_text", "text": "", "annotations": []})),
+    ]
+    body = [_sse(dict(part, type="response.output_text.delta", sequence_number=next(seq), delta=d, logprobs=[]))
+            for d in deltas]
+    completed = _response_object("replay", model, text, "completed")
+    closing = [
+        _sse(dict(part, type="response.output_text.done", sequence_number=next(seq), text=text, logprobs=[])),
+        _sse({"type": "response.output_item.done", "sequence_number": next(seq), "output_index": 0,
+              "item": completed["output"][0]}),
+        _sse({"type": "response.completed", "sequence_number": next(seq), "response": completed}),
+    ]
+    return opening, body, closing
+
+
+class _ReplayStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """SSE body that releases each frame after its recorded delay (scaled by speed)."""
+
+    def __init__(self, timed_frames: list[tuple[float, bytes]], speed: float):
+        self._frames = timed_frames
+        self._speed = speed
+
+    def _delay(self, ms: float) -> float:
+        return ms / 1000 / self._speed if self._speed > 0 else 0.0
+
+    def __iter__(self):
+        for ms, frame in self._frames:
+            if self._delay(ms):
+                time.sleep(self._delay(ms))
+            yield frame
+
+    async def __aiter__(self):
+        for ms, frame in self._frames:
+            if self._delay(ms):
+                await asyncio.sleep(self._delay(ms))
+            yield frame
+
+    def close(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+class ReplayTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """httpx transport (sync and async) that answers model calls from a cassette and never touches the network."""
+
+    def __init__(self, path: str = UPSTREAM_CASSETTE, speed: float = UPSTREAM_CASSETTE_SPEED,
+                 miss: str = UPSTREAM_CASSETTE_MISS):
+        self.path = path
+        self.speed = speed
+        self.miss = miss
+        self._exact: dict[tuple, list[dict]] = {}
+        self._by_prompt: dict[tuple, list[dict]] = {}
+        self._all: list[dict] = []
+        self._turns: dict[tuple, int] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stats = {'replayed': 0, 'misses': 0}
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            for entry in load(self.path):
+                self._all.append(entry)
+                self._exact.setdefault((entry["model"], entry["instructions"], entry["input"]), []).append(entry)
+                self._by_prompt.setdefault((entry["instructions"], entry["input"]), []).append(entry)
+            self._loaded = True
+
+    def lookup(self, call: dict) -> dict | None:
+        """The recording for call: same model and prompt, else same prompt, else (miss=any) one picked by input hash."""
+        self._load()
+        for key, index in (((call["model"], call["instructions"], call["input"]), self._exact),
+                           ((call["instructions"], call["input"]), self._by_prompt)):
+            entries = index.get(key)
+            if entries:
+                with self._lock:
+                    # Repeats of one request take its recordings in turn.
+                    turn = self._turns[key] = self._turns.get(key, -1) + 1
+                    self._stats['replayed'] += 1
+                return entries[turn % len(entries)]
+        with self._lock:
+            self._stats['misses'] += 1
+        if self.miss == "any" and self._all:
+            return self._all[int(call["input"], 16) % len(self._all)]
+        return None
+
+    def _reply(self, request) -> tuple[object, float]:
+        """(httpx.Response, seconds to wait before returning it)."""
+        call = _describe(request)
+        if call is None:
+            # Warm-up pings and anything else: answered locally.
+            return httpx.Response(404, json={"error": {"message": "not recorded"}}, request=request), 0.0
+        entry = self.lookup(call)
+        if entry is None:
+            return httpx.Response(404, json={"error": {"message": "no cassette recording for this request"}},
+                                  request=request), 0.0
+        model, deltas, gaps = call["model"] or entry["model"], entry["d"], entry["t"]
+        if not call["stream"]:
+            text = "".join(deltas)
+            payload = _chat_object(model, text) if call["api"] == "chat" else _response_object(
+                "replay", model, text, "completed")
+            wait = (sum(gaps) + entry.get("end", 0)) / 1000 / self.speed if self.speed > 0 else 0.0
+            return httpx.Response(200, json=payload, request=request), wait
+        if len(gaps) != len(deltas):  # recorded non-streaming, replayed as a stream: one delta at the end
+            gaps = [sum(gaps)] + [0.0] * (len(deltas) - 1)
+        opening, body, closing = _frames(call["api"], model, deltas)
+        timed = [(0.0, frame) for frame in opening] + list(zip(gaps, body))
+        timed += [(entry.get("end", 0) if i == 0 else 0.0, frame) for i, frame in enumerate(closing)]
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, request=request,
+                              stream=_ReplayStream(timed, self.speed)), 0.0
+
+    def handle_request(self, request):
+        response, wait = self._reply(request)
+        if wait:
+            time.sleep(wait)
+        return response
+
+    async def handle_async_request(self, request):
+        response, wait = self._reply(request)
+        if wait:
+            await asyncio.sleep(wait)
+        return response
+
+    def close(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'recordings': len(self._all), **self._stats}
@@ -0,0 +1,191 @@
+"""
+Circuit breaking and off-thread retries for upstream calls.
+
+A breaker per backend opens after repeated quota errors/timeouts (or at
+once when the upstream sends Retry-After) so requests fail fast instead of
+queueing behind a provider that is rejecting everything. Retries never
+sleep in a request thread: they are handed to one shared scheduler thread.
+"""
+import heapq
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Consecutive quota errors/timeouts that open a backend's breaker.
+BREAKER_FAILURE_THRESHOLD = max(1, int(os.getenv("BREAKER_FAILURE_THRESHOLD", "3")))
+# Open period after the first trip; doubles (with jitter) on each consecutive trip up to the max.
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "5"))
+BREAKER_MAX_RESET_SECONDS = float(os.getenv("BREAKER_MAX_RESET_SECONDS", "60"))
+# Background retries per failed analysis, and the most retries waiting at once.
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_QUEUE_MAX = int(os.getenv("RETRY_QUEUE_MAX", "256"))
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+def backoff_delay(attempt: int, retry_after: float | None = None,
+                  base: float = BREAKER_RESET_SECONDS, cap: float = BREAKER_MAX_RESET_SECONDS) -> float:
+    """Jittered exponential backoff for attempt (0-based), never shorter than retry_after."""
+    delay = min(cap, base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+    if retry_after:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+def retry_after_seconds(exc: Exception) -> float | None:
+    """Retry-After from an SDK error's HTTP response (seconds or HTTP date), if present."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    closed -> open after BREAKER_FAILURE_THRESHOLD consecutive failures (or one
+    failure carrying Retry-After); open -> half_open when the open period ends;
+    half_open lets one probe through at a time and closes on its success or
+    re-opens, with a longer period, on its failure.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self._state = CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._open_until = 0.0
+        self._probe_until = 0.0
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() >= self._open_until:
+                return HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """May a request go to this backend now? In half-open, only the single probe may."""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and now >= self._open_until:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and now >= self._probe_until:
+                # A probe that never reports back (e.g. cancelled) frees the slot after a reset period.
+                self._probe_until = now + BREAKER_RESET_SECONDS
+                return True
+            self._rejected += 1
+            return False
+
+    def retry_in(self) -> float:
+        """Seconds until the breaker will let a request through again (0 when closed)."""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(0.0, max(self._open_until, self._probe_until) - time.monotonic())
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trips = 0
+            self._probe_until = 0.0
+
+    def record_failure(self, retry_after: float | None = None) -> bool:
+        """Count a quota error/timeout. Returns True when this failure opened the breaker."""
+        with self._lock:
+            self._failures += 1
+            if self._state == OPEN:
+                # Stragglers from before the trip don't escalate the backoff; Retry-After may extend it.
+                if retry_after:
+                    self._open_until = max(self._open_until, time.monotonic() + min(retry_after, BREAKER_MAX_RESET_SECONDS))
+                return False
+            if self._state == CLOSED and self._failures < self.failure_threshold and not retry_after:
+                return False
+            self._state = OPEN
+            self._open_until = time.monotonic() + backoff_delay(self._trips, retry_after)
+            self._probe_until = 0.0
+            self._trips += 1
+            return True
+
+    def stats(self) -> dict:
+        state = self.state
+        with self._lock:
+            return {
+                'open': int(state == OPEN),
+                'half_open': int(state == HALF_OPEN),
+                'consecutive_failures': self._failures,
+                'rejected': self._rejected,
+            }
+
+
+class CircuitOpenError(Exception):
+    """Every backend's breaker is open; retry_after is the soonest one will admit a request."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"upstream circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class RetryScheduler:
+    """
+    One daemon thread running delayed calls in due order; schedule() never
+    blocks. Calls run one at a time, which also throttles retries during an outage.
+    """
+
+    def __init__(self, max_pending: int = RETRY_QUEUE_MAX):
+        self.max_pending = max_pending
+        self._heap: list[tuple[float, int, object]] = []
+        self._keys: set = set()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def schedule(self, delay: float, fn, key=None) -> bool:
+        """Run fn() after delay seconds. Returns False if full or key is already waiting."""
+        with self._cond:
+            if len(self._heap) >= self.max_pending or (key is not None and key in self._keys):
+                return False
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, (key, fn)))
+            if key is not None:
+                self._keys.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='upstream-retry', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return True
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, (key, fn) = heapq.heappop(self._heap)
+                self._keys.discard(key)
+            try:
+                fn()
+            except Exception:
+                pass
+
+
+retry_scheduler = RetryScheduler()
@@ -1,37 +1,181 @@
 """SQLite database setup and operations for user profiles."""
+import os
+import queue
 import sqlite3
+import threading
 from contextlib import contextmanager
 from typing import Optional
-import os
+
+from backend import metrics
+from backend.cache import TTLCache
+from backend.medical_context import build_medical_context
 
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance', 'health_assistant.db')
+# Serverless hosts only allow writes under /tmp: set DATABASE_PATH there.
+DATABASE_PATH = os.getenv("DATABASE_PATH", "").strip()
+# Bump when init_db changes the schema; stored in PRAGMA user_version.
+SCHEMA_VERSION = 2
+
+# Pool tuning. Override in .env.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHED_STATEMENTS = 128
+
+# Per-user (profile, prebuilt medical context). save_profile invalidates only its own
+# process's entry, so the TTL bounds how long other workers serve an edited profile's old context.
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "1024"))
+PROFILE_CACHE_TTL_SECONDS = float(os.getenv("PROFILE_CACHE_TTL_SECONDS", "5"))
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS)
+metrics.register_gauges('profile_cache', profile_cache.stats)
 
 
 def get_db_path():
     """Get database path, creating instance folder if needed."""
+    if DATABASE_PATH:
+        os.makedirs(os.path.dirname(os.path.abspath(DATABASE_PATH)), exist_ok=True)
+        return DATABASE_PATH
     instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance')
     os.makedirs(instance_path, exist_ok=True)
     return os.path.join(instance_path, 'health_assistant.db')
 
 
+class ConnectionPool:
+    """
+    Thread-safe pool of long-lived SQLite connections.
+
+    Connections are opened once with WAL journaling, synchronous=NORMAL and a
+    busy timeout, and keep sqlite3's per-connection prepared statement cache
+    warm across requests.
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = max(1, size)
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,  # connections move between threads, one at a time
+            cached_statements=DB_CACHED_STATEMENTS,
+        )
+        conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Borrow a connection, opening a new one while under the pool size."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get(timeout=DB_BUSY_TIMEOUT_MS / 1000)
+
+    def release(self, conn: sqlite3.Connection, broken: bool = False) -> None:
+        """Return a connection to the pool (or drop it if it is unusable)."""
+        if broken:
+            with self._lock:
+                self._created -= 1
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            return
+        self._idle.put(conn)
+
+    def close_all(self) -> None:
+        """Close idle connections (borrowed ones are closed when returned broken)."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Process-wide pool. Recreated after fork so workers never share a connection."""
+    global _pool
+    pool = _pool
+    if pool is None or pool._pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool._pid != os.getpid():
+                _pool = ConnectionPool(get_db_path())
+            pool = _pool
+    return pool
+
+
+def reset_pool(path: Optional[str] = None) -> None:
+    """Close the current pool. With a path, point a new pool at that database file."""
+    global _pool, _schema_ready
+    with _pool_lock:
+        if _pool is not None and _pool._pid == os.getpid():
+            _pool.close_all()
+        _pool = ConnectionPool(path) if path else None
+        _schema_ready = False
+
+
 @contextmanager
 def get_db():
-    """Context manager for database connections."""
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+    """Context manager for pooled database connections."""
+    pool = get_pool()
+    with metrics.span('db_pool_wait_seconds'):
+        conn = pool.acquire()
+    broken = False
     try:
-        yield conn
-        conn.commit()
+        with metrics.span('db_transaction_seconds'):
+            yield conn
+            conn.commit()
     except Exception:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            broken = True
         raise
     finally:
-        conn.close()
+        pool.release(conn, broken=broken)
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_schema() -> None:
+    """Run init_db once per process (cheap no-op afterwards; usable as a before_request hook)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            init_db()
+            _schema_ready = True
 
 
 def init_db():
-    """Initialize database tables."""
+    """Initialize database tables. Does nothing when PRAGMA user_version says the schema is current."""
     with get_db() as conn:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return
         cursor = conn.cursor()
         cursor.executescript('''
             CREATE TABLE IF NOT EXISTS users (
@@ -53,11 +197,35 @@ def init_db():
                 allergies TEXT,
                 smoking_habit TEXT,
                 alcohol_habit TEXT,
+                medical_context TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             );
+
+            -- Written in batches by backend.history; token counts are estimates (~4 chars per token).
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                symptoms TEXT NOT NULL,
+                response TEXT NOT NULL,
+                is_emergency INTEGER NOT NULL DEFAULT 0,
+                model TEXT,
+                latency_ms INTEGER,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                created_at TIMESTAMP NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            );
+
+            -- Keyset pagination: a user's history newest first is one index range scan.
+            CREATE INDEX IF NOT EXISTS idx_analyses_user_id ON analyses (user_id, id);
         ''')
+        # Older databases predate the precomputed context column.
+        columns = {row['name'] for row in cursor.execute('PRAGMA table_info(profiles)')}
+        if 'medical_context' not in columns:
+            cursor.execute('ALTER TABLE profiles ADD COLUMN medical_context TEXT')
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
         conn.commit()
 
 
@@ -72,6 +240,12 @@ def create_user(username: str, password_hash: str) -> int:
         return cursor.lastrowid
 
 
+def update_password_hash(user_id: int, password_hash: str) -> None:
+    """Replace a user's stored password hash (e.g. after a hash-parameter upgrade)."""
+    with get_db() as conn:
+        conn.execute('UPDATE users SET password_hash = ? WHERE id = ?', (password_hash, user_id))
+
+
 def get_user_by_username(username: str) -> Optional[dict]:
     """Get user by username."""
     with get_db() as conn:
@@ -91,14 +265,15 @@ def get_user_by_id(user_id: int) -> Optional[dict]:
 
 
 def save_profile(user_id: int, profile_data: dict) -> None:
-    """Save or update user profile."""
+    """Save or update user profile (and its precomputed medical context)."""
     with get_db() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO profiles (
                 user_id, name, age, gender, height_cm, weight_kg,
-                existing_conditions, allergies, smoking_habit, alcohol_habit
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                existing_conditions, allergies, smoking_habit, alcohol_habit,
+                medical_context
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 name = excluded.name,
                 age = excluded.age,
@@ -109,6 +284,7 @@ def save_profile(user_id: int, profile_data: dict) -> None:
                 allergies = excluded.allergies,
                 smoking_habit = excluded.smoking_habit,
                 alcohol_habit = excluded.alcohol_habit,
+                medical_context = excluded.medical_context,
                 updated_at = CURRENT_TIMESTAMP
         ''', (
             user_id,
@@ -120,9 +296,53 @@ def save_profile(user_id: int, profile_data: dict) -> None:
             profile_data.get('existing_conditions', ''),
             profile_data.get('allergies', ''),
             profile_data.get('smoking_habit', ''),
-            profile_data.get('alcohol_habit', '')
+            profile_data.get('alcohol_habit', ''),
+            build_medical_context(profile_data)
         ))
         conn.commit()
+    profile_cache.invalidate(user_id)
+
+
+def get_user_with_profile(username: str) -> Optional[dict]:
+    """
+    Get user by username together with their profile in one query.
+    Returns the user dict with a 'profile' key (None when no profile exists).
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.id, u.username, u.password_hash, u.created_at,
+                   p.id AS profile_id, p.name, p.age, p.gender, p.height_cm, p.weight_kg,
+                   p.existing_conditions, p.allergies, p.smoking_habit, p.alcohol_habit,
+                   p.created_at AS profile_created_at, p.updated_at AS profile_updated_at
+            FROM users u
+            LEFT JOIN profiles p ON p.user_id = u.id
+            WHERE u.username = ?
+        ''', (username,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        row = dict(row)
+        user = {key: row[key] for key in ('id', 'username', 'password_hash', 'created_at')}
+        if row['profile_id'] is None:
+            user['profile'] = None
+        else:
+            user['profile'] = {
+                'id': row['profile_id'],
+                'user_id': row['id'],
+                'name': row['name'],
+                'age': row['age'],
+                'gender': row['gender'],
+                'height_cm': row['height_cm'],
+                'weight_kg': row['weight_kg'],
+                'existing_conditions': row['existing_conditions'],
+                'allergies': row['allergies'],
+                'smoking_habit': row['smoking_habit'],
+                'alcohol_habit': row['alcohol_habit'],
+                'created_at': row['profile_created_at'],
+                'updated_at': row['profile_updated_at'],
+            }
+        return user
 
 
 def get_profile(user_id: int) -> Optional[dict]:
@@ -132,3 +352,55 @@ def get_profile(user_id: int) -> Optional[dict]:
         cursor.execute('SELECT * FROM profiles WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
         return dict(row) if row else None
+
+
+def get_profile_with_context(user_id: int) -> tuple[Optional[dict], str]:
+    """
+    Get (profile, medical context string) for analysis requests.
+    Served from profile_cache; the context is read from the profiles row
+    when present, so a cold process does not rebuild it.
+    """
+    cached = profile_cache.get(user_id)
+    if cached is not None:
+        profile, medical_context = cached
+        return (dict(profile) if profile else None), medical_context
+
+    profile = get_profile(user_id)
+    medical_context = (profile or {}).get('medical_context') or build_medical_context(profile)
+    profile_cache.set(user_id, (profile, medical_context))
+    return (dict(profile) if profile else None), medical_context
+
+
+ANALYSIS_COLUMNS = ('user_id', 'symptoms', 'response', 'is_emergency', 'model',
+                    'latency_ms', 'input_tokens', 'output_tokens', 'created_at')
+
+
+def insert_analyses(rows: list[tuple]) -> None:
+    """Insert analysis history rows (tuples in ANALYSIS_COLUMNS order) in one transaction."""
+    with get_db() as conn:
+        conn.executemany(
+            f"INSERT INTO analyses ({', '.join(ANALYSIS_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(ANALYSIS_COLUMNS))})",
+            rows
+        )
+
+
+def get_analyses(user_id: int, before_id: Optional[int] = None, limit: int = 20) -> list[dict]:
+    """
+    A user's analyses newest first, starting below before_id (keyset pagination:
+    pass the last id of one page to get the next; the cost does not grow with depth).
+    """
+    with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, symptoms, response, is_emergency, model, latency_ms,
+                   input_tokens, output_tokens, created_at
+            FROM analyses
+            WHERE user_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+        rows = [dict(row) for row in cursor.fetchall()]
+    for row in rows:
+        row['is_emergency'] = bool(row['is_emergency'])
+    return rows
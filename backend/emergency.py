@@ -0,0 +1,92 @@
+"""Emergency detection over analysis text, incrementally while a response streams."""
+
+# Strong explicit signals, matched anywhere in the text
+STRONG_PHRASES = (
+    "call 911",
+    "call emergency",
+    "call an ambulance",
+    "go to the emergency",
+    "seek immediate medical attention",
+    "life-threatening",
+)
+_PHRASE_OVERLAP = max(len(p) for p in STRONG_PHRASES) - 1
+
+# "Emergency Warning:" values that mean there is no warning
+NO_WARNING_VALUES = {"none", "no", "n/a", "na", "not applicable", "-"}
+
+
+def line_is_emergency(line: str) -> bool:
+    """Structured outputs: detect "Risk Level: High", "Doctor Consultation: Urgent" or a real warning."""
+    line = line.strip().lower()
+    if line.startswith("risk level"):
+        if "high" in line:
+            return True
+    if line.startswith("doctor consultation") or line.startswith("doctor needed"):
+        if "urgent" in line:
+            return True
+    if line.startswith("emergency warning"):
+        # Don't trigger just because the section exists.
+        parts = line.split(":", 1)
+        warning = (parts[1] if len(parts) == 2 else "").strip()
+        if warning and warning not in NO_WARNING_VALUES:
+            return True
+    return False
+
+
+class EmergencyDetector:
+    """
+    Consumes deltas as they arrive. Strong phrases are matched against the new
+    text plus a short overlap; structured lines are checked once, when their
+    newline arrives. Nothing already checked is scanned again.
+    """
+
+    def __init__(self):
+        self.is_emergency = False
+        self._line_parts: list[str] = []
+        self._tail = ""
+
+    def feed(self, delta: str) -> bool:
+        """Process a delta. Returns True only on the delta that first makes the response an emergency."""
+        if self.is_emergency or not delta:
+            return False
+        text = delta.lower()
+
+        window = self._tail + text
+        if any(phrase in window for phrase in STRONG_PHRASES):
+            return self._trigger()
+        self._tail = window[-_PHRASE_OVERLAP:]
+
+        if "\n" not in text:
+            self._line_parts.append(text)
+            return False
+        head, *rest = text.split("\n")
+        self._line_parts.append(head)
+        completed = ["".join(self._line_parts)] + rest[:-1]
+        self._line_parts = [rest[-1]]
+        if any(line_is_emergency(line) for line in completed):
+            return self._trigger()
+        return False
+
+    def close(self) -> bool:
+        """Check the final unterminated line. Returns True if that made the response an emergency."""
+        if self.is_emergency:
+            return False
+        line = "".join(self._line_parts)
+        self._line_parts = []
+        if line_is_emergency(line):
+            return self._trigger()
+        return False
+
+    def _trigger(self) -> bool:
+        self.is_emergency = True
+        self._line_parts = []
+        self._tail = ""
+        return True
+
+
+def is_emergency_text(text: str) -> bool:
+    """Check if a complete response contains high-risk/emergency indicators."""
+    detector = EmergencyDetector()
+    detector.feed(text or "")
+    detector.close()
+    return detector.is_emergency
@@ -0,0 +1,186 @@
+"""
+Analysis history, written behind the request path.
+
+record() only appends to a bounded in-memory queue; a background thread
+drains it and inserts whole batches with one executemany per transaction
+(database.insert_analyses), so an analysis never waits on a SQLite commit
+and a burst of analyses costs one fsync instead of one each. Rows reach the
+table within HISTORY_FLUSH_SECONDS. If the queue is full (the database is
+stuck), new rows are dropped and counted rather than blocking requests.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+from backend import metrics
+from backend.ai_service import SYSTEM_PROMPT
+from backend.database import get_analyses, insert_analyses
+from backend.emergency import is_emergency_text
+from backend.triage import triage_response
+
+# Keep a history of analyses (set to 0 to stop recording).
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1").strip().lower() in {"1", "true", "yes", "on"}
+# Rows per executemany/commit.
+HISTORY_BATCH_SIZE = max(1, int(os.getenv("HISTORY_BATCH_SIZE", "256")))
+# Longest a recorded analysis waits before its batch is written.
+HISTORY_FLUSH_SECONDS = float(os.getenv("HISTORY_FLUSH_SECONDS", "0.5"))
+# Rows waiting to be written; beyond this, new rows are dropped.
+HISTORY_QUEUE_MAX = int(os.getenv("HISTORY_QUEUE_MAX", "10000"))
+# Largest page /api/history returns.
+HISTORY_PAGE_MAX = 100
+
+metrics.describe('history_rows_written_total', 'Analyses written to history (divide by history_batches_total for the batch size).')
+metrics.describe('history_batches_total', 'History batches written.')
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 chars per token), as used for the early-stop estimates."""
+    return (len(text) + 3) // 4
+
+
+class HistoryWriter:
+    """Bounded queue of history rows and the thread that writes them in batches."""
+
+    def __init__(self, batch_size: int = HISTORY_BATCH_SIZE, flush_seconds: float = HISTORY_FLUSH_SECONDS,
+                 queue_max: int = HISTORY_QUEUE_MAX, write=insert_analyses):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._write = write
+        self._queue: queue.Queue = queue.Queue(queue_max)
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one writer at a time: the thread, or flush()
+        self._stats = {'recorded': 0, 'written': 0, 'batches': 0, 'dropped': 0, 'errors': 0}
+
+    def put(self, row: tuple) -> None:
+        """Queue a row (database.ANALYSIS_COLUMNS order) without blocking."""
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+            return
+        with self._lock:
+            self._stats['recorded'] += 1
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            # Gather what arrives within flush_seconds of the first row, up to a full batch.
+            batch = [first]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._flush_lock:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch: list[tuple]) -> None:
+        try:
+            self._write(batch)
+        except Exception:
+            with self._lock:
+                self._stats['errors'] += 1
+            return
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+        metrics.inc('history_rows_written_total', len(batch))
+        metrics.inc('history_batches_total')
+        with self._lock:
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+
+    def flush(self) -> None:
+        """
+        Write what is queued from the calling thread, then wait for the batch the
+        writer thread may be holding (tests, benchmarks, shutdown).
+        """
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    break
+                self._write_batch(batch)
+        self._queue.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, 'queued': self._queue.qsize()}
+
+
+writer = HistoryWriter()
+metrics.register_gauges('history', writer.stats)
+atexit.register(writer.flush)
+
+
+def record(user_id: int, symptoms: str, medical_context: str, response: str, is_emergency: bool,
+           latency_seconds: float, model: str | None = None) -> None:
+    """
+    Add one analysis to the user's history (written shortly after, off this
+    thread). model is the one that answered (the outcome analyze_symptoms
+    reports): 'cache' for a cached answer, 'triage' for a canned pre-triage
+    answer that had no model analysis, None (stored as NULL) when unknown.
+    """
+    if not HISTORY_ENABLED or not response:
+        return
+    writer.put((
+        user_id, symptoms, response, int(bool(is_emergency)), model,
+        round(latency_seconds * 1000),
+        estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(medical_context or '') + estimate_tokens(symptoms),
+        estimate_tokens(response),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),  # the format CURRENT_TIMESTAMP uses
+    ))
+
+
+def record_stream(user_id: int, symptoms: str, medical_context: str, triage: dict | None, text: str,
+                  latency_seconds: float, outcome: dict | None = None) -> None:
+    """
+    Record a finished stream: the model's answer, or the canned triage answer
+    when there was none. An error message is not an analysis and is not kept.
+    """
+    outcome = outcome or {}
+    text = text.strip()
+    if text and not outcome.get('error'):
+        record(user_id, symptoms, medical_context, text, triage is not None or is_emergency_text(text),
+               latency_seconds, model=outcome.get('model'))
+    elif triage is not None:
+        record(user_id, symptoms, medical_context, triage_response(triage), True, latency_seconds, model='triage')
+
+
+def history_page(user_id: int, before_id: int | None = None, limit: int = 20) -> tuple[list[dict], int | None]:
+    """(analyses newest first, the before_id for the next page or None on the last page)."""
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    rows = get_analyses(user_id, before_id, limit + 1)
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]['id']
+    return rows, None
+
+
+def iter_history(user_id: int, page_size: int = 500):
+    """Every analysis of the user, newest first, fetched a keyset page at a time (no long-held connection)."""
+    before_id = None
+    while True:
+        rows = get_analyses(user_id, before_id, page_size)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        before_id = rows[-1]['id']
@@ -0,0 +1,204 @@
+"""
+Shared HTTP connection pools for upstream model calls.
+
+Every OpenAI client (one per backend) sends through one long-lived httpx
+client with explicit keep-alive limits, so connections are reused across
+requests and backends instead of being set up per client. warm_up() opens
+idle connections to the upstream hosts ahead of the first analysis (and,
+with UPSTREAM_WARMUP_INTERVAL_SECONDS, keeps them open), so the first
+request after a deploy skips DNS, TCP and TLS setup like every later one.
+httpx is imported on first use, like the openai SDK (see ai_service).
+With UPSTREAM_CASSETTE_MODE set, the pools record upstream traffic or
+replay it instead of using the network (see backend.cassette).
+"""
+import asyncio
+import importlib.util
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from backend import metrics
+
+if TYPE_CHECKING:
+    import httpx
+
+# Connection limits shared by all upstream backends.
+UPSTREAM_POOL_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_POOL_MAX_CONNECTIONS", "100"))
+UPSTREAM_POOL_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_POOL_MAX_KEEPALIVE", "20"))
+# How long an idle connection is kept before the pool closes it.
+UPSTREAM_POOL_KEEPALIVE_SECONDS = float(os.getenv("UPSTREAM_POOL_KEEPALIVE_SECONDS", "90"))
+# HTTP/2 multiplexes concurrent streams over one connection; needs the optional h2 package (requirements-http2.txt).
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "").strip().lower() in {"1", "true", "yes", "on"}
+# Open upstream connections at startup (off by default on Vercel, where instances freeze between requests).
+UPSTREAM_WARMUP = os.getenv("UPSTREAM_WARMUP", "" if os.getenv("VERCEL") else "1").strip().lower() in {"1", "true", "yes", "on"}
+# Idle connections opened per upstream host by a warm-up.
+UPSTREAM_WARMUP_CONNECTIONS = max(1, int(os.getenv("UPSTREAM_WARMUP_CONNECTIONS", "2")))
+# Re-warm this often so idle connections outlive server-side idle timeouts (0: warm once).
+UPSTREAM_WARMUP_INTERVAL_SECONDS = float(os.getenv("UPSTREAM_WARMUP_INTERVAL_SECONDS", "45"))
+
+_client: "httpx.Client | None" = None
+_async_client: "httpx.AsyncClient | None" = None
+_lock = threading.Lock()
+_stats = {'warmups': 0, 'warmup_errors': 0, 'warmup_connections_opened': 0}
+
+
+def _http2() -> bool:
+    return UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+
+
+def _client_options(is_async: bool = False) -> dict:
+    import httpx
+    options = {
+        'limits': httpx.Limits(
+            max_connections=UPSTREAM_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_POOL_KEEPALIVE_SECONDS,
+        ),
+        'http2': _http2(),
+        # The SDK's own httpx defaults; per-request timeouts come from the OpenAI client.
+        'follow_redirects': True,
+        'timeout': httpx.Timeout(20.0, connect=5.0),
+    }
+    if not os.getenv('UPSTREAM_CASSETTE', '').strip():
+        return options
+    from backend import cassette
+    if cassette.UPSTREAM_CASSETTE_MODE == 'replay':
+        options['transport'] = cassette.ReplayTransport()
+    elif cassette.UPSTREAM_CASSETTE_MODE == 'record':
+        transport = httpx.AsyncHTTPTransport if is_async else httpx.HTTPTransport
+        options['transport'] = cassette.RecordingTransport(
+            transport(limits=options['limits'], http2=options['http2'])
+        )
+    return options
+
+
+def get_http_client() -> "httpx.Client":
+    """The process-wide sync pool (pass as OpenAI(http_client=...))."""
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                import httpx
+                _client = httpx.Client(**_client_options())
+    return _client
+
+
+def get_async_http_client() -> "httpx.AsyncClient":
+    """The async pool (pass as AsyncOpenAI(http_client=...)); create it on the event loop that uses it."""
+    global _async_client
+    if _async_client is None:
+        import httpx
+        _async_client = httpx.AsyncClient(**_client_options(is_async=True))
+    return _async_client
+
+
+async def close_async_http_client() -> None:
+    global _async_client
+    client, _async_client = _async_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def _warm_url(base_url: str) -> str:
+    # Any request opens the connection; /models is cheap, and a 401 still leaves it warm.
+    return base_url.rstrip("/") + "/models"
+
+
+def _connections(client) -> list:
+    """httpcore's pooled connections for client (empty if its layout ever changes)."""
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", ()))
+
+
+def warm_up(base_urls: list[str], connections: int = UPSTREAM_WARMUP_CONNECTIONS) -> None:
+    """Open (or refresh) `connections` idle connections to each base URL in the sync pool."""
+    client = get_http_client()
+    before = len(_connections(client))
+    errors = []
+
+    def ping(url: str) -> None:
+        try:
+            client.get(url, timeout=5.0).close()
+        except Exception as e:  # a failed warm-up only means the first request connects itself
+            errors.append(e)
+
+    # Concurrent requests, so the pool has to open `connections` separate sockets.
+    threads = [threading.Thread(target=ping, args=(_warm_url(url),), daemon=True)
+               for url in dict.fromkeys(base_urls) for _ in range(1 if _http2() else connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with _lock:
+        _stats['warmups'] += 1
+        _stats['warmup_errors'] += len(errors)
+        _stats['warmup_connections_opened'] += max(0, len(_connections(client)) - before)
+
+
+async def warm_up_async(base_urls: list[str], connections: int = UPSTREAM_WARMUP_CONNECTIONS) -> None:
+    """Async twin of warm_up() for the async pool."""
+    client = get_async_http_client()
+    before = len(_connections(client))
+
+    async def ping(url: str) -> bool:
+        try:
+            await (await client.get(url, timeout=5.0)).aclose()
+            return True
+        except Exception:
+            return False
+
+    results = await asyncio.gather(*(ping(_warm_url(url)) for url in dict.fromkeys(base_urls)
+                                     for _ in range(1 if _http2() else connections)))
+    with _lock:
+        _stats['warmups'] += 1
+        _stats['warmup_errors'] += results.count(False)
+        _stats['warmup_connections_opened'] += max(0, len(_connections(client)) - before)
+
+
+def start_warm_up(base_urls: list[str], then=None) -> None:
+    """
+    Warm the sync pool on a daemon thread (never delays startup), repeating
+    every UPSTREAM_WARMUP_INTERVAL_SECONDS; then() runs once after the first pass.
+    """
+    def run() -> None:
+        nonlocal then
+        while True:
+            warm_up(base_urls)
+            if then is not None:
+                then()
+                then = None
+            if UPSTREAM_WARMUP_INTERVAL_SECONDS <= 0:
+                return
+            time.sleep(UPSTREAM_WARMUP_INTERVAL_SECONDS)
+
+    if base_urls:
+        threading.Thread(target=run, name='upstream-warmup', daemon=True).start()
+
+
+async def keep_warm_async(base_urls: list[str]) -> None:
+    """Async twin of start_warm_up's loop; run it as a task and cancel it on shutdown."""
+    while base_urls:
+        await warm_up_async(base_urls)
+        if UPSTREAM_WARMUP_INTERVAL_SECONDS <= 0:
+            return
+        await asyncio.sleep(UPSTREAM_WARMUP_INTERVAL_SECONDS)
+
+
+def _pool_stats(client) -> dict:
+    connections = _connections(client)
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {'connections': len(connections), 'idle': idle, 'in_use': len(connections) - idle}
+
+
+def pool_stats() -> dict:
+    stats = {'http2': int(_http2()), 'max_connections': UPSTREAM_POOL_MAX_CONNECTIONS}
+    for prefix, client in (('sync', _client), ('async', _async_client)):
+        for name, value in _pool_stats(client).items():
+            stats[f'{prefix}_{name}'] = value
+    with _lock:
+        stats.update(_stats)
+    return stats
+
+
+metrics.register_gauges('upstream_pool', pool_stats)
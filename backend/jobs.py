@@ -0,0 +1,258 @@
+"""
+Resumable analysis streams.
+
+Each /api/analyze/stream request runs as a job: the generation publishes
+its SSE events, numbered from 1, into a bounded per-job ring buffer, and
+connections only read from it. A client whose connection drops reconnects
+to /api/analyze/stream/<job_id> with Last-Event-ID and gets the events it
+missed, then the live remainder, without a new upstream call or
+rate-limit slot. A job nobody is reading is cancelled after a short grace
+period; finished jobs stay replayable for JOB_TTL_SECONDS. At most
+JOB_MAX_RUNNING jobs generate at once; further streams are refused (the
+routes answer 503 with Retry-After). Jobs live in process memory, so a
+resume must reach the same server process.
+"""
+import asyncio
+import math
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+from backend import metrics
+from backend.upstream import Cancellation
+
+# Events kept per job; a resume from before the oldest kept event is refused (410).
+JOB_BUFFER_EVENTS = int(os.getenv("JOB_BUFFER_EVENTS", "512"))
+# How long a finished job stays replayable.
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "120"))
+# How long a running job with no connected reader waits for a reconnect before its upstream is cancelled.
+# Short: the dashboard reconnects within 0.5-1.5 s, and a closed tab keeps paying for tokens meanwhile.
+JOB_RESUME_GRACE_SECONDS = float(os.getenv("JOB_RESUME_GRACE_SECONDS", "2"))
+# Caps on retained jobs and on their buffered event bytes; the oldest finished jobs go first.
+JOB_MAX_JOBS = int(os.getenv("JOB_MAX_JOBS", "1000"))
+JOB_MAX_BYTES = int(os.getenv("JOB_MAX_BYTES", str(32 * 1024 * 1024)))
+# Jobs generating at once (0: no cap). Each holds threads until it ends, coalesced and cached streams
+# included, which admission control does not count. Possible emergencies are never refused.
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", "128"))
+
+
+class JobLimitReached(Exception):
+    """JOB_MAX_RUNNING jobs are running already. retry_after is a hint in whole seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"too many analyses running, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AnalysisJob:
+    """One analysis run: its SSE events with sequence ids and the readers attached to it."""
+
+    def __init__(self, job_id: str, user_id):
+        self.id = job_id
+        self.user_id = user_id
+        self.cancellation = Cancellation()
+        self.created = time.monotonic()
+        self.finished_at: float | None = None
+        self.size = 0
+        self._events: deque[tuple[int, str]] = deque(maxlen=JOB_BUFFER_EVENTS)
+        self._seq = 0
+        self._readers = 0
+        self._cond = threading.Condition()
+        self._async_waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def publish(self, frames: str) -> None:
+        """Append frames ("data: ...\\n\\n" events, as from AnalysisStream), one sequence id per event."""
+        with self._cond:
+            for event in frames.split("\n\n"):
+                if not event:
+                    continue
+                if len(self._events) == self._events.maxlen:
+                    self.size -= len(self._events[0][1])
+                self._seq += 1
+                self._events.append((self._seq, event + "\n\n"))
+                self.size += len(event) + 2
+            self._cond.notify_all()
+        self._wake_async()
+
+    def finish(self) -> None:
+        with self._cond:
+            first = self.finished_at is None
+            if first:
+                self.finished_at = time.monotonic()
+            self._cond.notify_all()
+        self._wake_async()
+        if first:
+            _job_ended(self.finished_at - self.created)
+
+    def can_resume(self, after_seq: int) -> bool:
+        """True if every event after after_seq is still buffered."""
+        with self._cond:
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            return 0 <= after_seq <= self._seq and after_seq >= oldest - 1
+
+    def events_after(self, after_seq: int) -> tuple[list[tuple[int, str]], bool]:
+        """(events with seq > after_seq, finished) without waiting."""
+        with self._cond:
+            return [item for item in self._events if item[0] > after_seq], self.done
+
+    def wait(self, after_seq: int) -> tuple[list[tuple[int, str]], bool]:
+        """Block until there are events after after_seq or the job has finished."""
+        with self._cond:
+            while self._seq <= after_seq and not self.done:
+                self._cond.wait()
+            return [item for item in self._events if item[0] > after_seq], self.done
+
+    async def wait_async(self, after_seq: int) -> tuple[list[tuple[int, str]], bool]:
+        """Async twin of wait(): suspends the coroutine, not a thread."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        self._async_waiters.add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                events, finished = self.events_after(after_seq)
+                if events or finished:
+                    return events, finished
+                await waiter[1].wait()
+        finally:
+            self._async_waiters.discard(waiter)
+
+    def _wake_async(self) -> None:
+        for loop, event in list(self._async_waiters):
+            loop.call_soon_threadsafe(event.set)
+
+    def attach(self) -> None:
+        with self._cond:
+            self._readers += 1
+
+    def detach(self) -> None:
+        """A reader left. If it was the last and the job is still running, start the grace period."""
+        with self._cond:
+            self._readers -= 1
+            abandoned = self._readers == 0 and not self.done
+        if not abandoned:
+            return
+        if JOB_RESUME_GRACE_SECONDS <= 0:
+            self._cancel_if_abandoned()
+        else:
+            timer = threading.Timer(JOB_RESUME_GRACE_SECONDS, self._cancel_if_abandoned)
+            timer.daemon = True
+            timer.start()
+
+    def _cancel_if_abandoned(self) -> None:
+        with self._cond:
+            if self._readers or self.done:
+                return
+        metrics.inc('analysis_jobs_abandoned_total')
+        self.cancellation.cancel()
+
+
+def sse_events(job: AnalysisJob, after_seq: int = 0):
+    """Yield job's SSE events after after_seq, with "id:" lines, until it finishes."""
+    job.attach()
+    try:
+        while True:
+            events, finished = job.wait(after_seq)
+            for seq, event in events:
+                after_seq = seq
+                yield f"id: {seq}\n{event}"
+            if finished and not events:
+                return
+    finally:
+        job.detach()
+
+
+async def sse_events_async(job: AnalysisJob, after_seq: int = 0):
+    """Async twin of sse_events."""
+    job.attach()
+    try:
+        while True:
+            events, finished = await job.wait_async(after_seq)
+            for seq, event in events:
+                after_seq = seq
+                yield f"id: {seq}\n{event}"
+            if finished and not events:
+                return
+    finally:
+        job.detach()
+
+
+def parse_last_event_id(value) -> int | None:
+    """Sequence number from a Last-Event-ID header / last_event_id parameter (None if absent or invalid)."""
+    try:
+        return int(str(value).strip()) if value not in (None, '') else 0
+    except ValueError:
+        return None
+
+
+# Jobs by id, oldest first.
+_jobs: "OrderedDict[str, AnalysisJob]" = OrderedDict()
+_jobs_lock = threading.Lock()
+# Jobs created and not finished yet, and how long jobs have been running (for Retry-After).
+_running = 0
+_run_ewma = 5.0
+
+
+def _evict(now: float) -> None:
+    """Drop expired finished jobs, then the oldest finished ones while over the caps. Caller holds _jobs_lock."""
+    for job_id, job in list(_jobs.items()):
+        if job.done and now - job.finished_at > JOB_TTL_SECONDS:
+            del _jobs[job_id]
+    total = sum(job.size for job in _jobs.values())
+    for job_id, job in list(_jobs.items()):
+        if len(_jobs) <= JOB_MAX_JOBS and total <= JOB_MAX_BYTES:
+            break
+        if job.done:
+            total -= job.size
+            del _jobs[job_id]
+            metrics.inc('analysis_jobs_evicted_total')
+
+
+def create_job(user_id, priority: bool = False) -> AnalysisJob:
+    """
+    A new running job for user_id. Raises JobLimitReached when JOB_MAX_RUNNING
+    jobs are running already (never for priority: a possible emergency).
+    """
+    global _running
+    job = AnalysisJob(secrets.token_urlsafe(12), user_id)
+    with _jobs_lock:
+        if not priority and 0 < JOB_MAX_RUNNING <= _running:
+            metrics.inc('analysis_jobs_rejected_total')
+            raise JobLimitReached(max(1, math.ceil(_run_ewma / JOB_MAX_RUNNING)))
+        _evict(time.monotonic())
+        _jobs[job.id] = job
+        _running += 1
+    return job
+
+
+def _job_ended(seconds: float) -> None:
+    global _running, _run_ewma
+    with _jobs_lock:
+        _running -= 1
+        _run_ewma += 0.2 * (seconds - _run_ewma)
+
+
+def get_job(job_id: str, user_id) -> AnalysisJob | None:
+    """The job if it exists, has not expired and belongs to user_id."""
+    with _jobs_lock:
+        _evict(time.monotonic())
+        job = _jobs.get(job_id)
+    return job if job is not None and job.user_id == user_id else None
+
+
+def job_stats() -> dict:
+    with _jobs_lock:
+        jobs = list(_jobs.values())
+    return {
+        'jobs': len(jobs),
+        'running': sum(not job.done for job in jobs),
+        'buffered_bytes': sum(job.size for job in jobs),
+    }
+
+
+metrics.register_gauges('analysis_jobs', job_stats)
@@ -0,0 +1,29 @@
+"""Medical context text built from a user profile and sent with every analysis."""
+from typing import Optional
+
+
+def build_medical_context(profile: Optional[dict]) -> str:
+    """Build medical context string from user profile."""
+    if not profile:
+        return "No medical history provided."
+
+    context_parts = []
+    if profile.get('name'):
+        context_parts.append(f"Patient name: {profile['name']}")
+    if profile.get('age'):
+        context_parts.append(f"Age: {profile['age']} years")
+    if profile.get('gender'):
+        context_parts.append(f"Gender: {profile['gender']}")
+    if profile.get('height_cm') and profile.get('weight_kg'):
+        bmi = round(profile['weight_kg'] / ((profile['height_cm'] / 100) ** 2), 1)
+        context_parts.append(f"Height: {profile['height_cm']} cm, Weight: {profile['weight_kg']} kg (BMI: {bmi})")
+    if profile.get('existing_conditions'):
+        context_parts.append(f"Existing conditions: {profile['existing_conditions']}")
+    if profile.get('allergies'):
+        context_parts.append(f"Allergies: {profile['allergies']}")
+    if profile.get('smoking_habit'):
+        context_parts.append(f"Smoking: {profile['smoking_habit']}")
+    if profile.get('alcohol_habit'):
+        context_parts.append(f"Alcohol: {profile['alcohol_habit']}")
+
+    return "\n".join(context_parts) if context_parts else "No medical history provided."
@@ -0,0 +1,158 @@
+"""
+Lightweight in-process metrics (counters, histograms, timing spans) and
+Prometheus text rendering for /metrics.
+
+Disabled unless METRICS_ENABLED=1: every helper then returns immediately
+(span() hands back a shared no-op context manager), so instrumented hot
+paths pay one global lookup.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "").strip().lower() in {"1", "true", "yes", "on"}
+
+# Seconds; covers sub-millisecond phases up to full generations.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_NOOP = nullcontext()
+_lock = threading.Lock()
+# name -> {label tuple: value}
+_counters: dict[str, dict[tuple, float]] = {}
+# name -> {label tuple: [bucket counts..., +Inf count, sum]}
+_histograms: dict[str, dict[tuple, list]] = {}
+_help: dict[str, str] = {}
+# prefix -> callable returning {key: number}; rendered as gauges
+_gauge_sources: dict[str, object] = {}
+
+
+def enable(enabled: bool = True) -> None:
+    """Turn collection on or off at runtime (e.g. for benchmarks)."""
+    global METRICS_ENABLED
+    METRICS_ENABLED = enabled
+
+
+def describe(name: str, help_text: str) -> None:
+    """Attach a HELP line to a metric."""
+    _help[name] = help_text
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    """Increase a counter."""
+    if not METRICS_ENABLED:
+        return
+    key = _label_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Record one histogram observation (seconds for *_seconds metrics)."""
+    if not METRICS_ENABLED:
+        return
+    key = _label_key(labels)
+    index = bisect_left(DEFAULT_BUCKETS, value)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        slots = series.get(key)
+        if slots is None:
+            slots = series[key] = [0] * (len(DEFAULT_BUCKETS) + 1) + [0.0]
+        slots[index] += 1
+        slots[-1] += value
+
+
+class _Span:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def span(name: str, **labels):
+    """Context manager timing its block into histogram name."""
+    if not METRICS_ENABLED:
+        return _NOOP
+    return _Span(name, labels)
+
+
+def register_gauges(prefix: str, source) -> None:
+    """Expose a stats() style callable ({key: number}) as gauges named prefix_key."""
+    _gauge_sources[prefix] = source
+
+
+def reset() -> None:
+    """Drop all recorded series (gauge sources stay registered)."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ''
+    parts = []
+    for label, value in items:
+        text = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{label}="{text}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = {name: dict(series) for name, series in _counters.items()}
+        histograms = {name: {k: list(v) for k, v in series.items()} for name, series in _histograms.items()}
+
+    for name in sorted(counters):
+        if name in _help:
+            lines.append(f'# HELP {name} {_help[name]}')
+        lines.append(f'# TYPE {name} counter')
+        for key, value in sorted(counters[name].items()):
+            lines.append(f'{name}{_format_labels(key)} {value:g}')
+
+    for name in sorted(histograms):
+        if name in _help:
+            lines.append(f'# HELP {name} {_help[name]}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, slots in sorted(histograms[name].items()):
+            cumulative = 0
+            for bound, count in zip(DEFAULT_BUCKETS, slots):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(key, (("le", f"{bound:g}"),))} {cumulative}')
+            cumulative += slots[len(DEFAULT_BUCKETS)]
+            lines.append(f'{name}_bucket{_format_labels(key, (("le", "+Inf"),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(key)} {slots[-1]:.6f}')
+            lines.append(f'{name}_count{_format_labels(key)} {cumulative}')
+
+    for prefix in sorted(_gauge_sources):
+        try:
+            stats = _gauge_sources[prefix]()
+        except Exception:
+            continue
+        for key in sorted(stats):
+            value = stats[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'{prefix}_{key}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,184 @@
+"""
+Password hashing off the request threads.
+
+Hashing and checking passwords is the most CPU-heavy work the app does. It
+runs in a small process pool (PASSWORD_HASH_WORKERS), so a login surge
+neither holds the GIL nor ties up the threads serving streams. Each app
+process starts its own pool on first use (a pool inherited through a fork,
+e.g. gunicorn --preload, has lost its management thread), and at most
+PASSWORD_HASH_MAX_PENDING hashes are accepted at once; beyond that
+HashingBusy is raised and the auth routes answer 503 instead of queueing
+CPU work. The hash method and its cost come from PASSWORD_HASH_METHOD; a
+stored hash made with other parameters is re-hashed on the next successful
+login (verify() returns the replacement).
+"""
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from backend import metrics
+
+# werkzeug method spec including its cost, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000.
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "scrypt").strip()
+# Worker processes for hashing, per app process (0: hash in the request thread; the default on
+# Vercel, which has no /dev/shm). Kept small: every gunicorn/uvicorn worker gets a pool of its own.
+PASSWORD_HASH_WORKERS = int(os.getenv(
+    "PASSWORD_HASH_WORKERS", "0" if os.getenv("VERCEL") else str(min(2, os.cpu_count() or 1))
+))
+# Hashes running or queued at once; further logins are refused with 503.
+PASSWORD_HASH_MAX_PENDING = max(1, int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32")))
+# Longest a hash may wait for a worker before the request gives up.
+PASSWORD_HASH_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_HASH_TIMEOUT_SECONDS", "10"))
+
+metrics.describe('password_hash_seconds', 'Time to hash or check a password, including the wait for a worker.')
+
+_pool: ProcessPoolExecutor | None = None
+_pool_pid = 0
+# Set by _init_worker: this process is a hashing worker and must not start a pool of its own.
+# (multiprocessing.parent_process() can't tell: uvicorn --workers spawns app processes with multiprocessing too.)
+_in_worker = False
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+_stats = {'hashes': 0, 'checks': 0, 'upgrades': 0, 'busy': 0, 'pool_restarts': 0}
+_stats_lock = threading.Lock()
+
+
+class HashingBusy(Exception):
+    """PASSWORD_HASH_MAX_PENDING hashes are already in progress."""
+
+
+@lru_cache(maxsize=None)
+def _method_prefix(method: str) -> str:
+    """The method field werkzeug writes for method, with defaults filled in (scrypt -> scrypt:32768:8:1)."""
+    return generate_password_hash('', method, salt_length=1).split('$', 1)[0]
+
+
+def _init_worker(method: str) -> None:
+    global _in_worker
+    _in_worker = True
+    # Exit with the app process even when it is killed without shutting the pool down.
+    parent = multiprocessing.parent_process()
+    if parent is not None:
+        threading.Thread(target=lambda: (parent.join(), os._exit(0)), daemon=True).start()
+    _method_prefix(method)  # work out the current method prefix now, not on the first login
+
+
+def _hash(password: str, method: str) -> str:
+    return generate_password_hash(password, method)
+
+
+def _verify(stored_hash: str, password: str, method: str) -> tuple[bool, str | None]:
+    """Worker side of verify(): check, and re-hash in the same trip when the parameters are outdated."""
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if stored_hash.split('$', 1)[0] == _method_prefix(method):
+        return True, None
+    return True, generate_password_hash(password, method)
+
+
+def _get_pool() -> ProcessPoolExecutor | None:
+    """This process's pool, started on first use. Recreated after fork, like database.get_pool."""
+    if PASSWORD_HASH_WORKERS <= 0 or _in_worker:
+        return None  # inline hashing, or we are a hashing worker ourselves
+    global _pool, _pool_pid
+    pool = _pool
+    if pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # A pool inherited from the parent is left alone: its workers and queues belong to the parent.
+                _pool, _pool_pid = _new_pool(), os.getpid()
+            pool = _pool
+    return pool
+
+
+def _new_pool() -> ProcessPoolExecutor:
+    # Spawned, not forked: the pool starts on the first login, when the server's threads are running,
+    # and a fork taken while one of them holds an OpenSSL lock leaves the worker stuck in its first hash.
+    pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(PASSWORD_HASH_METHOD,))
+    # A multiprocessing child (a uvicorn --workers process) exits through multiprocessing's own
+    # exit hook, which joins the hashing workers without running the executor's shutdown first.
+    # Priority above the queues' own finalizers (10), so the stop messages still get sent.
+    multiprocessing.util.Finalize(pool, pool.shutdown, kwargs={'cancel_futures': True}, exitpriority=100)
+    return pool
+
+
+def _run(fn, *args):
+    if not _pending.acquire(blocking=False):
+        with _stats_lock:
+            _stats['busy'] += 1
+        raise HashingBusy()
+    release = True
+    try:
+        with metrics.span('password_hash_seconds', op=fn.__name__.strip('_')):
+            pool = _get_pool()
+            if pool is None:
+                return fn(*args)
+            try:
+                future = pool.submit(fn, *args)
+                return future.result(PASSWORD_HASH_TIMEOUT_SECONDS)
+            except TimeoutError:
+                with _stats_lock:
+                    _stats['busy'] += 1
+                if not future.cancel():
+                    # Already hashing: keep its permit until the CPU work really ends, so
+                    # timed-out requests can't pile up work beyond PASSWORD_HASH_MAX_PENDING.
+                    release = False
+                    future.add_done_callback(lambda _: _pending.release())
+                raise HashingBusy() from None
+            except BrokenProcessPool:
+                _restart_pool(pool)
+                return fn(*args)
+    finally:
+        if release:
+            _pending.release()
+
+
+def _restart_pool(broken: ProcessPoolExecutor) -> None:
+    """A worker died (e.g. OOM-killed): replace the pool for later calls."""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = _new_pool()
+            with _stats_lock:
+                _stats['pool_restarts'] += 1
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def hash_password(password: str) -> str:
+    """Hash a new password with PASSWORD_HASH_METHOD. Raises HashingBusy when saturated."""
+    result = _run(_hash, password, PASSWORD_HASH_METHOD)
+    with _stats_lock:
+        _stats['hashes'] += 1
+    return result
+
+
+def verify(stored_hash: str, password: str) -> tuple[bool, str | None]:
+    """
+    Check password against stored_hash. Returns (ok, new_hash); new_hash is
+    set when the password matched but was hashed with other parameters, and
+    should be stored in place of the old one. Raises HashingBusy when saturated.
+    """
+    ok, new_hash = _run(_verify, stored_hash, password, PASSWORD_HASH_METHOD)
+    with _stats_lock:
+        _stats['checks'] += 1
+        _stats['upgrades'] += new_hash is not None
+    return ok, new_hash
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return {
+            'workers': PASSWORD_HASH_WORKERS if _pool is not None and _pool_pid == os.getpid() else 0,
+            'max_pending': PASSWORD_HASH_MAX_PENDING,
+            **_stats,
+        }
+
+
+metrics.register_gauges('password_hash', stats)
@@ -1,21 +1,189 @@
-"""Simple in-memory rate limiter for symptom analysis endpoints."""
+"""Rate limiter for symptom analysis endpoints (in-memory or shared SQLite backend)."""
 import os
+import sqlite3
+import threading
 import time
-from collections import defaultdict
-
-# Per-user (or per-IP) list of request timestamps; we prune older than window.
-_request_times: dict[str, list[float]] = defaultdict(list)
+from collections import OrderedDict
 
 # Default: 10 requests per minute per user. Set RATE_LIMIT_PER_MINUTE in .env to override.
 RATE_LIMIT_WINDOW_SECONDS = 60
 RATE_LIMIT_MAX_REQUESTS = int(os.getenv("RATE_LIMIT_PER_MINUTE", "10"))
+# "memory" (per process) or "sqlite" (shared by every worker on the host).
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").strip().lower() or "memory"
+# How often the shared backend sweeps out idle identifiers.
+RATE_LIMIT_EVICT_INTERVAL_SECONDS = 30
+# Sign-in attempts per minute per username and client address, a budget apart from analyses.
+LOGIN_RATE_LIMIT_MAX_REQUESTS = int(os.getenv("LOGIN_RATE_LIMIT_PER_MINUTE", "10"))
+
+
+class MemoryRateLimiter:
+    """
+    Sliding-window limiter for one process.
+
+    Each identifier keeps a fixed-size ring of its last max_requests
+    timestamps, so a check is O(1) and nothing is ever shifted. Identifiers
+    are kept in least-recently-seen order; idle ones (no request inside the
+    window) are dropped from the front as new requests arrive, so memory
+    tracks active users rather than every user ever seen.
+    """
+
+    def __init__(self, max_requests: int = RATE_LIMIT_MAX_REQUESTS,
+                 window_seconds: float = RATE_LIMIT_WINDOW_SECONDS):
+        self.max_requests = max(1, max_requests)
+        self.window_seconds = window_seconds
+        # identifier -> [next_slot, ts, ts, ...] (ring fills up to max_requests timestamps)
+        self._rings: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def check(self, identifier: str) -> tuple[bool, int | None]:
+        now = time.monotonic()
+        with self._lock:
+            # Amortized sweep: evicts faster than one new identifier per check can arrive.
+            self._checks += 1
+            if not self._checks & 31:
+                self._evict_idle(now)
+            ring = self._rings.get(identifier)
+            if ring is None:
+                self._rings[identifier] = [0, now]
+                return True, None
+            self._rings.move_to_end(identifier)
+
+            if len(ring) - 1 < self.max_requests:
+                ring.append(now)
+                return True, None
 
+            # Ring is full: its oldest slot is the max_requests-th most recent request.
+            slot = ring[0] + 1
+            oldest = ring[slot]
+            if oldest > now - self.window_seconds:
+                # Oldest in window is when one slot will free up
+                retry_after = max(1, int(oldest + self.window_seconds - now))
+                return False, retry_after
+            ring[slot] = now
+            ring[0] = (ring[0] + 1) % self.max_requests
+            return True, None
 
-def _prune(timestamps: list[float], window_secs: float) -> None:
-    """Drop timestamps older than window_secs from the list (mutates in place)."""
-    cutoff = time.monotonic() - window_secs
-    while timestamps and timestamps[0] < cutoff:
-        timestamps.pop(0)
+    def _newest(self, ring: list) -> float:
+        if len(ring) - 1 < self.max_requests:
+            return ring[-1]
+        return ring[(ring[0] - 1) % self.max_requests + 1]
+
+    def _evict_idle(self, now: float, limit: int = 64) -> None:
+        """Drop up to limit idle identifiers from the least-recently-seen end (caller holds the lock)."""
+        cutoff = now - self.window_seconds
+        for _ in range(limit):
+            if not self._rings:
+                return
+            identifier, ring = next(iter(self._rings.items()))
+            if self._newest(ring) >= cutoff:
+                return
+            del self._rings[identifier]
+
+    def tracked_identifiers(self) -> int:
+        with self._lock:
+            return len(self._rings)
+
+
+def _default_sqlite_path() -> str:
+    instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'instance')
+    os.makedirs(instance_path, exist_ok=True)
+    return os.path.join(instance_path, 'rate_limit.db')
+
+
+class SQLiteRateLimiter:
+    """
+    Sliding-window log stored in a SQLite file, so every gunicorn worker on
+    the host enforces one shared limit. Uses wall-clock time (comparable
+    across processes) and a write transaction per check.
+    """
+
+    def __init__(self, path: str | None = None, max_requests: int = RATE_LIMIT_MAX_REQUESTS,
+                 window_seconds: float = RATE_LIMIT_WINDOW_SECONDS,
+                 evict_interval: float = RATE_LIMIT_EVICT_INTERVAL_SECONDS):
+        self.path = path or _default_sqlite_path()
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.evict_interval = evict_interval
+        self._local = threading.local()
+        self._next_eviction = time.time() + evict_interval
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limit_hits (identifier TEXT NOT NULL, ts REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_limit_hits ON rate_limit_hits (identifier, ts)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def check(self, identifier: str) -> tuple[bool, int | None]:
+        now = time.time()
+        cutoff = now - self.window_seconds
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if now >= self._next_eviction:
+                # Idle identifiers: nothing inside the window for anyone.
+                conn.execute('DELETE FROM rate_limit_hits WHERE ts < ?', (cutoff,))
+                self._next_eviction = now + self.evict_interval
+            else:
+                conn.execute('DELETE FROM rate_limit_hits WHERE identifier = ? AND ts < ?', (identifier, cutoff))
+            count, oldest = conn.execute(
+                'SELECT COUNT(*), MIN(ts) FROM rate_limit_hits WHERE identifier = ?', (identifier,)
+            ).fetchone()
+            if count >= self.max_requests:
+                conn.execute('COMMIT')
+                return False, max(1, int(oldest + self.window_seconds - now))
+            conn.execute('INSERT INTO rate_limit_hits (identifier, ts) VALUES (?, ?)', (identifier, now))
+            conn.execute('COMMIT')
+            return True, None
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+
+_BACKENDS = {
+    'memory': MemoryRateLimiter,
+    'sqlite': SQLiteRateLimiter,
+}
+
+_limiter = None
+_login_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def create_limiter(max_requests: int = RATE_LIMIT_MAX_REQUESTS):
+    """
+    A new RATE_LIMIT_BACKEND limiter allowing max_requests per window, for a
+    budget kept apart from the analysis limit (give its identifiers their own prefix).
+    """
+    backend = _BACKENDS.get(RATE_LIMIT_BACKEND)
+    if backend is None:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND!r} (expected memory or sqlite)")
+    return backend(max_requests=max_requests)
+
+
+def get_limiter():
+    """The process-wide limiter for RATE_LIMIT_BACKEND (created on first use)."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = create_limiter()
+    return _limiter
+
+
+def set_limiter(limiter) -> None:
+    """Replace the process-wide limiter (any object with check(identifier))."""
+    global _limiter
+    with _limiter_lock:
+        _limiter = limiter
 
 
 def check_rate_limit(identifier: str) -> tuple[bool, int | None]:
@@ -24,14 +192,18 @@ def check_rate_limit(identifier: str) -> tuple[bool, int | None]:
     identifier: e.g. user_id from session or request.remote_addr.
     Returns (allowed, retry_after_seconds). retry_after_seconds is set when not allowed.
     """
-    now = time.monotonic()
-    timestamps = _request_times[identifier]
-    _prune(timestamps, RATE_LIMIT_WINDOW_SECONDS)
+    return get_limiter().check(identifier)
 
-    if len(timestamps) >= RATE_LIMIT_MAX_REQUESTS:
-        # Oldest in window is when one slot will free up
-        retry_after = max(1, int(timestamps[0] + RATE_LIMIT_WINDOW_SECONDS - now))
-        return False, retry_after
 
-    timestamps.append(now)
-    return True, None
+def check_login_rate_limit(username: str, client_addr: str | None) -> tuple[bool, int | None]:
+    """
+    check_rate_limit for a sign-in attempt. Keyed on the username and the
+    client's address together, so someone guessing a password cannot lock
+    the account's owner out from elsewhere.
+    """
+    global _login_limiter
+    if _login_limiter is None:
+        with _limiter_lock:
+            if _login_limiter is None:
+                _login_limiter = create_limiter(LOGIN_RATE_LIMIT_MAX_REQUESTS)
+    return _login_limiter.check(f'login:{username.lower()}:{client_addr}')
@@ -1,18 +1,32 @@
 """Flask routes for the Health Assistant application."""
 import json
+import threading
+import time
 from functools import wraps
 from flask import (
     Blueprint, render_template, request, redirect, url_for,
     session, jsonify, flash, Response, stream_with_context
 )
-from werkzeug.security import generate_password_hash, check_password_hash
 
+from backend import metrics
+from backend.admission import AdmissionRejected, admission
 from backend.database import (
     create_user, get_user_by_username, get_user_by_id,
-    save_profile, get_profile
+    get_user_with_profile, save_profile, get_profile, get_profile_with_context, update_password_hash
 )
-from backend.ai_service import analyze_symptoms, analyze_symptoms_stream, get_config_error
-from backend.rate_limit import check_rate_limit
+from backend.ai_service import (
+    analyze_in_background, analyze_symptoms, analyze_symptoms_stream, busy_message, get_config_error,
+    is_analysis_cached
+)
+from backend.batch import run_batch, validate_items
+from backend.emergency import is_emergency_text
+from backend.history import history_page, iter_history, record as record_history, record_stream
+from backend.jobs import JobLimitReached, create_job, get_job, parse_last_event_id, sse_events
+from backend.passwords import HashingBusy, hash_password, verify
+from backend.sections import parse_sections
+from backend.streaming import AnalysisStream, paced, requested_format
+from backend.triage import pre_triage, triage_response
+from backend.rate_limit import check_login_rate_limit, check_rate_limit
 
 
 # Blueprints
@@ -21,11 +35,19 @@ main_bp = Blueprint('main', __name__)
 api_bp = Blueprint('api', __name__)
 
 
+metrics.describe('app_phase_seconds', 'Time spent in request phases (session check, rate limit, profile lookup, ...).')
+metrics.describe('rate_limit_rejections_total', 'Requests rejected with 429 by the per-user rate limiter.')
+metrics.describe('sse_bytes_total', 'Bytes of SSE frames written to clients.')
+metrics.describe('sse_client_disconnects_total', 'SSE connections closed by the client mid-stream.')
+
+
 def login_required(f):
     """Decorator to require login for protected routes."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        with metrics.span('app_phase_seconds', phase='session_check'):
+            logged_in = 'user_id' in session
+        if not logged_in:
             return redirect(url_for('auth.login'))
         return f(*args, **kwargs)
     return decorated_function
@@ -33,6 +55,11 @@ def login_required(f):
 
 # ============ Auth Routes ============
 
+def _hashing_busy(template: str):
+    flash('Sign-in is very busy right now. Please try again in a moment.', 'danger')
+    return render_template(template), 503, {'Retry-After': '1'}
+
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page and handler."""
@@ -44,12 +71,25 @@ def login():
             flash('Please enter both username and password.', 'danger')
             return render_template('auth/login.html')
         
-        user = get_user_by_username(username)
-        if user and check_password_hash(user['password_hash'], password):
+        # Every attempt takes a slot before any hashing, so guessing a password costs no CPU past the limit
+        allowed, retry_after = check_login_rate_limit(username, request.remote_addr)
+        if not allowed:
+            metrics.inc('rate_limit_rejections_total', endpoint=request.endpoint)
+            flash(f'Too many sign-in attempts. Please try again in {retry_after} seconds.', 'danger')
+            return render_template('auth/login.html'), 429, {'Retry-After': str(retry_after)}
+
+        user = get_user_with_profile(username)
+        try:
+            ok, new_hash = verify(user['password_hash'], password) if user else (False, None)
+        except HashingBusy:
+            return _hashing_busy('auth/login.html')
+        if ok:
+            if new_hash:
+                update_password_hash(user['id'], new_hash)  # PASSWORD_HASH_METHOD changed since it was stored
             session['user_id'] = user['id']
             session['username'] = username
             # Redirect to profile if not complete, else dashboard
-            profile = get_profile(user['id'])
+            profile = user['profile']
             if not profile or not profile.get('name'):
                 return redirect(url_for('main.profile'))
             return redirect(url_for('main.dashboard'))
@@ -84,7 +124,11 @@ def register():
             return render_template('auth/register.html')
         
         try:
-            create_user(username, generate_password_hash(password))
+            password_hash = hash_password(password)
+        except HashingBusy:
+            return _hashing_busy('auth/register.html')
+        try:
+            create_user(username, password_hash)
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('auth.login'))
         except Exception:
@@ -108,6 +152,14 @@ def index():
     return render_template('index.html')
 
 
+@main_bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of in-process metrics (404 unless METRICS_ENABLED)."""
+    if not metrics.METRICS_ENABLED:
+        return 'Not Found', 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @main_bp.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
@@ -149,87 +201,245 @@ def dashboard():
 
 def _is_emergency(response_text: str) -> bool:
     """Check if response contains high-risk/emergency indicators."""
-    text = (response_text or "").lower()
-
-    # Strong explicit signals
-    if any(term in text for term in [
-        "call 911",
-        "call emergency",
-        "call an ambulance",
-        "go to the emergency",
-        "seek immediate medical attention",
-        "life-threatening",
-    ]):
-        return True
-
-    # Structured outputs: detect "Risk Level: High" or "Doctor Consultation: Urgent"
-    for line in text.splitlines():
-        line = line.strip()
-        if line.startswith("risk level"):
-            if "high" in line:
-                return True
-        if line.startswith("doctor consultation") or line.startswith("doctor needed"):
-            if "urgent" in line:
-                return True
-        if line.startswith("emergency warning"):
-            # Don't trigger just because the section exists.
-            parts = line.split(":", 1)
-            warning = (parts[1] if len(parts) == 2 else "").strip()
-            if warning and warning not in {"none", "no", "n/a", "na", "not applicable", "-"}:
-                return True
-
-    return False
+    with metrics.span('app_phase_seconds', phase='emergency_check'):
+        return is_emergency_text(response_text)
+
+
+def _admit(symptoms: str, medical_context: str, priority: bool):
+    """
+    (ticket, None) with a place in the upstream admission queue (see backend.admission),
+    (None, None) when the answer is cached, or (None, 503 response with Retry-After)
+    when the queue is full. Possible emergencies are never shed.
+    """
+    if admission.queue_full() and is_analysis_cached(symptoms, medical_context):
+        return None, None
+    try:
+        return admission.enter(priority), None
+    except AdmissionRejected as e:
+        return None, (jsonify({
+            'error': busy_message(e.retry_after),
+            'retry_after': e.retry_after,
+            'queue_depth': e.queue_depth,
+        }), 503, {'Retry-After': str(e.retry_after)})
 
 
 @api_bp.route('/analyze', methods=['POST'])
 @login_required
 def analyze():
-    """API endpoint for symptom analysis (non-streaming fallback)."""
+    """
+    API endpoint for symptom analysis (non-streaming fallback). Also returns the parsed sections.
+    Clear emergencies (local pre-triage) get a canned safety answer at once while the model
+    runs in the background; repeating the request returns the model's answer when it is ready.
+    """
     data = request.get_json()
     symptoms = data.get('symptoms', '').strip()
 
     if not symptoms:
         return jsonify({'error': 'Please describe your symptoms.'}), 400
+    started = time.monotonic()
+
+    with metrics.span('app_phase_seconds', phase='pre_triage'):
+        triage = pre_triage(symptoms)
 
     user_id = session['user_id']
-    allowed, retry_after = check_rate_limit(str(user_id))
+    with metrics.span('app_phase_seconds', phase='rate_limit'):
+        allowed, retry_after = check_rate_limit(str(user_id))
     if not allowed:
-        return jsonify({
-            'error': f'Too many requests. Please wait {retry_after} seconds and try again.'
-        }), 429, {'Retry-After': str(retry_after)}
+        metrics.inc('rate_limit_rejections_total', endpoint=request.endpoint)
+        if triage is None:
+            return jsonify({
+                'error': f'Too many requests. Please wait {retry_after} seconds and try again.'
+            }), 429, {'Retry-After': str(retry_after)}
 
     config_err = get_config_error()
-    if config_err:
+    if config_err and triage is None:
         return jsonify({
             'error': config_err
         }), 503
 
-    profile_data = get_profile(user_id)
-    profile_dict = dict(profile_data) if profile_data else None
-
-    response_text = analyze_symptoms(symptoms, profile_dict)
-    return jsonify({
+    with metrics.span('app_phase_seconds', phase='profile_lookup'):
+        profile_dict, medical_context = get_profile_with_context(user_id)
+
+    can_analyze = allowed and not config_err
+    if triage is not None and not (can_analyze and is_analysis_cached(symptoms, medical_context)):
+        # Safety first: never make an emergency wait on (or fail with) the upstream.
+        metrics.inc('pre_triage_hits_total', category=triage['category'])
+        if can_analyze:
+            analyze_in_background(symptoms, profile_dict, medical_context, priority=True)
+        response_text = triage_response(triage)
+        record_history(user_id, symptoms, medical_context, response_text, True, time.monotonic() - started,
+                       model='triage')
+        return jsonify({
+            'response': response_text,
+            'sections': parse_sections(response_text),
+            'is_emergency': True,
+            'triage': triage,
+            'analysis_pending': can_analyze
+        })
+
+    ticket, shed = _admit(symptoms, medical_context, triage is not None)
+    if shed is not None:
+        return shed
+
+    outcome = {}
+    response_text = analyze_symptoms(symptoms, profile_dict, medical_context, priority=triage is not None,
+                                     ticket=ticket, outcome=outcome)
+    payload = {
         'response': response_text,
-        'is_emergency': _is_emergency(response_text)
-    })
+        'sections': parse_sections(response_text),
+        'is_emergency': triage is not None or _is_emergency(response_text)
+    }
+    if triage is not None:
+        payload['triage'] = triage
+    if not outcome.get('error'):
+        record_history(user_id, symptoms, medical_context, response_text, payload['is_emergency'],
+                       time.monotonic() - started, model=outcome.get('model'))
+    return jsonify(payload)
 
 
 @api_bp.route('/analyze/stream', methods=['POST'])
 @login_required
 def analyze_stream():
-    """Streaming symptom analysis for faster time-to-first-token (~1-2s)."""
+    """
+    Streaming symptom analysis for faster time-to-first-token (~1-2s).
+    Send {"format": "sections"} for typed per-section events instead of raw deltas.
+    Clear emergencies (local pre-triage) get a {"triage": ...} event with a canned safety
+    answer before the model starts; it is still sent when rate limited or misconfigured.
+    """
     data = request.get_json()
     symptoms = data.get('symptoms', '').strip()
 
     if not symptoms:
         return jsonify({'error': 'Please describe your symptoms.'}), 400
+    started = time.monotonic()
+
+    with metrics.span('app_phase_seconds', phase='pre_triage'):
+        triage = pre_triage(symptoms)
 
     user_id = session['user_id']
-    allowed, retry_after = check_rate_limit(str(user_id))
+    with metrics.span('app_phase_seconds', phase='rate_limit'):
+        allowed, retry_after = check_rate_limit(str(user_id))
     if not allowed:
+        metrics.inc('rate_limit_rejections_total', endpoint=request.endpoint)
+        if triage is None:
+            return jsonify({
+                'error': f'Too many requests. Please wait {retry_after} seconds and try again.'
+            }), 429, {'Retry-After': str(retry_after)}
+
+    config_err = get_config_error()
+    if config_err and triage is None:
+        return jsonify({
+            'error': config_err
+        }), 503
+
+    with metrics.span('app_phase_seconds', phase='profile_lookup'):
+        profile_dict, medical_context = get_profile_with_context(user_id)
+
+    can_analyze = allowed and not config_err
+    ticket = None
+    if can_analyze:
+        # Queue for an upstream slot now, so a full queue is a 503 rather than an error inside the stream.
+        ticket, shed = _admit(symptoms, medical_context, triage is not None)
+        if shed is not None:
+            return shed
+
+    try:
+        job = create_job(user_id, priority=triage is not None)
+    except JobLimitReached as e:
+        if ticket is not None:
+            ticket.close()
         return jsonify({
-            'error': f'Too many requests. Please wait {retry_after} seconds and try again.'
-        }), 429, {'Retry-After': str(retry_after)}
+            'error': busy_message(e.retry_after),
+            'retry_after': e.retry_after,
+        }), 503, {'Retry-After': str(e.retry_after)}
+    encoder = AnalysisStream(requested_format(data))
+
+    def produce():
+        # Runs on its own thread so the analysis outlives a dropped connection (see backend.jobs).
+        parts = []
+        outcome = {}
+        try:
+            if triage is not None:
+                metrics.inc('pre_triage_hits_total', category=triage['category'])
+                job.publish(encoder.triage(triage, analysis_pending=can_analyze))
+                if not can_analyze:
+                    return
+            chunks = analyze_symptoms_stream(symptoms, profile_dict, medical_context,
+                                             cancel=job.cancellation, priority=triage is not None,
+                                             ticket=ticket, outcome=outcome)
+            # paced() also wakes when coalesced text has waited its full window (chunk is None).
+            for chunk in paced(chunks, encoder):
+                if chunk is not None:
+                    parts.append(chunk)
+                with metrics.span('app_phase_seconds', phase='sse_encode'):
+                    frames = encoder.encode_due() if chunk is None else encoder.encode(chunk)
+                if frames:
+                    job.publish(frames)
+        finally:
+            if not job.cancellation.cancelled:
+                job.publish(encoder.finish())
+            job.finish()
+            if not job.cancellation.cancelled:
+                record_stream(user_id, symptoms, medical_context, triage, ''.join(parts),
+                              time.monotonic() - started, outcome)
+
+    threading.Thread(target=produce, name='analysis-job', daemon=True).start()
+    return _job_response(job, 0)
+
+
+@api_bp.route('/analyze/stream/<job_id>', methods=['GET'])
+@login_required
+def resume_analyze_stream(job_id):
+    """
+    Reconnect to a running or recently finished analysis stream. Replays the
+    events after Last-Event-ID (header, or ?last_event_id=) and continues live.
+    """
+    job = get_job(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'This analysis has expired. Please send your symptoms again.'}), 404
+    after = parse_last_event_id(request.headers.get('Last-Event-ID', request.args.get('last_event_id')))
+    if after is None or not job.can_resume(after):
+        return jsonify({'error': 'This analysis can no longer be resumed. Please send your symptoms again.'}), 410
+    metrics.inc('analysis_job_resumes_total')
+    return _job_response(job, after)
+
+
+def _job_response(job, after_seq: int) -> Response:
+    """SSE response streaming job's events after after_seq."""
+    def generate():
+        sent = 0
+        try:
+            for frame in sse_events(job, after_seq):
+                sent += len(frame)
+                yield frame
+        except GeneratorExit:
+            # The WSGI server closes the response when a write fails (tab closed, fetch aborted).
+            metrics.inc('sse_client_disconnects_total')
+            raise
+        finally:
+            metrics.inc('sse_bytes_total', sent)
+            metrics.inc('sse_streams_total')
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'X-Analysis-Job': job.id}
+    )
+
+
+@api_bp.route('/analyze/batch', methods=['POST'])
+@login_required
+def analyze_batch():
+    """
+    Analyze many {"symptoms", "profile"} items concurrently. Streams NDJSON in
+    completion order: one {"index", "ok", ...} line per item, then {"done": true}.
+    Items without a profile use the logged-in user's profile.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('items') if isinstance(data, dict) else None
+    error = validate_items(items)
+    if error:
+        return jsonify({'error': error}), 400
 
     config_err = get_config_error()
     if config_err:
@@ -237,30 +447,56 @@ def analyze_stream():
             'error': config_err
         }), 503
 
-    profile_data = get_profile(user_id)
-    profile_dict = dict(profile_data) if profile_data else None
+    user_id = session['user_id']
+    with metrics.span('app_phase_seconds', phase='profile_lookup'):
+        profile_dict, medical_context = get_profile_with_context(user_id)
 
     def generate():
-        full_text = []
+        results = run_batch(items, profile_dict, medical_context, str(user_id))
         try:
-            for chunk in analyze_symptoms_stream(symptoms, profile_dict):
-                full_text.append(chunk)
-                # Send JSON SSE events so the frontend can append without adding extra newlines.
-                yield f"data: {json.dumps({'delta': chunk})}\n\n"
+            for result in results:
+                yield json.dumps(result) + '\n'
         finally:
-            done = json.dumps({
-                "done": True,
-                "is_emergency": _is_emergency(''.join(full_text))
-            })
-            yield f"data: {done}\n\n"
+            results.close()
 
     return Response(
         stream_with_context(generate()),
-        mimetype='text/event-stream',
+        mimetype='application/x-ndjson',
         headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
     )
 
 
+@api_bp.route('/history', methods=['GET'])
+@login_required
+def history():
+    """
+    The user's analyses, newest first, ?limit= at a time (at most 100). Pass
+    next_before back as ?before= for the next page; null means the last page.
+    Keyset pagination on (user_id, id), so deep pages cost the same as the first.
+    """
+    items, next_before = history_page(session['user_id'], request.args.get('before', type=int),
+                                      request.args.get('limit', 20, type=int))
+    return jsonify({'items': items, 'next_before': next_before})
+
+
+@api_bp.route('/history/export', methods=['GET'])
+@login_required
+def export_history():
+    """The user's whole history as NDJSON, newest first, one analysis per line."""
+    user_id = session['user_id']
+
+    def generate():
+        for row in iter_history(user_id):
+            yield json.dumps(row) + '\n'
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no',
+                 'Content-Disposition': 'attachment; filename="analysis-history.ndjson"'}
+    )
+
+
 @api_bp.route('/bmi', methods=['POST'])
 def calculate_bmi():
     """Calculate BMI from height and weight."""
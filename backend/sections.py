@@ -0,0 +1,191 @@
+"""Streaming parser for the 5-line analysis format requested by SYSTEM_PROMPT."""
+
+# (key, label) in the order SYSTEM_PROMPT asks for them
+SECTIONS = (
+    ('possible_condition', 'Possible Condition'),
+    ('risk_level', 'Risk Level'),
+    ('emergency_warning', 'Emergency Warning'),
+    ('self_care_advice', 'Self-Care Advice'),
+    ('doctor_consultation', 'Doctor Consultation'),
+)
+SECTION_KEYS = tuple(key for key, _ in SECTIONS)
+_LABELS = tuple((key, label.lower()) for key, label in SECTIONS)
+# Characters the model sometimes wraps labels in, despite "no markdown"
+_LABEL_DECORATION = ' \t*-#_'
+
+
+def _match_label(line_start: str, final: bool = False):
+    """
+    Classify the beginning of a line.
+    Returns (key, value_text) for a labelled line, False if it cannot be a
+    label, or None if more text is needed to decide.
+    """
+    text = line_start.lstrip(_LABEL_DECORATION).lower()
+    if not text:
+        return False if final else None
+    undecided = False
+    for key, label in _LABELS:
+        if text.startswith(label):
+            rest_start = len(line_start) - len(line_start.lstrip(_LABEL_DECORATION)) + len(label)
+            rest = line_start[rest_start:]
+            value = rest.lstrip(_LABEL_DECORATION)
+            if value.startswith(':'):
+                return key, value[1:]
+            if value or final:
+                # Tolerate a missing colon ("Risk Level - High"), as the dashboard always has.
+                return key, value
+            undecided = True
+        elif label.startswith(text):
+            undecided = True
+    if undecided and not final:
+        return None
+    return False
+
+
+class SectionParser:
+    """
+    Turns raw deltas into typed events:
+
+        {"type": "section_start", "section": key, "label": label}
+        {"type": "section_delta", "section": key, "text": "..."}
+        {"type": "section_end", "section": key}
+        {"type": "text", "text": "..."}      (text outside any section, e.g. error messages)
+
+    Only the start of the current line is buffered (until it is known whether
+    it carries a label); everything else is forwarded as it arrives.
+    """
+
+    def __init__(self):
+        self.current: str | None = None
+        self.completed: list[str] = []
+        self._pending = ""        # start of the current line while still undecided
+        self._at_line_start = True
+        self._section_has_text = False
+
+    def feed(self, delta: str) -> list[dict]:
+        events: list[dict] = []
+        while delta:
+            newline = delta.find("\n")
+            piece, delta = (delta, "") if newline < 0 else (delta[:newline], delta[newline + 1:])
+            self._consume(piece, events)
+            if newline >= 0:
+                self._end_line(events)
+        return events
+
+    def close(self) -> list[dict]:
+        """Flush the last line and end the open section."""
+        events: list[dict] = []
+        self._end_line(events, final=True)
+        self._end_section(events)
+        return events
+
+    # ---- internals ----
+
+    def _consume(self, piece: str, events: list[dict]) -> None:
+        if not piece:
+            return
+        if self._at_line_start:
+            self._pending += piece
+            self._decide(events, final=False)
+            return
+        self._emit_text(piece, events)
+
+    def _decide(self, events: list[dict], final: bool) -> None:
+        match = _match_label(self._pending, final=final)
+        if match is None:
+            return
+        pending, self._pending = self._pending, ""
+        self._at_line_start = False
+        if match is False:
+            if self.current is not None and self._section_has_text:
+                self._emit_text("\n", events)
+            self._emit_text(pending, events)
+            return
+        key, value = match
+        self._end_section(events)
+        self.current = key
+        self._section_has_text = False
+        events.append({"type": "section_start", "section": key, "label": dict(SECTIONS)[key]})
+        if value:
+            self._emit_text(value, events)
+
+    def _emit_text(self, text: str, events: list[dict]) -> None:
+        if self.current is not None and not self._section_has_text:
+            # Drop the space / closing "**" between a label and its value, however the deltas split it.
+            text = text.lstrip(_LABEL_DECORATION)
+            if not text:
+                return
+        if self.current is None:
+            events.append({"type": "text", "text": text})
+        else:
+            events.append({"type": "section_delta", "section": self.current, "text": text})
+        self._section_has_text = True
+
+    def _end_line(self, events: list[dict], final: bool = False) -> None:
+        if self._at_line_start and self._pending:
+            self._decide(events, final=True)
+        elif self.current is None and not self._at_line_start and not final:
+            # Keep line breaks in free text (multi-line error/preamble messages).
+            events.append({"type": "text", "text": "\n"})
+        self._at_line_start = True
+
+    def _end_section(self, events: list[dict]) -> None:
+        if self.current is not None:
+            events.append({"type": "section_end", "section": self.current})
+            self.completed.append(self.current)
+            self.current = None
+
+
+def parse_sections(text: str) -> dict:
+    """Parse a complete response into {section key: text or None}."""
+    parser = SectionParser()
+    parts: dict[str, list[str]] = {key: [] for key in SECTION_KEYS}
+    seen = set()
+    for event in parser.feed(text or "") + parser.close():
+        if event["type"] == "section_start":
+            seen.add(event["section"])
+        elif event["type"] == "section_delta":
+            parts[event["section"]].append(event["text"])
+    return {key: ("".join(parts[key]).strip() if key in seen else None) for key in SECTION_KEYS}
+
+
+class CompletionDetector:
+    """
+    Detects the end of a useful response: every section has been produced and
+    the line that completed the set has ended. Anything after that is filler.
+    """
+
+    def __init__(self):
+        self.seen: set[str] = set()
+        self.complete = False
+        self._line_parts: list[str] = []
+
+    def feed(self, delta: str) -> int | None:
+        """
+        Process a delta. Returns None while the response is incomplete, or the
+        number of leading characters of delta to keep once it completes.
+        """
+        if self.complete:
+            return 0
+        pos = 0
+        while True:
+            newline = delta.find("\n", pos)
+            if newline < 0:
+                self._line_parts.append(delta[pos:])
+                return None
+            self._line_parts.append(delta[pos:newline])
+            line = "".join(self._line_parts)
+            self._line_parts = []
+            match = _match_label(line, final=True)
+            if match:
+                self.seen.add(match[0])
+            if len(self.seen) == len(SECTIONS):
+                self.complete = True
+                return newline + 1
+            pos = newline + 1
+
+
+def trim_after_completion(text: str) -> str:
+    """Drop anything the model wrote after the last expected section line."""
+    keep = CompletionDetector().feed(text or "")
+    return text if keep is None else text[:keep]
@@ -0,0 +1,229 @@
+"""SSE encoding for /api/analyze/stream (shared by the Flask route and the ASGI handler)."""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+from backend.emergency import EmergencyDetector
+from backend.sections import SectionParser
+from backend.triage import triage_response
+
+# Stream formats a client can ask for with {"format": ...}
+STREAM_FORMATS = ('text', 'sections')
+# Deltas are merged into one frame until the first of them has waited this window
+# or this many characters are buffered (0 ms sends every delta as it comes).
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "30"))
+SSE_COALESCE_CHARS = int(os.getenv("SSE_COALESCE_CHARS", "256"))
+
+
+def sse_frame(payload: dict) -> str:
+    """One SSE event carrying a JSON payload."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+class DeltaCoalescer:
+    """
+    Merges small upstream deltas so each SSE frame carries more text. The
+    first delta passes straight through (TTFT is unchanged). After that, text
+    is released at the last newline, at max_chars, or once it has been held
+    for window seconds. feed() checks the window as deltas arrive; between
+    deltas the producer calls flush_due() when due_in() runs out, so a stall
+    upstream never holds text back for longer than the window.
+    """
+
+    def __init__(self, window: float = SSE_COALESCE_MS / 1000, max_chars: int = SSE_COALESCE_CHARS,
+                 clock=time.monotonic):
+        self.window = window
+        self.max_chars = max_chars
+        self.clock = clock
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_release: float | None = None
+        self._held_since = 0.0
+
+    def feed(self, delta: str) -> str:
+        """Text to send now ('' while buffering)."""
+        if self._last_release is None or self.window <= 0:
+            return self._release([delta])
+        if not self._parts:
+            self._held_since = self.clock()
+        self._parts.append(delta)
+        self._size += len(delta)
+        if self._size >= self.max_chars or self.clock() - self._held_since >= self.window:
+            return self.flush()
+        newline = delta.rfind("\n")
+        if newline >= 0:
+            # Complete lines go out now so per-line consumers stay responsive.
+            rest = delta[newline + 1:]
+            self._parts[-1] = delta[:newline + 1]
+            text = self._release(self._parts)
+            if rest:
+                self._parts, self._size = [rest], len(rest)
+                self._held_since = self._last_release
+            return text
+        return ''
+
+    def due_in(self) -> float | None:
+        """Seconds until buffered text must go out (None when nothing is buffered)."""
+        if not self._parts:
+            return None
+        return max(0.0, self._held_since + self.window - self.clock())
+
+    def flush_due(self) -> str:
+        """The buffered text if it has been held for the whole window, else ''."""
+        return self.flush() if self.due_in() == 0.0 else ''
+
+    def flush(self) -> str:
+        """Everything still buffered (end of stream)."""
+        return self._release(self._parts) if self._parts else ''
+
+    def _release(self, parts: list[str]) -> str:
+        self._parts, self._size = [], 0
+        self._last_release = self.clock()
+        return "".join(parts)
+
+
+class AnalysisStream:
+    """
+    Encodes analysis deltas as SSE frames.
+
+    format="text" sends {"delta": ...} per chunk (the original format);
+    format="sections" sends the typed section_start/section_delta/section_end
+    events from SectionParser instead. Both send {"emergency": true} as soon
+    as it is detected and finish with {"done": true, "is_emergency": ...}.
+    A local pre-triage match is sent first as {"triage": {...}}. Deltas go
+    through a DeltaCoalescer first, so one frame usually carries several.
+    """
+
+    def __init__(self, format: str = 'text', coalescer: DeltaCoalescer | None = None):
+        self.detector = EmergencyDetector()
+        self.parser = SectionParser() if format == 'sections' else None
+        self.coalescer = coalescer or DeltaCoalescer()
+
+    def encode(self, chunk: str) -> str:
+        """SSE frames for one upstream delta (empty while it is being coalesced or a section label is buffered)."""
+        text = self.coalescer.feed(chunk)
+        return self._encode(text) if text else ''
+
+    def due_in(self) -> float | None:
+        """Seconds until encode_due() has frames to send (None while nothing is held back)."""
+        return self.coalescer.due_in()
+
+    def encode_due(self) -> str:
+        """SSE frames for coalesced text whose window ran out with no new delta."""
+        text = self.coalescer.flush_due()
+        return self._encode(text) if text else ''
+
+    def _encode(self, chunk: str) -> str:
+        if self.parser is not None:
+            frames = ''.join(sse_frame(event) for event in self.parser.feed(chunk))
+        else:
+            # Send JSON SSE events so the frontend can append without adding extra newlines.
+            frames = sse_frame({'delta': chunk})
+        if self.detector.feed(chunk):
+            # Flag the emergency as soon as the line/phrase is complete, not after the last token.
+            frames += sse_frame({'emergency': True})
+        return frames
+
+    def triage(self, result: dict, analysis_pending: bool) -> str:
+        """
+        Opening frames for a local pre-triage match: the canned safety answer
+        and the emergency flag, sent before the model has produced anything.
+        """
+        self.detector.is_emergency = True  # later deltas must not re-send the flag
+        return sse_frame({
+            'triage': dict(result, message=triage_response(result), analysis_pending=analysis_pending)
+        }) + sse_frame({'emergency': True})
+
+    def finish(self) -> str:
+        """Closing frames: buffered text, trailing section events, a late emergency flag, and the done event."""
+        text = self.coalescer.flush()
+        frames = self._encode(text) if text else ''
+        if self.parser is not None:
+            frames += ''.join(sse_frame(event) for event in self.parser.close())
+        if self.detector.close():
+            frames += sse_frame({'emergency': True})
+        return frames + sse_frame({
+            "done": True,
+            "is_emergency": self.detector.is_emergency
+        })
+
+
+def requested_format(data) -> str:
+    """Stream format from the request JSON, defaulting to plain text deltas."""
+    fmt = data.get('format') if isinstance(data, dict) else None
+    return fmt if fmt in STREAM_FORMATS else 'text'
+
+
+_END = object()
+
+
+def paced(chunks, encoder: AnalysisStream):
+    """
+    Iterate chunks, yielding None whenever encoder.due_in() runs out before the
+    next chunk (time for encoder.encode_due()). The chunks are read on a thread
+    of their own; with coalescing off they are passed straight through.
+    """
+    if encoder.coalescer.window <= 0:
+        yield from chunks
+        return
+    deltas: queue.Queue = queue.Queue()
+    stop = threading.Event()
+
+    def read():
+        try:
+            for chunk in chunks:
+                deltas.put(chunk)
+                if stop.is_set():
+                    break
+        except BaseException as e:
+            deltas.put(e)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            deltas.put(_END)
+
+    threading.Thread(target=read, name='analysis-reader', daemon=True).start()
+    try:
+        while True:
+            try:
+                item = deltas.get(timeout=encoder.due_in())
+            except queue.Empty:
+                yield None
+                continue
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+async def paced_async(chunks, encoder: AnalysisStream):
+    """Async twin of paced(): the pending read is simply left running while waiting out the window."""
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(chunks.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=encoder.due_in())
+            if not done:
+                yield None
+                continue
+            try:
+                item = pending.result()
+            except StopAsyncIteration:
+                return
+            finally:
+                pending = None
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
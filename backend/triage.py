@@ -0,0 +1,129 @@
+"""
+Local emergency pre-triage over the user's symptom text.
+
+One precompiled regex covers every red-flag phrase, with a named group per
+category, so a message is scanned once in microseconds before any upstream
+call. A match preceded by a negation in the same clause ("no chest pain",
+"I don't have trouble breathing") or by "history of" is ignored. Named
+events (heart attack, stroke, choking) only count when described as
+happening now ("I'm having a heart attack", "signs of a stroke", "he is
+choking"), not as past or family history ("my father had a heart attack",
+"heat stroke").
+"""
+import re
+
+# category -> (label, possible condition, first-aid advice, phrase patterns)
+CATEGORIES = {
+    'chest_pain': (
+        'Chest pain',
+        'Possible heart attack or other serious heart problem',
+        'Stop what you are doing, sit down and stay with someone until help arrives.',
+        (
+            r"chest (?:pain|pressure|tightness|heaviness)",
+            r"(?:pain|pressure|tightness|heaviness) in (?:my |the )?chest",
+            r"crushing (?:pain|chest)",
+            r"having (?:a |what (?:feels|seems) like a )?heart attack",
+            r"(?:signs|symptoms) of (?:a )?heart attack",
+            r"heart attack (?:symptoms|signs)",
+            r"pain (?:radiating|spreading|going) (?:down |into |to )(?:my |the )?(?:left )?(?:arm|jaw)",
+        ),
+    ),
+    'stroke': (
+        'Stroke signs',
+        'Possible stroke',
+        'Note the time the symptoms started, do not eat or drink, and lie on your side if drowsy.',
+        (
+            r"(?:face|facial) (?:droop|drooping|is drooping)",
+            r"drooping (?:face|mouth|eyelid)",
+            r"slurred speech",
+            r"slurring (?:my )?(?:words|speech)",
+            r"(?:sudden )?(?:numbness|weakness|paralysis) (?:on|in) one side",
+            r"one side of (?:my |the |his |her )?(?:body|face)",
+            r"(?:can'?t|cannot|unable to) (?:move|feel) (?:my )?(?:arm|leg|face)",
+            r"having (?:a |what (?:feels|seems) like a )?stroke",
+            r"(?:signs|symptoms) of (?:a )?stroke",
+            r"(?<!heat )stroke (?:symptoms|signs)",
+            r"worst headache of (?:my|their|his|her) life",
+            r"sudden (?:loss of vision|vision loss|blindness)",
+        ),
+    ),
+    'severe_bleeding': (
+        'Severe bleeding',
+        'Possible serious bleeding',
+        'Press firmly on the wound with a clean cloth and keep pressing until help arrives.',
+        (
+            r"(?:severe|heavy|massive|uncontrolled|profuse) bleeding",
+            r"bleeding (?:heavily|a lot|badly|profusely)",
+            r"bleeding (?:that )?(?:won'?t|will not|does not|doesn'?t|can'?t|cannot) (?:stop|be stopped)",
+            r"(?:coughing|vomiting|throwing) up blood",
+            r"(?:spurting|gushing|pouring) blood",
+            r"blood (?:is )?(?:spurting|gushing|pouring)",
+        ),
+    ),
+    'breathing_difficulty': (
+        'Breathing difficulty',
+        'Possible breathing emergency',
+        'Sit upright, loosen tight clothing, and use your prescribed inhaler or epinephrine auto-injector if you have one.',
+        (
+            r"(?:can'?t|cannot|can not|unable to|struggling to|hard to) (?:breathe|catch (?:my|a) breath)",
+            r"(?:difficulty|trouble|problems?) breathing",
+            r"(?:severe|sudden|extreme) (?:shortness of breath|breathlessness)",
+            r"gasping for (?:air|breath)",
+            r"(?:i'?m|i am|is|are|he'?s|she'?s|they'?re|keeps?|started) (?:still )?choking",
+            r"lips (?:are |turning |turned )?(?:blue|purple)",
+            r"throat (?:is )?(?:closing|swelling shut|swelling up)",
+        ),
+    ),
+}
+
+_TRIAGE_RE = re.compile(
+    '|'.join(
+        rf"(?P<{key}>\b(?:{'|'.join(patterns)})\b)"
+        for key, (_, _, _, patterns) in CATEGORIES.items()
+    )
+)
+# A negation or "history of" close before the match (up to three words), within the same clause.
+_NEGATION_RE = re.compile(
+    r"\b(?:no|not|never|without|den(?:y|ies|ied)|free of|history of|(?:do|does|did|have|has|had|is|are|was|were)n't)\b"
+    r"(?:\W+\w+){0,3}\W*$"
+)
+# Commas break clauses too: "no fever, chest pain since noon" must still match.
+_CLAUSE_BREAK_RE = re.compile(r"[.,;!?\n]|\bbut\b|\bhowever\b|\balthough\b")
+_NEGATION_LOOKBACK = 60
+
+
+def _negated(text: str, start: int) -> bool:
+    prefix = text[max(0, start - _NEGATION_LOOKBACK):start]
+    last_break = None
+    for last_break in _CLAUSE_BREAK_RE.finditer(prefix):
+        pass
+    if last_break is not None:
+        prefix = prefix[last_break.end():]
+    return _NEGATION_RE.search(prefix) is not None
+
+
+def pre_triage(symptoms: str) -> dict | None:
+    """
+    {"category", "label", "matched"} for the first non-negated red flag in
+    the symptom text, or None when nothing clearly urgent is described.
+    """
+    text = (symptoms or '').lower().replace('’', "'")
+    for match in _TRIAGE_RE.finditer(text):
+        if _negated(text, match.start()):
+            continue
+        category = match.lastgroup
+        return {'category': category, 'label': CATEGORIES[category][0], 'matched': match.group()}
+    return None
+
+
+def triage_response(result: dict) -> str:
+    """Canned safety answer for a pre-triage match, in the usual five-line format."""
+    label, condition, advice, _ = CATEGORIES[result['category']]
+    return (
+        f"Possible Condition: {condition} ({label.lower()} reported)\n"
+        "Risk Level: High\n"
+        "Emergency Warning: Call your local emergency number (911/112) now or go to the nearest "
+        "emergency department. Do not drive yourself.\n"
+        f"Self-Care Advice: {advice}\n"
+        "Doctor Consultation: Urgent - seek emergency care immediately."
+    )
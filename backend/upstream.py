@@ -0,0 +1,440 @@
+"""
+Upstream backends (provider/model pairs) and hedged streaming across them.
+
+UPSTREAM_BACKENDS lists backends in preference order, comma separated:
+
+    model                       same provider/key as the default client
+    model@base_url              another OpenAI-compatible endpoint, default key
+    model@base_url#KEY_ENV      ...with the API key read from env var KEY_ENV
+
+e.g. "openai/gpt-4o-mini, meta-llama/llama-3.1-8b-instruct,
+gpt-4o-mini@https://api.openai.com/v1#OPENAI_API_KEY". Unset means a
+single backend running OPENAI_MODEL, which is never hedged (a second
+identical request to a slow provider only doubles its load).
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+
+from backend import metrics
+from backend.admission import admission
+from backend.circuit import CircuitBreaker, CircuitOpenError
+
+UPSTREAM_BACKENDS = os.getenv("UPSTREAM_BACKENDS", "").strip()
+# Start a second stream when the first token is later than the recent p95 TTFT.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "1").strip().lower() in {"1", "true", "yes", "on"}
+# Hedge deadline until enough TTFT samples exist, and the floor applied to the p95 afterwards.
+HEDGE_AFTER_SECONDS = float(os.getenv("HEDGE_AFTER_SECONDS", "3"))
+HEDGE_MIN_SECONDS = float(os.getenv("HEDGE_MIN_SECONDS", "0.5"))
+HEDGE_PERCENTILE = 95
+_TTFT_SAMPLES = 200
+_TTFT_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """Recent time-to-first-token samples for one backend (fixed ring)."""
+
+    def __init__(self, size: int = _TTFT_SAMPLES):
+        self._samples: list[float] = []
+        self._next = 0
+        self._size = size
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            if len(self._samples) < self._size:
+                self._samples.append(seconds)
+            else:
+                self._samples[self._next] = seconds
+                self._next = (self._next + 1) % self._size
+
+    def hedge_deadline(self) -> float:
+        """Seconds to wait for a first token before hedging."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < _TTFT_MIN_SAMPLES:
+            return HEDGE_AFTER_SECONDS
+        p95 = samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))]
+        return max(HEDGE_MIN_SECONDS, p95)
+
+
+class Backend:
+    """One provider/model pair. base_url/key_env of None mean the default client settings."""
+
+    def __init__(self, model: str, base_url: str | None = None, key_env: str | None = None):
+        self.model = model
+        self.base_url = base_url
+        self.key_env = key_env
+        self.name = model if base_url is None else f"{model}@{base_url}"
+        self.ttft = LatencyTracker()
+        self.breaker = CircuitBreaker(self.name)
+
+    def __repr__(self) -> str:
+        return f"Backend({self.name!r})"
+
+
+def parse_backends(spec: str, default_model: str) -> list[Backend]:
+    """Backends from an UPSTREAM_BACKENDS string (see module docstring)."""
+    backends = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        key_env = None
+        if "#" in entry:
+            entry, key_env = (part.strip() for part in entry.rsplit("#", 1))
+        model, _, base_url = (part.strip() for part in entry.partition("@"))
+        backends.append(Backend(model or default_model, base_url or None, key_env or None))
+    return backends or [Backend(default_model)]
+
+
+class Cancellation:
+    """Set from any thread to stop a hedged stream; wakes it at once instead of at its next token."""
+
+    def __init__(self):
+        self._callbacks: list = []
+        self._lock = threading.Lock()
+        self.cancelled = False
+
+    def on_cancel(self, callback) -> None:
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def _next_allowed(candidates: list[Backend]) -> Backend | None:
+    """Pop candidates until one whose breaker admits a request (skipped ones are dropped)."""
+    while candidates:
+        backend = candidates.pop(0)
+        if backend.breaker.allow():
+            return backend
+        metrics.inc('upstream_breaker_rejections_total', backend=backend.name)
+    return None
+
+
+class _Attempt:
+    """
+    One upstream stream running on its own thread, reporting into the shared
+    queue. A hedge holds an admission ticket of its own until it ends or wins.
+    """
+
+    def __init__(self, backend: Backend, hedge: bool, events: queue.Queue, ticket=None):
+        self.backend = backend
+        self.hedge = hedge
+        self.events = events
+        self.ticket = ticket
+        self.started = time.monotonic()
+        self.cancelled = threading.Event()
+        self._closers: list = []
+        self._closers_lock = threading.Lock()
+
+    def on_open(self, closer) -> None:
+        """Register a callable that aborts the underlying HTTP stream (used by cancel)."""
+        with self._closers_lock:
+            self._closers.append(closer)
+        if self.cancelled.is_set():
+            self._close()
+
+    def run(self, open_stream) -> None:
+        gen = open_stream(self.backend, self.on_open)
+        first = True
+        try:
+            for delta in gen:
+                if self.cancelled.is_set():
+                    return
+                if first:
+                    first = False
+                    self.backend.ttft.record(time.monotonic() - self.started)
+                self.events.put((self, 'delta', delta))
+            self.events.put((self, 'done', None))
+        except Exception as e:
+            if not self.cancelled.is_set():
+                self.events.put((self, 'error', e))
+        finally:
+            gen.close()
+            self.release()
+
+    def release(self) -> None:
+        """Give back the hedge's admission slot (no-op for the first attempt and failovers)."""
+        if self.ticket is not None:
+            self.ticket.close()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        self.release()
+        self._close()
+
+    def _close(self) -> None:
+        with self._closers_lock:
+            closers, self._closers = self._closers, []
+        for close in closers:
+            try:
+                close()
+            except Exception:
+                pass
+
+
+def hedged_stream(backends: list[Backend], open_stream, on_error=None, hedge: bool | None = None,
+                  cancel: Cancellation | None = None, on_win=None):
+    """
+    Yield the deltas of one successful upstream stream.
+
+    open_stream(backend, on_open) must return a generator of deltas for that
+    backend (raising on failure) and pass on_open a callable that aborts its
+    HTTP stream. The first backend starts immediately. If it has produced no
+    token by its hedge deadline, the next backend starts too, provided an
+    admission slot is free for it (the caller holds the first attempt's).
+    The first stream to produce a token wins and the others are cancelled.
+    Nothing from a losing stream is ever forwarded, so clients see no
+    duplicated deltas. A stream that fails before any output fails over to
+    the next unused backend. A backend is never tried twice, so with a single
+    backend there is no hedge and no failover. Errors go to
+    on_error(backend, exc), and the winning backend to on_win(backend). When
+    every attempt has failed, the last error is raised, and so is a failure
+    after output has started. Backends whose circuit breaker refuses are
+    skipped; CircuitOpenError if none admits one. Cancelling cancel ends the
+    stream (no error) and closes every HTTP stream.
+    """
+    hedge = HEDGE_ENABLED if hedge is None else hedge
+    # Unused backends, in order (hedges and failovers only ever go to another backend).
+    candidates = list(backends)
+    events: queue.Queue = queue.Queue()
+    attempts: list[_Attempt] = []
+    live: set[_Attempt] = set()
+    winner: _Attempt | None = None
+    hedged = False
+    last_error: Exception | None = None
+
+    def start(is_hedge: bool) -> bool:
+        ticket = None
+        if is_hedge:
+            ticket = admission.try_enter()
+            if ticket is None:
+                metrics.inc('upstream_hedges_skipped_total')
+                return False
+        backend = _next_allowed(candidates)
+        if backend is None:
+            if ticket is not None:
+                ticket.close()
+            return False
+        attempt = _Attempt(backend, is_hedge, events, ticket)
+        attempts.append(attempt)
+        live.add(attempt)
+        threading.Thread(target=attempt.run, args=(open_stream,), name='upstream-attempt', daemon=True).start()
+        return True
+
+    if not start(False):
+        raise CircuitOpenError(min(backend.breaker.retry_in() for backend in backends))
+    if cancel is not None:
+        cancel.on_cancel(lambda: events.put((None, 'cancel', None)))
+    try:
+        while True:
+            timeout = None
+            if winner is None and hedge and not hedged and candidates:
+                first = attempts[0]
+                timeout = max(0.0, first.started + first.backend.ttft.hedge_deadline() - time.monotonic())
+            try:
+                attempt, kind, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                hedged = True
+                if start(True):
+                    metrics.inc('upstream_hedges_total', backend=attempts[-1].backend.name)
+                continue
+
+            if kind == 'cancel':
+                return  # the reader went away; finally closes the upstream streams
+            if kind != 'delta':
+                live.discard(attempt)
+            if winner is None:
+                if kind == 'delta':
+                    winner = attempt
+                    attempt.backend.breaker.record_success()
+                    if on_win is not None:
+                        on_win(attempt.backend)
+                    metrics.inc('upstream_stream_wins_total', backend=attempt.backend.name,
+                                hedge='yes' if attempt.hedge else 'no')
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel()
+                    attempt.release()  # the losers are gone; the caller's slot covers the winner
+                    live.intersection_update({attempt})
+                elif kind == 'error':
+                    last_error = payload
+                    if on_error is not None:
+                        on_error(attempt.backend, payload)
+                    if live:
+                        continue  # the other stream is still running inside the caller's slot
+                    if start(False):
+                        metrics.inc('upstream_failovers_total', backend=attempts[-1].backend.name)
+                    else:
+                        raise last_error
+                    continue
+                elif not live:
+                    return  # finished without any text
+                else:
+                    continue
+
+            if attempt is not winner:
+                continue  # late output from a cancelled stream
+            if kind == 'delta':
+                yield payload
+            elif kind == 'done':
+                return
+            else:
+                if on_error is not None:
+                    on_error(attempt.backend, payload)
+                raise payload
+    finally:
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+        if winner is not None and winner in live:
+            winner.cancel()  # consumer stopped early (client gone / section set complete)
+
+
+class _AsyncAttempt:
+    """Async twin of _Attempt: one upstream stream as an asyncio task."""
+
+    def __init__(self, backend: Backend, hedge: bool, events: "asyncio.Queue", ticket=None):
+        self.backend = backend
+        self.hedge = hedge
+        self.events = events
+        self.ticket = ticket
+        self.started = time.monotonic()
+        self.task: "asyncio.Task | None" = None
+
+    async def run(self, open_stream) -> None:
+        gen = open_stream(self.backend)
+        first = True
+        try:
+            async for delta in gen:
+                if first:
+                    first = False
+                    self.backend.ttft.record(time.monotonic() - self.started)
+                self.events.put_nowait((self, 'delta', delta))
+            self.events.put_nowait((self, 'done', None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.events.put_nowait((self, 'error', e))
+        finally:
+            await gen.aclose()
+            self.release()
+
+    def release(self) -> None:
+        if self.ticket is not None:
+            self.ticket.close()
+
+    def cancel(self) -> None:
+        self.release()
+        # Cancelling the task unwinds the SDK's async stream, closing its HTTP response.
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+async def hedged_stream_async(backends: list[Backend], open_stream, on_error=None, hedge: bool | None = None,
+                              on_win=None):
+    """
+    Async counterpart of hedged_stream; open_stream(backend) returns an async
+    generator of deltas. Same hedging, failover and winner rules. To cancel,
+    close this generator (aclose): that cancels the attempt tasks.
+    """
+    hedge = HEDGE_ENABLED if hedge is None else hedge
+    # Unused backends, in order (hedges and failovers only ever go to another backend).
+    candidates = list(backends)
+    events: asyncio.Queue = asyncio.Queue()
+    attempts: list[_AsyncAttempt] = []
+    live: set[_AsyncAttempt] = set()
+    winner: _AsyncAttempt | None = None
+    hedged = False
+
+    def start(is_hedge: bool) -> bool:
+        ticket = None
+        if is_hedge:
+            ticket = admission.try_enter()
+            if ticket is None:
+                metrics.inc('upstream_hedges_skipped_total')
+                return False
+        backend = _next_allowed(candidates)
+        if backend is None:
+            if ticket is not None:
+                ticket.close()
+            return False
+        attempt = _AsyncAttempt(backend, is_hedge, events, ticket)
+        attempt.task = asyncio.get_running_loop().create_task(attempt.run(open_stream))
+        attempts.append(attempt)
+        live.add(attempt)
+        return True
+
+    if not start(False):
+        raise CircuitOpenError(min(backend.breaker.retry_in() for backend in backends))
+    try:
+        while True:
+            timeout = None
+            if winner is None and hedge and not hedged and candidates:
+                first = attempts[0]
+                timeout = max(0.0, first.started + first.backend.ttft.hedge_deadline() - time.monotonic())
+            try:
+                attempt, kind, payload = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                hedged = True
+                if start(True):
+                    metrics.inc('upstream_hedges_total', backend=attempts[-1].backend.name)
+                continue
+
+            if kind != 'delta':
+                live.discard(attempt)
+            if winner is None:
+                if kind == 'delta':
+                    winner = attempt
+                    attempt.backend.breaker.record_success()
+                    if on_win is not None:
+                        on_win(attempt.backend)
+                    metrics.inc('upstream_stream_wins_total', backend=attempt.backend.name,
+                                hedge='yes' if attempt.hedge else 'no')
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel()
+                    attempt.release()
+                    live.intersection_update({attempt})
+                elif kind == 'error':
+                    if on_error is not None:
+                        on_error(attempt.backend, payload)
+                    if live:
+                        continue  # the other stream is still running inside the caller's slot
+                    if start(False):
+                        metrics.inc('upstream_failovers_total', backend=attempts[-1].backend.name)
+                    else:
+                        raise payload
+                    continue
+                elif not live:
+                    return  # finished without any text
+                else:
+                    continue
+
+            if attempt is not winner:
+                continue  # late output from a cancelled stream
+            if kind == 'delta':
+                yield payload
+            elif kind == 'done':
+                return
+            else:
+                if on_error is not None:
+                    on_error(attempt.backend, payload)
+                raise payload
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
@@ -0,0 +1 @@
+"""Offline benchmarks for the Health Assistant backend. Run each with `python -m benchmarks.<name>`."""
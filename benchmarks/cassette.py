@@ -0,0 +1,98 @@
+"""
+Benchmark: record upstream traffic once, then replay it offline.
+
+    python -m benchmarks.cassette [--analyses 10] [--ttft 0.3] [--token-delay 0.03]
+
+Each mode is a fresh interpreter running the app in-process and streaming
+--analyses distinct symptom reports through /api/analyze/stream. The first
+run records against the fake upstream (UPSTREAM_CASSETTE_MODE=record); the
+others replay the cassette with no upstream at all, at original timing
+(UPSTREAM_CASSETTE_SPEED=1), 10x faster and with no delay (0). Reports
+TTFT and total latency per mode, and whether the replayed text matches the
+recorded run (frame boundaries aside).
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.fake_upstream import FakeUpstreamConfig, start_in_thread
+
+CHILD = r'''
+import hashlib, json, statistics, sys, time
+import backend.app
+analyses = int(sys.argv[1])
+client = backend.app.app.test_client()
+client.post('/auth/register', data={'username': 'bench', 'password': 'secret1', 'confirm_password': 'secret1'})
+client.post('/auth/login', data={'username': 'bench', 'password': 'secret1'})
+ttfts, totals, digest = [], [], hashlib.sha256()
+for i in range(analyses):
+    start = time.perf_counter()
+    resp = client.post('/api/analyze/stream', json={'symptoms': f'sore throat for {i + 1} days'}, buffered=False)
+    first, body = None, b''
+    for chunk in resp.response:
+        if first is None:
+            first = time.perf_counter() - start
+        body += chunk
+    ttfts.append(first)
+    totals.append(time.perf_counter() - start)
+    # The answer text, not the frames: event ids and coalescing vary with timing.
+    for line in body.decode().splitlines():
+        if line.startswith('data: '):
+            digest.update(json.loads(line[6:]).get('delta', '').encode())
+print(json.dumps({
+    'ttft_p50': statistics.median(ttfts),
+    'total_p50': statistics.median(totals),
+    'wall': sum(totals),
+    'digest': digest.hexdigest(),
+}))
+'''
+
+
+def run_once(cassette: str, analyses: int, **env_vars) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {k: v for k, v in os.environ.items() if k not in ('OPENAI_API_KEY', 'OPENAI_BASE_URL')}
+        env.update(
+            DATABASE_PATH=os.path.join(tmp, 'health_assistant.db'), UPSTREAM_CASSETTE=cassette,
+            OPENAI_MODEL='fake-model', UPSTREAM_WARMUP='0', PASSWORD_HASH_WORKERS='0', HEDGE_ENABLED='0',
+            SIMILAR_CACHE_SIZE='0', RATE_LIMIT_PER_MINUTE='1000000', **env_vars,
+        )
+        out = subprocess.run([sys.executable, '-c', CHILD, str(analyses)],
+                             env=env, capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--analyses', type=int, default=10)
+    parser.add_argument('--ttft', type=float, default=0.3)
+    parser.add_argument('--token-delay', type=float, default=0.03)
+    args = parser.parse_args()
+    server, url = start_in_thread(config=FakeUpstreamConfig(ttft=args.ttft, token_delay=args.token_delay))
+    with tempfile.TemporaryDirectory() as tmp:
+        cassette = os.path.join(tmp, 'upstream.jsonl')
+        modes = [('record (fake upstream)', dict(UPSTREAM_CASSETTE_MODE='record', OPENAI_BASE_URL=url,
+                                                 OPENAI_API_KEY='fake'))]
+        try:
+            results = [run_once(cassette, args.analyses, **modes[0][1])]
+        finally:
+            server.shutdown()
+        size = os.path.getsize(cassette)
+        with open(cassette, 'rb') as f:
+            recordings = sum(1 for _ in f)
+        print(f"{args.analyses} streamed analyses; cassette: {recordings} recordings, {size} bytes")
+        for speed in ('1', '10', '0'):
+            modes.append((f'replay, speed {speed}', dict(UPSTREAM_CASSETTE_MODE='replay',
+                                                         UPSTREAM_CASSETTE_SPEED=speed,
+                                                         UPSTREAM_CASSETTE_MISS='error')))
+            results.append(run_once(cassette, args.analyses, **modes[-1][1]))
+    print(f"{'mode':<26}{'TTFT p50 ms':>13}{'total p50 ms':>14}{'wall s':>9}  same output")
+    for (name, _), r in zip(modes, results):
+        same = 'yes' if r['digest'] == results[0]['digest'] else 'no'
+        print(f"{name:<26}{r['ttft_p50'] * 1000:13.1f}{r['total_p50'] * 1000:14.1f}{r['wall']:9.2f}  {same}")
+
+
+if __name__ == '__main__':
+    main()
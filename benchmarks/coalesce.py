@@ -0,0 +1,81 @@
+"""
+Check: requests coalesced onto an identical in-flight analysis take no admission capacity.
+
+    python -m benchmarks.coalesce [--followers 6] [--queue-max 2]
+
+Runs the analysis service in-process against the local fake upstream with
+UPSTREAM_MAX_CONCURRENCY=1 and ADMISSION_QUEUE_MAX=--queue-max. One
+streaming analysis takes the only slot; then --followers identical
+requests (JSON and streaming, alternately) each take a ticket the way the
+routes do and join its generation. Reports how many followers were refused
+for a full queue, the admission queue depth while they wait, and how many
+upstream generations ran. Exits non-zero if a follower was refused or
+still holds a place in the queue.
+"""
+import argparse
+import os
+import threading
+import time
+
+from benchmarks.fake_upstream import FakeUpstreamConfig, start_in_thread
+
+SYMPTOMS = 'dry cough and a mild fever for three days'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--followers', type=int, default=6)
+    parser.add_argument('--queue-max', type=int, default=2)
+    args = parser.parse_args()
+
+    server, base_url = start_in_thread(config=FakeUpstreamConfig(ttft=0.3, token_delay=0.02))
+    os.environ.update(OPENAI_BASE_URL=base_url, OPENAI_API_KEY='fake', OPENAI_MODEL='fake-model',
+                      UPSTREAM_MAX_CONCURRENCY='1', ADMISSION_QUEUE_MAX=str(args.queue_max),
+                      UPSTREAM_WARMUP='0', SIMILAR_CACHE_SIZE='0')
+    os.environ.pop('UPSTREAM_CASSETTE', None)
+    from backend import ai_service
+    from backend.admission import AdmissionRejected, admission
+
+    def stream(ticket) -> None:
+        for _ in ai_service.analyze_symptoms_stream(SYMPTOMS, None, '', ticket=ticket):
+            pass
+
+    def ask(ticket) -> None:
+        ai_service.analyze_symptoms(SYMPTOMS, None, '', ticket=ticket)
+
+    try:
+        threads = [threading.Thread(target=stream, args=(admission.enter(),))]
+        threads[0].start()
+        while not ai_service.single_flight_stats()['in_flight']:
+            time.sleep(0.005)
+        refused = 0
+        for i in range(args.followers):
+            try:
+                ticket = admission.enter()
+            except AdmissionRejected:
+                refused += 1
+                continue
+            thread = threading.Thread(target=stream if i % 2 else ask, args=(ticket,))
+            thread.start()
+            threads.append(thread)
+            # Arrivals one after another: each follower has joined before the next one asks for a ticket.
+            deadline = time.monotonic() + 2.0
+            while ai_service.single_flight_stats()['coalesced'] < len(threads) - 1 and time.monotonic() < deadline:
+                time.sleep(0.005)
+        waiting = admission.stats()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.shutdown()
+
+    print(f"{args.followers} identical followers, 1 upstream slot, queue max {args.queue_max}")
+    print(f"  refused (queue full)        {refused}")
+    print(f"  queue depth while joined    {waiting['queue_depth']}")
+    print(f"  slots active while joined   {waiting['active']}")
+    print(f"  upstream generations        {ai_service.single_flight_stats()['started']}")
+    if refused or waiting['queue_depth']:
+        raise SystemExit('coalesced requests held admission capacity')
+
+
+if __name__ == '__main__':
+    main()
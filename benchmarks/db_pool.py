@@ -0,0 +1,94 @@
+"""
+Micro-benchmark: per-call sqlite3.connect (old get_db) vs the pooled WAL layer.
+
+    python -m benchmarks.db_pool [--seconds 3] [--threads 4]
+
+Runs the login lookup (user then profile, vs the single joined query) against
+a throwaway database and prints queries per second for each variant.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from backend import database
+
+
+@contextmanager
+def _legacy_get_db(path: str):
+    """The pre-pool get_db: new connection (and makedirs) on every call."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _legacy_login_lookup(path: str, username: str) -> None:
+    with _legacy_get_db(path) as conn:
+        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    with _legacy_get_db(path) as conn:
+        conn.execute('SELECT * FROM profiles WHERE user_id = ?', (user['id'],)).fetchone()
+
+
+def _pooled_login_lookup(path: str, username: str) -> None:
+    database.get_user_with_profile(username)
+
+
+def _run(fn, path: str, usernames: list[str], seconds: float, threads: int) -> float:
+    counts = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(slot: int) -> None:
+        i = slot
+        while time.perf_counter() < deadline:
+            fn(path, usernames[i % len(usernames)])
+            i += threads
+            counts[slot] += 1
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        database.reset_pool(path)
+        database.init_db()
+        usernames = [f'user{i}' for i in range(args.users)]
+        for name in usernames:
+            user_id = database.create_user(name, 'x')
+            database.save_profile(user_id, {'name': name, 'age': 30})
+
+        legacy = _run(_legacy_login_lookup, path, usernames, args.seconds, args.threads)
+        pooled = _run(_pooled_login_lookup, path, usernames, args.seconds, args.threads)
+        database.reset_pool()
+
+    print(f"threads={args.threads} users={args.users} seconds={args.seconds}")
+    print(f"per-call connect, 2 queries : {legacy:10.0f} logins/s")
+    print(f"pooled WAL, joined query    : {pooled:10.0f} logins/s")
+    print(f"speed-up                    : {pooled / legacy:10.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Benchmark: upstream tokens avoided when clients abandon /api/analyze/stream.
+
+    python -m benchmarks.disconnect [--requests 20] [--read-events 3] [--server wsgi|asgi]
+
+Starts the local fake upstream (slow token pacing) and the app in a
+subprocess (threaded Werkzeug server or uvicorn), then opens streaming
+analyses and drops each connection after a few events, like a closed tab.
+Reports what the fake upstream actually sent versus the full answers, how
+many upstream streams it saw cancelled, and the app's own disconnect and
+cancellation counters from /metrics. The app runs with its default
+JOB_RESUME_GRACE_SECONDS, so a dropped stream is cancelled only after the
+reconnect window; the default token pacing makes each answer outlast it.
+Exits non-zero if a dropped stream kept generating to the end.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.fake_upstream import FakeUpstreamConfig, start_in_thread, tokenize
+
+SERVER_COMMANDS = {
+    'wsgi': "import logging; logging.getLogger('werkzeug').setLevel(logging.ERROR); "
+            "from werkzeug.serving import run_simple; from backend.app import app; "
+            "run_simple('127.0.0.1', {port}, app, threaded=True)",
+    'asgi': "import uvicorn; uvicorn.run('backend.asgi:app', host='127.0.0.1', port={port}, log_level='warning')",
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(base_url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(base_url + '/', timeout=10.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise SystemExit('app server did not start')
+
+
+def _metric(text: str, name: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(name + ' ') or line.startswith(name + '{'):
+            return float(line.rsplit(' ', 1)[1])
+    return 0.0
+
+
+def abandon_stream(client: httpx.Client, symptoms: str, read_events: int) -> int:
+    """Open a stream, read read_events SSE events, then drop the connection."""
+    events = 0
+    with client.stream('POST', '/api/analyze/stream', json={'symptoms': symptoms}) as resp:
+        for line in resp.iter_lines():
+            if line.startswith('data:'):
+                events += 1
+                if events >= read_events:
+                    break
+    return events  # leaving the block closes the socket mid-response
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--read-events', type=int, default=3)
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='wsgi')
+    parser.add_argument('--token-delay', type=float, default=0.1)
+    args = parser.parse_args()
+
+    config = FakeUpstreamConfig(ttft=0.2, token_delay=args.token_delay)
+    upstream, upstream_url = start_in_thread(config=config)
+    answer_tokens = len(tokenize(config.answer))
+    port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            OPENAI_BASE_URL=upstream_url, OPENAI_API_KEY='fake', OPENAI_MODEL='fake-model',
+            DATABASE_PATH=os.path.join(tmp, 'health_assistant.db'), METRICS_ENABLED='1',
+            RATE_LIMIT_PER_MINUTE='100000', HEDGE_ENABLED='0', SIMILAR_CACHE_SIZE='0',
+        )
+        server = subprocess.Popen([sys.executable, '-c', SERVER_COMMANDS[args.server].format(port=port)], env=env)
+        base_url = f'http://127.0.0.1:{port}'
+        try:
+            _wait_until_up(base_url)
+            client = httpx.Client(base_url=base_url, timeout=30.0)
+            client.post('/auth/register', data={'username': 'bench', 'password': 'secret1',
+                                                'confirm_password': 'secret1'})
+            resp = client.post('/auth/login', data={'username': 'bench', 'password': 'secret1'})
+            if resp.status_code != 302 or 'session' not in client.cookies:
+                raise SystemExit(f'login failed: HTTP {resp.status_code}')
+
+            start = time.perf_counter()
+            for i in range(args.requests):
+                abandon_stream(client, f'dull ache in my knee case{i}', args.read_events)
+            elapsed = time.perf_counter() - start
+            time.sleep(answer_tokens * args.token_delay + 0.5)  # let any uncancelled stream run out
+
+            stats = httpx.get(upstream_url[:-3] + '/stats').json()
+            app_metrics = client.get('/metrics').text
+        finally:
+            server.terminate()
+            server.wait()
+
+    full = args.requests * answer_tokens
+    print(f"server={args.server} abandoned streams={args.requests} after {args.read_events} events "
+          f"({elapsed / args.requests * 1000:.0f} ms each)")
+    print(f"upstream streams={stats['streams']} cancelled={stats['cancelled_streams']} "
+          f"completed={stats['completed_streams']}")
+    print(f"upstream tokens sent={stats['tokens_sent']} of {full} "
+          f"(avoided {stats['tokens_not_sent']}, {stats['tokens_not_sent'] / max(1, full):.0%})")
+    print(f"app: sse_client_disconnects_total={_metric(app_metrics, 'sse_client_disconnects_total'):.0f} "
+          f"analysis_jobs_abandoned_total={_metric(app_metrics, 'analysis_jobs_abandoned_total'):.0f} "
+          f"client_disconnect_cancelled_streams={_metric(app_metrics, 'client_disconnect_cancelled_streams'):.0f} "
+          f"client_disconnect_est_tokens_avoided={_metric(app_metrics, 'client_disconnect_est_tokens_avoided'):.0f}")
+    if stats['completed_streams']:
+        raise SystemExit(f"{stats['completed_streams']} abandoned stream(s) ran to completion upstream")
+
+
+if __name__ == '__main__':
+    main()
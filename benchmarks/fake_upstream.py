@@ -0,0 +1,341 @@
+"""
+Local OpenAI-compatible stand-in for the upstream model API.
+
+    python -m benchmarks.fake_upstream --port 8399 --token-delay 0.02 --ttft 0.3
+
+then start the app against it:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8399/v1 OPENAI_API_KEY=fake python run.py
+
+Serves POST /v1/responses and POST /v1/chat/completions, streaming or not,
+with a fixed five-line answer split into word tokens. Latency, failures and
+429s are configurable. GET /stats returns request/token/cancellation counters
+as JSON; POST /stats/reset clears them.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ANSWER = (
+    "Possible Condition: Likely a common viral infection such as a cold.\n"
+    "Risk Level: Low\n"
+    "Emergency Warning: None\n"
+    "Self-Care Advice: Rest, drink plenty of fluids and monitor your temperature.\n"
+    "Doctor Consultation: No, unless symptoms last more than a few days or get worse.\n"
+    "Additional notes: this trailing line is filler that the app should stop before."
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Split text into word-sized tokens that re-join to the original text."""
+    tokens, current = [], ""
+    for ch in text:
+        current += ch
+        if ch in " \n":
+            tokens.append(current)
+            current = ""
+    if current:
+        tokens.append(current)
+    return tokens
+
+
+class FakeUpstreamConfig:
+    def __init__(self, ttft: float = 0.2, token_delay: float = 0.02, fail_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: int = 2, answer: str = DEFAULT_ANSWER,
+                 connect_delay: float = 0.0):
+        self.ttft = ttft
+        # Extra delay before a new connection's first response (stands in for DNS + TLS to a remote API).
+        self.connect_delay = connect_delay
+        self.token_delay = token_delay
+        self.fail_rate = fail_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.answer = answer
+
+
+class FakeUpstreamStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = {
+                'requests': 0, 'streams': 0, 'completed_streams': 0, 'cancelled_streams': 0,
+                'tokens_sent': 0, 'tokens_not_sent': 0, 'rate_limited': 0, 'failed': 0,
+            }
+
+    def add(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+def _response_object(response_id: str, model: str, text: str, status: str) -> dict:
+    output = []
+    if status == 'completed':
+        output = [{
+            'id': 'msg_' + response_id, 'type': 'message', 'role': 'assistant', 'status': 'completed',
+            'content': [{'type': 'output_text', 'text': text, 'annotations': []}],
+        }]
+    return {
+        'id': response_id, 'object': 'response', 'created_at': int(time.time()), 'model': model,
+        'status': status, 'output': output, 'error': None, 'incomplete_details': None,
+        'instructions': None, 'metadata': {}, 'parallel_tool_calls': False, 'tool_choice': 'auto',
+        'tools': [], 'temperature': 0.2, 'top_p': 1.0,
+        'usage': {
+            'input_tokens': 100, 'output_tokens': len(tokenize(text)),
+            'total_tokens': 100 + len(tokenize(text)),
+            'input_tokens_details': {'cached_tokens': 0}, 'output_tokens_details': {'reasoning_tokens': 0},
+        } if status == 'completed' else None,
+    }
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeUpstream/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    config: FakeUpstreamConfig
+    stats: FakeUpstreamStats
+
+    def log_message(self, format, *args):  # quiet by default
+        pass
+
+    def setup(self):
+        super().setup()
+        if self.config.connect_delay:
+            time.sleep(self.config.connect_delay)
+
+    # ---- plumbing ----
+
+    def _send_json(self, status: int, payload: dict, headers: dict | None = None) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_sse(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+    def _sse(self, payload, event: str | None = None) -> None:
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        frame = (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+        self.wfile.write(frame.encode('utf-8'))
+        self.wfile.flush()
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return {}
+
+    def _inject_failure(self) -> bool:
+        """Maybe answer with a 429 or 500 instead of a completion."""
+        roll = random.random()
+        if roll < self.config.rate_limit_rate:
+            self.stats.add('rate_limited')
+            self._send_json(429, {'error': {
+                'message': 'Rate limit reached (injected by fake upstream)',
+                'type': 'rate_limit_error', 'code': 'rate_limit_exceeded',
+            }}, {'Retry-After': str(self.config.retry_after)})
+            return True
+        if roll < self.config.rate_limit_rate + self.config.fail_rate:
+            self.stats.add('failed')
+            self._send_json(500, {'error': {'message': 'Injected upstream failure', 'type': 'server_error'}})
+            return True
+        return False
+
+    def _stream_tokens(self, tokens: list[str], emit) -> bool:
+        """Send tokens with the configured pacing. False if the client went away."""
+        time.sleep(self.config.ttft)
+        for index, token in enumerate(tokens):
+            if index:
+                time.sleep(self.config.token_delay)
+            try:
+                emit(index, token)
+            except (BrokenPipeError, ConnectionResetError):
+                self.stats.add('cancelled_streams')
+                self.stats.add('tokens_not_sent', len(tokens) - index)
+                return False
+            self.stats.add('tokens_sent')
+        return True
+
+    # ---- routes ----
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.stats.snapshot())
+            return
+        if self.path.rstrip('/') in ('/v1/models', '/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'fake-model', 'object': 'model'}]})
+            return
+        self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        path = self.path.rstrip('/')
+        if path == '/stats/reset':
+            self.stats.reset()
+            self._send_json(200, {'ok': True})
+            return
+        body = self._read_json()
+        self.stats.add('requests')
+        if path.endswith('/responses'):
+            if not self._inject_failure():
+                self._responses(body)
+            return
+        if path.endswith('/chat/completions'):
+            if not self._inject_failure():
+                self._chat_completions(body)
+            return
+        self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+
+    def _responses(self, body: dict) -> None:
+        model = body.get('model', 'fake-model')
+        response_id = 'resp_' + uuid.uuid4().hex[:16]
+        text = self.config.answer
+        if not body.get('stream'):
+            time.sleep(self.config.ttft + self.config.token_delay * len(tokenize(text)))
+            self._send_json(200, _response_object(response_id, model, text, 'completed'))
+            return
+
+        self.stats.add('streams')
+        self._start_sse()
+        item_id = 'msg_' + response_id
+        seq = iter(range(1_000_000))
+        self._sse({'type': 'response.created', 'sequence_number': next(seq),
+                   'response': _response_object(response_id, model, text, 'in_progress')},
+                  'response.created')
+        self._sse({'type': 'response.output_item.added', 'sequence_number': next(seq), 'output_index': 0,
+                   'item': {'id': item_id, 'type': 'message', 'role': 'assistant',
+                            'status': 'in_progress', 'content': []}},
+                  'response.output_item.added')
+        self._sse({'type': 'response.content_part.added', 'sequence_number': next(seq), 'item_id': item_id,
+                   'output_index': 0, 'content_index': 0,
+                   'part': {'type': 'output_text', 'text': '', 'annotations': []}},
+                  'response.content_part.added')
+
+        def emit(_index, token):
+            self._sse({'type': 'response.output_text.delta', 'sequence_number': next(seq), 'item_id': item_id,
+                       'output_index': 0, 'content_index': 0, 'delta': token, 'logprobs': []},
+                      'response.output_text.delta')
+
+        if not self._stream_tokens(tokenize(text), emit):
+            return
+        try:
+            self._sse({'type': 'response.output_text.done', 'sequence_number': next(seq), 'item_id': item_id,
+                       'output_index': 0, 'content_index': 0, 'text': text, 'logprobs': []},
+                      'response.output_text.done')
+            self._sse({'type': 'response.content_part.done', 'sequence_number': next(seq), 'item_id': item_id,
+                       'output_index': 0, 'content_index': 0,
+                       'part': {'type': 'output_text', 'text': text, 'annotations': []}},
+                      'response.content_part.done')
+            completed = _response_object(response_id, model, text, 'completed')
+            self._sse({'type': 'response.output_item.done', 'sequence_number': next(seq), 'output_index': 0,
+                       'item': completed['output'][0]}, 'response.output_item.done')
+            self._sse({'type': 'response.completed', 'sequence_number': next(seq), 'response': completed},
+                      'response.completed')
+            self.stats.add('completed_streams')
+        except (BrokenPipeError, ConnectionResetError):
+            self.stats.add('cancelled_streams')
+
+    def _chat_completions(self, body: dict) -> None:
+        model = body.get('model', 'fake-model')
+        completion_id = 'chatcmpl-' + uuid.uuid4().hex[:16]
+        text = self.config.answer
+        created = int(time.time())
+        if not body.get('stream'):
+            time.sleep(self.config.ttft + self.config.token_delay * len(tokenize(text)))
+            self._send_json(200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': text}}],
+                'usage': {'prompt_tokens': 100, 'completion_tokens': len(tokenize(text)),
+                          'total_tokens': 100 + len(tokenize(text))},
+            })
+            return
+
+        self.stats.add('streams')
+        self._start_sse()
+
+        def chunk(delta: dict, finish_reason=None) -> dict:
+            return {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+        def emit(index, token):
+            delta = {'content': token}
+            if index == 0:
+                delta['role'] = 'assistant'
+            self._sse(chunk(delta))
+
+        if not self._stream_tokens(tokenize(text), emit):
+            return
+        try:
+            self._sse(chunk({}, 'stop'))
+            self._sse('[DONE]')
+            self.stats.add('completed_streams')
+        except (BrokenPipeError, ConnectionResetError):
+            self.stats.add('cancelled_streams')
+
+
+def make_server(host: str = '127.0.0.1', port: int = 8399, config: FakeUpstreamConfig | None = None):
+    """Build (but don't start) a fake upstream server. Handy for in-process tests and benchmarks."""
+    handler = type('BoundFakeUpstreamHandler', (FakeUpstreamHandler,), {
+        'config': config or FakeUpstreamConfig(),
+        'stats': FakeUpstreamStats(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(host: str = '127.0.0.1', port: int = 0, config: FakeUpstreamConfig | None = None):
+    """Start a fake upstream in a background thread. Returns (server, base_url)."""
+    server = make_server(host, port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible fake upstream')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8399)
+    parser.add_argument('--ttft', type=float, default=0.2, help='seconds before the first token')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='seconds between tokens')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction answered with 429')
+    parser.add_argument('--retry-after', type=int, default=2, help='Retry-After seconds on injected 429s')
+    parser.add_argument('--connect-delay', type=float, default=0.0,
+                        help='seconds added to each new connection (simulated DNS/TLS setup)')
+    args = parser.parse_args()
+
+    config = FakeUpstreamConfig(args.ttft, args.token_delay, args.fail_rate, args.rate_limit_rate, args.retry_after,
+                                connect_delay=args.connect_delay)
+    server = make_server(args.host, args.port, config)
+    print(f"Fake upstream on http://{args.host}:{args.port}/v1 "
+          f"(ttft={args.ttft}s, token_delay={args.token_delay}s, "
+          f"fail={args.fail_rate:.0%}, 429={args.rate_limit_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
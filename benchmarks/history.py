@@ -0,0 +1,119 @@
+"""
+Benchmark: analysis history writes and reads.
+
+    python -m benchmarks.history [--rows 1000000] [--users 1000] [--user-rows 100000] [--records 2000]
+
+Write path: the per-request cost of history.record() (queue append, batched
+write-behind) against a synchronous single-row insert and commit through
+get_db, and how long the write-behind takes to drain.
+Read path: fills a temporary database with --rows analyses, --user-rows of
+them for one heavy user and the rest spread over --users others, then times
+/api/history-style pages at the start and end of the heavy user's history
+(keyset on (user_id, id)) next to LIMIT/OFFSET, and a full NDJSON-style export.
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault('UPSTREAM_WARMUP', '0')
+
+from backend import database, history  # noqa: E402
+
+ROW_TIME = '2026-01-01 00:00:00'
+
+
+def _row(user_id: int, i: int) -> tuple:
+    return (user_id, f'mild headache case {i}', 'Possible Condition: tension headache. Rest and hydrate.',
+            0, 'fake-model', 900, 120, 40, ROW_TIME)
+
+
+def _timed(fn, repeat: int) -> float:
+    """Median milliseconds of fn() over repeat calls."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def bench_writes(records: int) -> None:
+    with database.get_db() as conn:
+        conn.execute("INSERT INTO users (username, password_hash) VALUES ('writer', 'x')")
+    start = time.perf_counter()
+    for i in range(records):
+        database.insert_analyses([_row(1, i)])
+    sync_us = (time.perf_counter() - start) / records * 1e6
+
+    start = time.perf_counter()
+    for i in range(records):
+        history.record(1, f'mild headache case {i}', '', 'Possible Condition: tension headache.', False, 0.9,
+                       model='fake-model')
+    record_us = (time.perf_counter() - start) / records * 1e6
+    history.writer.flush()
+    drain_ms = (time.perf_counter() - start) * 1000
+    stats = history.writer.stats()
+    print(f"write path, {records} analyses")
+    print(f"  synchronous insert + commit per request  {sync_us:8.1f} us/request")
+    print(f"  history.record() (write-behind)          {record_us:8.1f} us/request")
+    print(f"  all {stats['written']} rows committed after {drain_ms:.0f} ms in {stats['batches']} batch(es)")
+
+
+def bench_reads(rows: int, users: int, user_rows: int) -> None:
+    start = time.perf_counter()
+    with database.get_db() as conn:
+        conn.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                         ((f'user{u}', 'x') for u in range(users)))
+        first_user = conn.execute("SELECT MIN(id) FROM users WHERE username LIKE 'user%'").fetchone()[0]
+    rng = random.Random(0)
+    heavy = set(rng.sample(range(rows), min(user_rows, rows)))
+    batch = []
+    for i in range(rows):
+        batch.append(_row(first_user if i in heavy else first_user + 1 + rng.randrange(users - 1), i))
+        if len(batch) == 10000:
+            database.insert_analyses(batch)
+            batch = []
+    if batch:
+        database.insert_analyses(batch)
+    print(f"\nread path, {rows} rows over {users} users (loaded in {time.perf_counter() - start:.1f} s)")
+
+    user_id = first_user
+    ids = [row['id'] for row in history.iter_history(user_id)]
+    deep_before = ids[-21]
+
+    def offset_page(offset: int):
+        with database.get_db() as conn:
+            return conn.execute('SELECT * FROM analyses WHERE user_id = ? ORDER BY id DESC LIMIT 20 OFFSET ?',
+                                (user_id, offset)).fetchall()
+
+    print(f"  user with {len(ids)} analyses, 20 per page, median ms")
+    print(f"  keyset first page                        {_timed(lambda: history.history_page(user_id), 200):8.3f}")
+    print(f"  keyset last page                         "
+          f"{_timed(lambda: history.history_page(user_id, deep_before), 200):8.3f}")
+    print(f"  OFFSET middle page                       {_timed(lambda: offset_page(len(ids) // 2), 20):8.3f}")
+    print(f"  OFFSET last page                         {_timed(lambda: offset_page(len(ids) - 20), 20):8.3f}")
+    start = time.perf_counter()
+    exported = sum(1 for _ in history.iter_history(user_id))
+    print(f"  export: {exported} rows in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--user-rows', type=int, default=100_000)
+    parser.add_argument('--records', type=int, default=2000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        database.reset_pool(os.path.join(tmp, 'health_assistant.db'))
+        database.ensure_schema()
+        bench_writes(args.records)
+        bench_reads(args.rows, max(2, args.users), args.user_rows)
+        database.reset_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Load generator for /api/analyze/stream and /api/analyze.
+
+    python -m benchmarks.fake_upstream &                      # no API spend
+    OPENAI_BASE_URL=http://127.0.0.1:8399/v1 OPENAI_API_KEY=fake \
+        RATE_LIMIT_PER_MINUTE=100000 python run.py &
+    python -m benchmarks.loadgen --url http://127.0.0.1:5000 --users 20 \
+        --concurrency 20 --requests 400 --mode sse --server-pid <pid>
+
+Registers/logs in test users (one session per user), then drives concurrent
+analyses and reports time-to-first-token, total latency percentiles,
+requests/second and (with --server-pid) the server's resident memory.
+Symptoms get a unique suffix unless --repeat-symptoms is given, so the
+result cache does not hide upstream latency.
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+SYMPTOMS = [
+    "headache and fever since yesterday",
+    "sore throat and a runny nose",
+    "stomach ache after eating",
+    "dry cough for a week",
+    "mild back pain when standing up",
+]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def rss_mb(pid: int | None) -> float | None:
+    """Resident set size of pid in MB (Linux /proc), or None if unavailable."""
+    if not pid:
+        return None
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def login_users(base_url: str, count: int, prefix: str, timeout: float) -> list[httpx.Client]:
+    """Register (if needed) and log in count users; returns one cookie-carrying client each."""
+    clients = []
+    for i in range(count):
+        client = httpx.Client(base_url=base_url, timeout=timeout, follow_redirects=False)
+        username, password = f'{prefix}{i}', 'loadtest-password'
+        client.post('/auth/register', data={
+            'username': username, 'password': password, 'confirm_password': password,
+        })
+        resp = client.post('/auth/login', data={'username': username, 'password': password})
+        if resp.status_code != 302 or 'session' not in client.cookies:
+            raise SystemExit(f'login failed for {username}: HTTP {resp.status_code}')
+        client.post('/profile', data={'name': username, 'age': '35'})
+        clients.append(client)
+    return clients
+
+
+class Result:
+    __slots__ = ('ok', 'status', 'ttft', 'total', 'bytes', 'events', 'error')
+
+    def __init__(self):
+        self.ok = False
+        self.status = 0
+        self.ttft = None
+        self.total = 0.0
+        self.bytes = 0
+        self.events = 0
+        self.error = ''
+
+
+def run_sse(client: httpx.Client, symptoms: str, fmt: str) -> Result:
+    result = Result()
+    start = time.perf_counter()
+    try:
+        with client.stream('POST', '/api/analyze/stream', json={'symptoms': symptoms, 'format': fmt}) as resp:
+            result.status = resp.status_code
+            if resp.status_code != 200:
+                resp.read()
+                result.error = resp.text[:200]
+                return result
+            for line in resp.iter_lines():
+                result.bytes += len(line) + 1
+                if not line.startswith('data:'):
+                    continue
+                result.events += 1
+                payload = json.loads(line[5:].strip() or '{}')
+                if result.ttft is None and (payload.get('delta') or payload.get('text')):
+                    result.ttft = time.perf_counter() - start
+                if payload.get('done'):
+                    result.ok = True
+    except httpx.HTTPError as e:
+        result.error = repr(e)
+    finally:
+        result.total = time.perf_counter() - start
+    return result
+
+
+def run_json(client: httpx.Client, symptoms: str, _fmt: str) -> Result:
+    result = Result()
+    start = time.perf_counter()
+    try:
+        resp = client.post('/api/analyze', json={'symptoms': symptoms})
+        result.status = resp.status_code
+        result.bytes = len(resp.content)
+        result.ok = resp.status_code == 200
+        if not result.ok:
+            result.error = resp.text[:200]
+    except httpx.HTTPError as e:
+        result.error = repr(e)
+    result.total = result.ttft = time.perf_counter() - start
+    return result
+
+
+def report(results: list[Result], elapsed: float, rss_before, rss_peak) -> None:
+    ok = [r for r in results if r.ok]
+    ttfts = [r.ttft for r in ok if r.ttft is not None]
+    totals = [r.total for r in ok]
+    print(f"requests: {len(results)}  ok: {len(ok)}  failed: {len(results) - len(ok)}  "
+          f"elapsed: {elapsed:.2f}s  throughput: {len(results) / elapsed:.1f} req/s")
+    for label, values in (('TTFT', ttfts), ('total', totals)):
+        if values:
+            print(f"{label:>6} ms  p50 {percentile(values, 50) * 1000:8.1f}  p90 {percentile(values, 90) * 1000:8.1f}  "
+                  f"p99 {percentile(values, 99) * 1000:8.1f}  max {max(values) * 1000:8.1f}  "
+                  f"mean {statistics.fmean(values) * 1000:8.1f}")
+    if ok:
+        print(f"per response: {statistics.fmean(r.events for r in ok):.1f} SSE events, "
+              f"{statistics.fmean(r.bytes for r in ok):.0f} bytes")
+    statuses = {}
+    for r in results:
+        if not r.ok:
+            statuses[r.status or r.error[:40]] = statuses.get(r.status or r.error[:40], 0) + 1
+    if statuses:
+        print(f"failures by status: {statuses}")
+    if rss_before is not None:
+        print(f"server RSS: {rss_before:.1f} MB before, {rss_peak:.1f} MB peak")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load generator for the analysis endpoints')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--mode', choices=('sse', 'json'), default='sse')
+    parser.add_argument('--format', choices=('text', 'sections'), default='text', help='SSE stream format')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--repeat-symptoms', action='store_true', help='reuse identical symptom texts (cache hits)')
+    parser.add_argument('--server-pid', type=int, default=None, help='sample this PID\'s RSS during the run')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--user-prefix', default=f'load-{os.getpid()}-')
+    args = parser.parse_args()
+
+    clients = login_users(args.url, args.users, args.user_prefix, args.timeout)
+    runner = run_sse if args.mode == 'sse' else run_json
+    client_cycle = itertools.cycle(clients)
+    symptom_cycle = itertools.cycle(SYMPTOMS)
+    jobs = []
+    for _ in range(args.requests):
+        symptoms = next(symptom_cycle)
+        if not args.repeat_symptoms:
+            symptoms = f"{symptoms} ({uuid.uuid4().hex[:8]})"
+        jobs.append((next(client_cycle), symptoms))
+
+    rss_before = rss_mb(args.server_pid)
+    rss_peak = rss_before or 0.0
+    stop = threading.Event()
+
+    def sample_rss() -> None:
+        nonlocal rss_peak
+        while not stop.wait(0.2):
+            rss_peak = max(rss_peak, rss_mb(args.server_pid) or 0.0)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    if rss_before is not None:
+        sampler.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda job: runner(job[0], job[1], args.format), jobs))
+    elapsed = time.perf_counter() - start
+    stop.set()
+
+    print(f"mode={args.mode} format={args.format} users={args.users} concurrency={args.concurrency}")
+    report(results, elapsed, rss_before, rss_peak)
+    for client in clients:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark: login throughput, and how a login surge affects other requests.
+
+    python -m benchmarks.login [--logins 200] [--concurrency 8] [--method scrypt]
+
+Each mode is a fresh interpreter running the app in-process: --concurrency
+threads log in --logins times in total, while one more thread keeps
+fetching a cheap page (standing in for the requests a surge stalls).
+Reports logins/second, logins/second per core, login latency and the cheap
+page's latency, with hashing in the request threads (PASSWORD_HASH_WORKERS=0)
+and in the process pool. First checks that an app process started with
+multiprocessing spawn, as uvicorn --workers starts them, still hashes in its
+pool; exits non-zero if it hashes inline.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+
+CHILD = r'''
+import json, statistics, sys, threading, time
+import backend.app
+from backend.database import create_user
+from backend.passwords import hash_password
+logins, concurrency = int(sys.argv[1]), int(sys.argv[2])
+app = backend.app.app
+create_user('bench', hash_password('secret1'))
+remaining = iter(range(logins))
+lock = threading.Lock()
+login_times, probe_times = [], []
+done = threading.Event()
+
+def log_in():
+    client = app.test_client()
+    while True:
+        with lock:
+            if next(remaining, None) is None:
+                return
+        t0 = time.perf_counter()
+        resp = client.post('/auth/login', data={'username': 'bench', 'password': 'secret1'})
+        login_times.append(time.perf_counter() - t0)
+        assert resp.status_code == 302, resp.status_code
+
+def probe():
+    client = app.test_client()
+    while not done.is_set():
+        t0 = time.perf_counter()
+        client.get('/auth/login')
+        probe_times.append(time.perf_counter() - t0)
+        time.sleep(0.01)
+
+prober = threading.Thread(target=probe)
+prober.start()
+start = time.perf_counter()
+threads = [threading.Thread(target=log_in) for _ in range(concurrency)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+elapsed = time.perf_counter() - start
+done.set()
+prober.join()
+probe_times.sort()
+print(json.dumps({
+    'per_second': logins / elapsed,
+    'login_p50': statistics.median(login_times),
+    'probe_p50': statistics.median(probe_times),
+    'probe_p95': probe_times[int(len(probe_times) * 0.95)],
+}))
+'''
+
+
+def run_once(workers: int, method: str, logins: int, concurrency: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            PASSWORD_HASH_WORKERS=str(workers), PASSWORD_HASH_METHOD=method,
+            PASSWORD_HASH_MAX_PENDING=str(max(32, concurrency)),
+            DATABASE_PATH=os.path.join(tmp, 'health_assistant.db'),
+            RATE_LIMIT_PER_MINUTE='1000000', LOGIN_RATE_LIMIT_PER_MINUTE='1000000', UPSTREAM_WARMUP='0',
+        )
+        out = subprocess.run([sys.executable, '-c', CHILD, str(logins), str(concurrency)],
+                             env=env, capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _spawned_app_process(results) -> None:
+    """Runs in a spawned child: hash once and report whether the pool did it."""
+    from backend import passwords
+    passwords.hash_password('secret1')
+    results.put(passwords.stats()['workers'])
+
+
+def check_pool_in_spawned_process() -> None:
+    """Fail unless a process whose parent is a multiprocessing parent (uvicorn --workers) uses the pool."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    os.environ['PASSWORD_HASH_WORKERS'] = '1'  # spawn hands the child a copy of this environment
+    try:
+        child = context.Process(target=_spawned_app_process, args=(results,))
+        child.start()
+        workers = results.get(timeout=60)
+        child.join()
+    finally:
+        del os.environ['PASSWORD_HASH_WORKERS']
+    print(f"spawned app process (as under uvicorn --workers): pool workers={workers}")
+    if not workers:
+        raise SystemExit('a spawned app process hashed inline instead of in its pool')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--method', default='scrypt', help='PASSWORD_HASH_METHOD')
+    args = parser.parse_args()
+    check_pool_in_spawned_process()
+    cores = os.cpu_count() or 1
+    print(f"{args.logins} logins, {args.concurrency} concurrent, method {args.method}, {cores} core(s)")
+    print(f"{'mode':<26}{'logins/s':>10}{'per core':>10}{'login p50 ms':>14}"
+          f"{'page p50 ms':>13}{'page p95 ms':>13}")
+    for name, workers in (('PASSWORD_HASH_WORKERS=0', 0), (f'PASSWORD_HASH_WORKERS={cores}', cores)):
+        r = run_once(workers, args.method, args.logins, args.concurrency)
+        print(f"{name:<26}{r['per_second']:10.1f}{r['per_second'] / cores:10.1f}{r['login_p50'] * 1000:14.1f}"
+              f"{r['probe_p50'] * 1000:13.1f}{r['probe_p95'] * 1000:13.1f}")
+
+
+if __name__ == '__main__':
+    main()
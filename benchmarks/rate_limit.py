@@ -0,0 +1,92 @@
+"""
+Benchmark: the original list/defaultdict limiter vs the ring-buffer and SQLite backends.
+
+    python -m benchmarks.rate_limit [--identifiers 100000] [--rounds 3]
+
+Each round calls check() once for every identifier. Reports checks per second
+and traced memory, before and after idle eviction.
+"""
+import argparse
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+from backend.rate_limit import MemoryRateLimiter, SQLiteRateLimiter
+
+
+class LegacyRateLimiter:
+    """The pre-rework limiter: list.pop(0) pruning and a defaultdict that never forgets."""
+
+    def __init__(self, max_requests: int, window_seconds: float):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self._request_times = defaultdict(list)
+
+    def check(self, identifier: str):
+        now = time.monotonic()
+        timestamps = self._request_times[identifier]
+        cutoff = now - self.window_seconds
+        while timestamps and timestamps[0] < cutoff:
+            timestamps.pop(0)
+        if len(timestamps) >= self.max_requests:
+            return False, max(1, int(timestamps[0] + self.window_seconds - now))
+        timestamps.append(now)
+        return True, None
+
+
+def _measure(name: str, factory, identifiers: list[str], rounds: int) -> None:
+    """Throughput on one limiter, retained memory on a second (tracemalloc skews timing)."""
+    limiter = factory()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for ident in identifiers:
+            limiter.check(ident)
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    limiter = factory()
+    for ident in identifiers:
+        limiter.check(ident)
+    current, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    checks = rounds * len(identifiers)
+    print(f"{name:<28} {checks / elapsed:12.0f} checks/s   {current / 1e6:8.1f} MB for {len(identifiers)} ids")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--identifiers', type=int, default=100_000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--sqlite-identifiers', type=int, default=10_000,
+                        help='SQLite does a write transaction per check; keep this smaller')
+    args = parser.parse_args()
+    identifiers = [f'user-{i}' for i in range(args.identifiers)]
+
+    print(f"identifiers={args.identifiers} rounds={args.rounds} window=60s")
+    _measure('legacy list + defaultdict', lambda: LegacyRateLimiter(10, 60), identifiers, args.rounds)
+    _measure('ring + idle eviction', lambda: MemoryRateLimiter(10, 60), identifiers, args.rounds)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'rate_limit.db')
+        _measure('sqlite (shared)', lambda: SQLiteRateLimiter(path, 10, 60),
+                 identifiers[:args.sqlite_identifiers], 1)
+
+    # Idle eviction: every identifier goes quiet, then ordinary traffic from a few users continues.
+    window = 0.2
+    legacy, memory = LegacyRateLimiter(10, window), MemoryRateLimiter(10, window)
+    for ident in identifiers:
+        legacy.check(ident)
+        memory.check(ident)
+    time.sleep(window * 1.5)
+    for i in range(args.identifiers // 2 + 1):
+        legacy.check(f'active-{i % 100}')
+        memory.check(f'active-{i % 100}')
+    print(f"identifiers still tracked after going idle: legacy={len(legacy._request_times)} "
+          f"ring={memory.tracked_identifiers()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark: near-duplicate symptom lookups in cache.SimilarityIndex.
+
+    python -m benchmarks.similar_cache [--entries 1000000] [--lookups 20000]
+
+Fills an index with synthetic symptom texts spread over many profile
+contexts, then times lookups of reworded near-duplicates (hits) and of
+unrelated texts (misses), plus insert cost, eviction and resident memory.
+"""
+import argparse
+import random
+import time
+
+from backend.cache import SimilarityIndex
+
+WORDS = (
+    "headache fever cough sore throat runny nose nausea vomiting diarrhea rash itching dizziness fatigue "
+    "back pain stomach ache chills sweating sneezing congestion earache toothache swelling bruise cramps "
+    "insomnia anxiety wheezing heartburn bloating constipation joint stiffness muscle weakness numbness "
+    "tingling blurred vision dry eyes nosebleed hoarse voice"
+).split()
+TIMING = ["since yesterday", "for two days", "for a week", "since this morning", "on and off", "at night",
+          "after eating", "when standing", "getting worse", "mild", "severe", "sudden"]
+LINKERS = [" and ", " + ", ", ", " with "]
+
+
+def _symptom_text(rng: random.Random) -> tuple[list[str], str]:
+    words = rng.sample(WORDS, rng.randint(2, 4)) + [f"day{rng.randint(1, 400)}"]
+    return words, rng.choice(LINKERS).join(words) + " " + rng.choice(TIMING)
+
+
+def _reworded(words: list[str], timing: str, rng: random.Random) -> str:
+    shuffled = words[:]
+    rng.shuffle(shuffled)
+    return rng.choice(LINKERS).join(shuffled) + " " + timing
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    parser.add_argument('--contexts', type=int, default=5_000)
+    parser.add_argument('--lookups', type=int, default=20_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    contexts = [f"context-{i:064d}" for i in range(args.contexts)]
+
+    index = SimilarityIndex(max_entries=args.entries)
+    rss_before = rss_mb()
+    samples = []
+    start = time.perf_counter()
+    for i in range(args.entries):
+        words, text = _symptom_text(rng)
+        context = rng.choice(contexts)
+        index.add(text, context, i)
+        if len(samples) < args.lookups:
+            samples.append((words, text.rsplit(" ", 2)[-2:], context, i))
+    add_elapsed = time.perf_counter() - start
+    print(f"entries={len(index)} contexts={args.contexts} buckets={index.stats()['buckets']} "
+          f"insert {add_elapsed / args.entries * 1e6:.1f} us/entry  RSS +{rss_mb() - rss_before:.0f} MB")
+
+    hits = 0
+    start = time.perf_counter()
+    for words, timing, context, value in samples:
+        if value in index.lookup(_reworded(words, " ".join(timing), rng), context):
+            hits += 1
+    hit_elapsed = time.perf_counter() - start
+
+    misses = [(_symptom_text(rng)[1] + " unrelated", rng.choice(contexts)) for _ in range(args.lookups)]
+    start = time.perf_counter()
+    false_hits = sum(1 for text, context in misses if index.lookup(text, context))
+    miss_elapsed = time.perf_counter() - start
+
+    print(f"near-duplicate lookups  {hit_elapsed / len(samples) * 1e6:7.1f} us each   recall {hits / len(samples):.1%}")
+    print(f"unrelated lookups       {miss_elapsed / len(misses) * 1e6:7.1f} us each   false matches {false_hits}")
+
+    # Bounded memory: keep inserting past capacity; size stays at max_entries.
+    for i in range(args.entries // 10):
+        index.add(_symptom_text(rng)[1], rng.choice(contexts), -i)
+    print(f"after {args.entries // 10} more inserts: size={len(index)} buckets={index.stats()['buckets']}")
+
+
+if __name__ == '__main__':
+    main()
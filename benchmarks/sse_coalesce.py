@@ -0,0 +1,116 @@
+"""
+Benchmark: SSE frames, bytes and CPU per streamed analysis, with and without delta coalescing.
+
+    python -m benchmarks.sse_coalesce [--responses 2000] [--seed 1]
+
+Replays synthetic upstream streams (the fake upstream's answer cut into
+1-4 character deltas, 5-35 ms apart on a simulated clock) through
+streaming.AnalysisStream in both stream formats. Reports frames, bytes and
+encode CPU per response, plus the extra delay coalescing adds to text
+(first delta is never delayed). Like the app's producers, held text is
+flushed as soon as its window runs out, even when no delta arrives.
+"""
+import argparse
+import random
+import time
+
+from backend.streaming import AnalysisStream, DeltaCoalescer
+from benchmarks.fake_upstream import DEFAULT_ANSWER
+
+ANSWER = DEFAULT_ANSWER.rsplit("\n", 1)[0] + "\n"  # the app stops before the filler line
+
+
+def synthetic_stream(rng: random.Random) -> list[tuple[float, str]]:
+    """(arrival time, delta) pairs: small deltas with jittered gaps."""
+    deltas, at, i = [], 0.0, 0
+    while i < len(ANSWER):
+        size = rng.choice((1, 1, 2, 2, 2, 3, 4))
+        at += rng.uniform(0.005, 0.035)
+        deltas.append((at, ANSWER[i:i + size]))
+        i += size
+    return deltas
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def run(streams: list[list[tuple[float, str]]], fmt: str, window_ms: float, max_chars: int) -> dict:
+    frames = sent = 0
+    cpu = 0.0
+    for deltas in streams:
+        clock = SimClock()
+        encoder = AnalysisStream(fmt, DeltaCoalescer(window_ms / 1000, max_chars, clock))
+        start = time.process_time()
+        for at, delta in deltas:
+            due = encoder.due_in()
+            if due is not None and clock.now + due <= at:
+                clock.now += due
+                out = encoder.encode_due()
+                frames += out.count("\n\n")
+                sent += len(out)
+            clock.now = at
+            out = encoder.encode(delta)
+            frames += out.count("\n\n")
+            sent += len(out)
+        out = encoder.finish()
+        cpu += time.process_time() - start
+        frames += out.count("\n\n")
+        sent += len(out)
+
+    # Separate pass for added latency: how long each character waited in the buffer.
+    waited = waited_max = 0.0
+    for deltas in streams:
+        clock = SimClock()
+        coalescer = DeltaCoalescer(window_ms / 1000, max_chars, clock)
+        pending: list[float] = []
+        for at, delta in deltas:
+            due = coalescer.due_in()
+            if due is not None and clock.now + due <= at:
+                clock.now += due
+                released = len(coalescer.flush_due())
+                for arrived in pending[:released]:
+                    waited += clock.now - arrived
+                    waited_max = max(waited_max, clock.now - arrived)
+                del pending[:released]
+            clock.now = at
+            pending.extend([at] * len(delta))
+            released = len(coalescer.feed(delta))
+            for arrived in pending[:released]:
+                waited += at - arrived
+                waited_max = max(waited_max, at - arrived)
+            del pending[:released]
+    count = len(streams)
+    return {
+        'frames': frames / count,
+        'bytes': sent / count,
+        'cpu_us': cpu / count * 1e6,
+        'avg_delay_ms': waited / (count * len(ANSWER)) * 1000,
+        'max_delay_ms': waited_max * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--responses', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    streams = [synthetic_stream(rng) for _ in range(args.responses)]
+    print(f"responses={args.responses} deltas/response={sum(map(len, streams)) / len(streams):.0f} "
+          f"chars/response={len(ANSWER)}")
+    print(f"{'format':<10}{'coalescing':<20}{'frames':>10}{'bytes':>10}{'cpu us':>10}{'avg delay ms':>15}{'max delay ms':>15}")
+    for fmt in ('text', 'sections'):
+        for label, window_ms, max_chars in (('off', 0, 0), ('30 ms / 256 chars', 30, 256),
+                                            ('60 ms / 256 chars', 60, 256)):
+            r = run(streams, fmt, window_ms, max_chars)
+            print(f"{fmt:<10}{label:<20}{r['frames']:10.1f}{r['bytes']:10.0f}{r['cpu_us']:10.1f}"
+                  f"{r['avg_delay_ms']:15.1f}{r['max_delay_ms']:15.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark: cold-start cost of the WSGI app (what a serverless instance pays).
+
+    python -m benchmarks.startup [--runs 5]
+
+Each run is a fresh interpreter that imports backend.app, serves its first
+page, then logs in and makes its first analysis against the local fake
+upstream (which triggers the lazy openai import). Runs with LAZY_INIT off
+and on, and with the openai SDK imported up front for comparison with the
+old eager import. Uses a throwaway database per run.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.fake_upstream import FakeUpstreamConfig, start_in_thread
+
+CHILD = r'''
+import json, time
+t0 = time.perf_counter()
+if PRELOAD_SDK:
+    import openai
+import backend.app
+t1 = time.perf_counter()
+client = backend.app.app.test_client()
+client.get('/')
+t2 = time.perf_counter()
+client.post('/auth/register', data={'username': 'u', 'password': 'secret1', 'confirm_password': 'secret1'})
+client.post('/auth/login', data={'username': 'u', 'password': 'secret1'})
+t3 = time.perf_counter()
+client.post('/api/analyze', json={'symptoms': 'mild headache'})
+t4 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first_page': t2 - t1, 'first_analysis': t4 - t3, 'total': t4 - t0}))
+'''
+
+FIELDS = ('import', 'first_page', 'first_analysis', 'total')
+
+
+def run_once(base_url: str, lazy: bool, preload_sdk: bool) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            LAZY_INIT='1' if lazy else '0',
+            DATABASE_PATH=os.path.join(tmp, 'health_assistant.db'),
+            OPENAI_BASE_URL=base_url, OPENAI_API_KEY='fake', OPENAI_MODEL='fake-model',
+        )
+        code = f"PRELOAD_SDK = {preload_sdk}\n" + CHILD
+        out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    server, base_url = start_in_thread(config=FakeUpstreamConfig(ttft=0.0, token_delay=0.0))
+    try:
+        print(f"median of {args.runs} runs, milliseconds")
+        print(f"{'mode':<28}" + ''.join(f"{field:>16}" for field in FIELDS))
+        for name, lazy, preload in (('eager openai import', False, True),
+                                    ('LAZY_INIT=0', False, False),
+                                    ('LAZY_INIT=1', True, False)):
+            runs = [run_once(base_url, lazy, preload) for _ in range(args.runs)]
+            print(f"{name:<28}" + ''.join(
+                f"{statistics.median(r[field] for r in runs) * 1000:16.1f}" for field in FIELDS
+            ))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
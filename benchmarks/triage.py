@@ -0,0 +1,104 @@
+"""
+Benchmark: local emergency pre-triage over a large synthetic symptom corpus.
+
+    python -m benchmarks.triage [--texts 200000] [--seed 1]
+
+Compares the single compiled regex in backend.triage with a naive loop over
+one compiled pattern per phrase, and reports per-message latency and the
+share of messages flagged (corpus mixes routine, negated, past/family
+history and urgent texts). Also checks that pre-triage flags every urgent
+text and none of the negated or history ones.
+"""
+import argparse
+import random
+import re
+import time
+
+from backend.triage import CATEGORIES, _negated, pre_triage
+
+ROUTINE = [
+    "headache and fever since yesterday",
+    "sore throat and a runny nose for three days",
+    "stomach ache after eating spicy food",
+    "dry cough for a week, worse at night",
+    "mild back pain when standing up",
+    "itchy rash on my forearm",
+    "feeling tired all the time and sleeping badly",
+    "ear pain and a bit of dizziness",
+]
+NEGATED = [
+    "no chest pain, just a cough",
+    "I don't have trouble breathing but my nose is blocked",
+    "denies chest pain or shortness of breath",
+    "not coughing up blood, only clear phlegm",
+]
+# Red-flag words that describe history, another person's past, or something milder: never urgent.
+HISTORY = [
+    "my father had a heart attack last year; I have a cold",
+    "I think I got heat stroke",
+    "history of stroke, now mild cough",
+    "family history of heart attack, mild cough",
+    "my son choked on a grape yesterday, fine now",
+]
+URGENT = [
+    "sudden crushing chest pain spreading to my left arm",
+    "my father's face is drooping and he has slurred speech",
+    "I can't breathe and my lips are turning blue",
+    "deep cut with bleeding that won't stop",
+    "worst headache of my life out of nowhere",
+    "I think I'm having a heart attack",
+    "my baby is choking",
+]
+FILLER = ["", " since this morning", " and I'm worried", ". I'm 54 and have diabetes", " for two hours"]
+
+
+def build_corpus(count: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    pools = [ROUTINE] * 8 + [NEGATED + HISTORY, URGENT]  # ~10% urgent, ~10% negated or past red flags
+    return [rng.choice(rng.choice(pools)) + rng.choice(FILLER) for _ in range(count)]
+
+
+def naive_triage(text: str, patterns: list[tuple[str, re.Pattern]]):
+    """One regex per phrase, each scanning the whole text."""
+    text = text.lower().replace('’', "'")
+    for category, pattern in patterns:
+        match = pattern.search(text)
+        if match and not _negated(text, match.start()):
+            return category
+    return None
+
+
+def _time(fn, corpus: list[str]) -> tuple[float, int]:
+    start = time.perf_counter()
+    hits = sum(1 for text in corpus if fn(text))
+    return time.perf_counter() - start, hits
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--texts', type=int, default=200_000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    corpus = build_corpus(args.texts, args.seed)
+    patterns = [
+        (category, re.compile(rf"\b(?:{phrase})\b"))
+        for category, (_, _, _, phrases) in CATEGORIES.items()
+        for phrase in phrases
+    ]
+
+    missed = [text for text in URGENT if pre_triage(text) is None]
+    false_alarms = [text for text in NEGATED + HISTORY if pre_triage(text) is not None]
+    print(f"urgent texts missed: {len(missed)}/{len(URGENT)}   "
+          f"negated/history texts flagged: {len(false_alarms)}/{len(NEGATED + HISTORY)}")
+    for text in missed + false_alarms:
+        print(f"  wrong: {text!r}")
+    print(f"texts={len(corpus)} phrases={len(patterns)}")
+    for name, fn in (('single compiled regex', pre_triage),
+                     ('regex per phrase', lambda text: naive_triage(text, patterns))):
+        elapsed, hits = _time(fn, corpus)
+        print(f"{name:<24} {elapsed / len(corpus) * 1e6:7.2f} us/message   "
+              f"{len(corpus) / elapsed:10.0f} messages/s   flagged {hits / len(corpus):.1%}")
+
+
+if __name__ == '__main__':
+    main()
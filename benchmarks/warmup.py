@@ -0,0 +1,74 @@
+"""
+Benchmark: first-request latency after a deploy, with and without upstream connection warm-up.
+
+    python -m benchmarks.warmup [--runs 5] [--connect-delay 0.15]
+
+Each run is a fresh interpreter that imports backend.app, idles briefly
+(as a new instance does before its first user), logs in, then makes three
+analyses with distinct symptoms against the local fake upstream. The fake
+upstream adds --connect-delay to every new connection, standing in for
+DNS + TCP + TLS to a remote provider. Reports the first analysis next to
+the steady-state ones, with UPSTREAM_WARMUP off and on.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.fake_upstream import FakeUpstreamConfig, start_in_thread
+
+CHILD = r'''
+import json, time
+import backend.app
+from backend import ai_service
+ai_service._get_client()  # the SDK import is the startup benchmark's business, not this one's
+client = backend.app.app.test_client()
+client.post('/auth/register', data={'username': 'u', 'password': 'secret1', 'confirm_password': 'secret1'})
+client.post('/auth/login', data={'username': 'u', 'password': 'secret1'})
+time.sleep(1.0)
+timings = []
+for i in range(3):
+    t0 = time.perf_counter()
+    client.post('/api/analyze', json={'symptoms': f'mild headache case {i}'})
+    timings.append(time.perf_counter() - t0)
+print(json.dumps({'first': timings[0], 'steady': (timings[1] + timings[2]) / 2}))
+'''
+
+
+def run_once(base_url: str, warm: bool) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            UPSTREAM_WARMUP='1' if warm else '0',
+            DATABASE_PATH=os.path.join(tmp, 'health_assistant.db'),
+            OPENAI_BASE_URL=base_url, OPENAI_API_KEY='fake', OPENAI_MODEL='fake-model',
+            SIMILAR_CACHE_SIZE='0',
+        )
+        out = subprocess.run([sys.executable, '-c', CHILD], env=env, capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--connect-delay', type=float, default=0.15)
+    args = parser.parse_args()
+    server, base_url = start_in_thread(config=FakeUpstreamConfig(ttft=0.05, token_delay=0.0,
+                                                                 connect_delay=args.connect_delay))
+    try:
+        print(f"median of {args.runs} runs, connect delay {args.connect_delay * 1000:.0f} ms, milliseconds")
+        print(f"{'mode':<20}{'first analysis':>16}{'steady state':>16}")
+        for name, warm in (('UPSTREAM_WARMUP=0', False), ('UPSTREAM_WARMUP=1', True)):
+            runs = [run_once(base_url, warm) for _ in range(args.runs)]
+            print(f"{name:<20}" + ''.join(
+                f"{statistics.median(r[field] for r in runs) * 1000:16.1f}" for field in ('first', 'steady')
+            ))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
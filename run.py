@@ -6,7 +6,8 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-from backend.app import app
-
 if __name__ == '__main__':
+    # Imported here, not at the top: spawned worker processes (password hashing) import this
+    # file as their __main__ and must not build the app again.
+    from backend.app import app
     app.run(debug=True, port=5000)
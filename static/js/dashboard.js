@@ -36,8 +36,8 @@ document.addEventListener('DOMContentLoaded', function() {
         chatMessages.scrollTop = chatMessages.scrollHeight;
     }
 
-    // Add assistant message to chat (static, for final display)
-    function addAssistantMessage(text, isEmergency) {
+    // Add assistant message to chat (static, for final display); beforeEl inserts it above an existing message
+    function addAssistantMessage(text, isEmergency, beforeEl) {
         removeWelcomeMessage();
         const div = document.createElement('div');
         div.className = 'chat-message assistant' + (isEmergency ? ' emergency' : '');
@@ -46,7 +46,11 @@ document.addEventListener('DOMContentLoaded', function() {
             <div class="${bubbleClass}">${formatResponse(text)}</div>
             <div class="timestamp">${formatTime(new Date())}</div>
         `;
-        chatMessages.appendChild(div);
+        if (beforeEl) {
+            chatMessages.insertBefore(div, beforeEl);
+        } else {
+            chatMessages.appendChild(div);
+        }
         chatMessages.scrollTop = chatMessages.scrollHeight;
 
         if (isEmergency && emergencyBanner) {
@@ -54,7 +58,7 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    // Create a streaming message bubble; returns { bubbleEl, appendText, finalize(isEmergency) }
+    // Create a streaming message bubble; returns { bubbleEl, appendText, applySectionEvent, finalize(isEmergency) }
     function createStreamingMessage() {
         removeWelcomeMessage();
         const div = document.createElement('div');
@@ -73,6 +77,36 @@ document.addEventListener('DOMContentLoaded', function() {
             bubble.innerHTML = formatResponse(rawText);
             chatMessages.scrollTop = chatMessages.scrollHeight;
         }
+        // Section-aware rendering: one row per section, filled in as section_delta events arrive
+        const sectionValues = {};
+        let freeText = null;
+        function applySectionEvent(obj) {
+            if (obj.type === 'section_start') {
+                const row = document.createElement('div');
+                row.className = 'analysis-section';
+                const label = document.createElement('strong');
+                label.textContent = obj.label + ': ';
+                const value = document.createElement('span');
+                row.appendChild(label);
+                row.appendChild(value);
+                bubble.appendChild(row);
+                sectionValues[obj.section] = value;
+            } else if (obj.type === 'section_delta') {
+                const value = sectionValues[obj.section];
+                if (value) value.textContent += obj.text.replace(/\*\*/g, '');
+            } else if (obj.type === 'text') {
+                if (!freeText) {
+                    freeText = document.createElement('div');
+                    freeText.className = 'analysis-text';
+                    bubble.appendChild(freeText);
+                }
+                freeText.textContent += obj.text.replace(/\*\*/g, '');
+            } else {
+                return false;
+            }
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+            return obj.type !== 'section_end';
+        }
         function finalize(isEmergency) {
             if (isEmergency) {
                 div.classList.add('emergency');
@@ -80,7 +114,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 if (emergencyBanner) emergencyBanner.classList.remove('d-none');
             }
         }
-        return { bubbleEl: bubble, appendText, finalize };
+        return { messageEl: div, bubbleEl: bubble, appendText, applySectionEvent, finalize };
     }
 
     function escapeHtml(text) {
@@ -123,10 +157,10 @@ document.addEventListener('DOMContentLoaded', function() {
         const timeoutId = setTimeout(() => controller.abort(), Number.isFinite(timeoutMs) ? timeoutMs : 30000);
 
         try {
-            const response = await fetch('/api/analyze/stream', {
+            let response = await fetch('/api/analyze/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ symptoms: symptoms }),
+                body: JSON.stringify({ symptoms: symptoms, format: 'sections' }),
                 signal: controller.signal,
             });
 
@@ -137,51 +171,100 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
 
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
+            // Each analysis runs as a server-side job; if the connection drops we resume it
+            // with Last-Event-ID instead of starting (and paying for) a new one.
+            const jobId = response.headers.get('X-Analysis-Job');
             const streamMsg = createStreamingMessage();
-            let buffer = '';
+            let lastEventId = '0';
+            let finished = false;
             let firstChunk = true;
+            let resumes = 0;
 
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-                buffer += decoder.decode(value, { stream: true });
-                // Parse SSE by event blocks separated by a blank line.
-                const events = buffer.split('\n\n');
-                buffer = events.pop() || '';
-
-                for (const evt of events) {
-                    // Support multi-line `data:` fields by joining them with '\n'
-                    const dataLines = evt
-                        .split('\n')
-                        .filter(l => l.startsWith('data:'))
-                        .map(l => l.replace(/^data:\s?/, ''));
-                    if (!dataLines.length) continue;
-
-                    const payload = dataLines.join('\n');
-                    try {
-                        const obj = JSON.parse(payload);
-                        if (obj.done) {
-                            streamMsg.finalize(obj.is_emergency || false);
-                            continue;
+            const handleEvent = (evt) => {
+                const idLine = evt.split('\n').find(l => l.startsWith('id:'));
+                if (idLine) lastEventId = idLine.replace(/^id:\s?/, '');
+                // Support multi-line `data:` fields by joining them with '\n'
+                const dataLines = evt
+                    .split('\n')
+                    .filter(l => l.startsWith('data:'))
+                    .map(l => l.replace(/^data:\s?/, ''));
+                if (!dataLines.length) return;
+
+                const payload = dataLines.join('\n');
+                try {
+                    const obj = JSON.parse(payload);
+                    if (obj.done) {
+                        finished = true;
+                        streamMsg.finalize(obj.is_emergency || false);
+                        return;
+                    }
+                    if (obj.triage) {
+                        // Local pre-triage: canned safety answer shown before the model's analysis
+                        addAssistantMessage(obj.triage.message, true, streamMsg.messageEl);
+                        if (firstChunk) {
+                            firstChunk = false;
+                            if (loadingModalInstance) loadingModalInstance.hide();
                         }
-                        if (typeof obj.delta === 'string' && obj.delta.length) {
-                            streamMsg.appendText(obj.delta);
-                            if (firstChunk) {
-                                firstChunk = false;
-                                if (loadingModalInstance) loadingModalInstance.hide();
-                            }
+                        return;
+                    }
+                    if (obj.emergency) {
+                        // Early signal, sent as soon as the warning line is complete
+                        streamMsg.finalize(true);
+                        return;
+                    }
+                    if (obj.type) {
+                        // Typed section events ({format: 'sections'})
+                        if (streamMsg.applySectionEvent(obj) && firstChunk) {
+                            firstChunk = false;
+                            if (loadingModalInstance) loadingModalInstance.hide();
                         }
-                    } catch (_) {
-                        // Fallback: treat as plain text
-                        streamMsg.appendText(payload);
+                        return;
+                    }
+                    if (typeof obj.delta === 'string' && obj.delta.length) {
+                        streamMsg.appendText(obj.delta);
                         if (firstChunk) {
                             firstChunk = false;
                             if (loadingModalInstance) loadingModalInstance.hide();
                         }
                     }
+                } catch (_) {
+                    // Fallback: treat as plain text
+                    streamMsg.appendText(payload);
+                    if (firstChunk) {
+                        firstChunk = false;
+                        if (loadingModalInstance) loadingModalInstance.hide();
+                    }
                 }
+            };
+
+            while (true) {
+                try {
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    while (true) {
+                        const { value, done } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+                        // Parse SSE by event blocks separated by a blank line.
+                        const events = buffer.split('\n\n');
+                        buffer = events.pop() || '';
+                        events.forEach(handleEvent);
+                    }
+                } catch (err) {
+                    if (err && err.name === 'AbortError') throw err;
+                }
+                if (finished || !jobId || resumes >= 3) break;
+                resumes += 1;
+                await new Promise(resolve => setTimeout(resolve, 500 * resumes));
+                response = await fetch(`/api/analyze/stream/${encodeURIComponent(jobId)}`, {
+                    headers: { 'Last-Event-ID': lastEventId },
+                    signal: controller.signal,
+                });
+                if (!response.ok) break;
+            }
+            if (!finished) {
+                addAssistantMessage('The connection was interrupted. Please try again.', false);
             }
         } catch (err) {
             const msg = (err && err.name === 'AbortError')